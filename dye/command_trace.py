@@ -0,0 +1,234 @@
+"""Record every command we run, with its timing, so we can tell which step
+made a deploy slow.
+
+This is used both by tasklib (for local subprocesses) and by fablib (for
+remote commands), so it only uses the standard library - fablib must not
+have to import tasklib to get it.  Each command is kept in trace_records for
+the summary table, and if a trace file is given it is also appended to that
+file as one JSON object per line, with the keys:
+
+* command - the command line
+* host - where it ran
+* start, end - seconds since the epoch
+* seconds - how long it took
+* exit_code - None if we don't know (eg. the command could not be started)
+* output_bytes - the size of the output, None if it was not captured
+
+Commands, along with tasks, deploy steps and SQL statements, are also kept
+as spans of time in trace_spans.  These can be written out as a Chrome
+trace event file (load it in chrome://tracing or https://ui.perfetto.dev)
+with one process per host and one thread per worker thread, so nested
+spans show what was running inside what, and where things were waiting.
+"""
+from contextlib import contextmanager
+import json
+import re
+import threading
+import time
+
+# the commands traced so far in this run
+trace_records = []
+# spans for the Chrome trace - tasks, steps, commands and SQL
+trace_spans = []
+# (host, events) from trace files written elsewhere, eg. by tasks.py on
+# the server
+_merged_traces = []
+_trace_lock = threading.Lock()
+_local_host = None
+
+# don't write passwords into trace files - mysql takes them as -p<password>,
+# and only mysql, as plenty of other commands have options starting with -p
+_mysql_command_re = re.compile(r"(^|[\s/;&|('\"])mysql(dump|admin)?(\s|$)")
+_password_re = re.compile(r"(^|\s)(-p|--password=)\S+")
+
+
+def _local_hostname():
+    global _local_host
+    if _local_host is None:
+        import socket
+        _local_host = socket.gethostname()
+    return _local_host
+
+
+def _record_command(command, start_time, end_time, exit_code,
+                    output_bytes=None, host=None, trace_file=None,
+                    category='command'):
+    if not isinstance(command, basestring):
+        command = ' '.join(command)
+    if _mysql_command_re.search(command):
+        command = _password_re.sub(r'\1\2***', command)
+    if host is None:
+        host = _local_hostname()
+    _record_span(command, category, start_time, end_time, host,
+                 {'exit_code': exit_code, 'output_bytes': output_bytes})
+    record = {
+        'command': command,
+        'host': host,
+        'start': start_time,
+        'end': end_time,
+        'seconds': end_time - start_time,
+        'exit_code': exit_code,
+        'output_bytes': output_bytes,
+    }
+    _trace_lock.acquire()
+    try:
+        trace_records.append(record)
+        if trace_file:
+            f = open(trace_file, 'a')
+            try:
+                f.write(json.dumps(record, sort_keys=True) + '\n')
+            finally:
+                f.close()
+    finally:
+        _trace_lock.release()
+    return record
+
+
+def _format_bytes(num_bytes):
+    if num_bytes is None:
+        return '-'
+    if num_bytes < 1024:
+        return '%dB' % num_bytes
+    return '%.1fKB' % (num_bytes / 1024.0)
+
+
+def _trace_summary(records=None, limit=10, command_width=60):
+    """Return the lines of a table of the slowest commands"""
+    if records is None:
+        records = trace_records
+    if not records:
+        return []
+    lines = ['%8s %5s %8s  %-20s %s' %
+             ('seconds', 'exit', 'output', 'host', 'command')]
+    slowest = sorted(records, key=lambda r: r['seconds'], reverse=True)
+    for record in slowest[:limit]:
+        command = record['command']
+        if len(command) > command_width:
+            command = command[:command_width - 3] + '...'
+        exit_code = record['exit_code']
+        if exit_code is None:
+            exit_code = '?'
+        lines.append('%8.1f %5s %8s  %-20s %s' % (
+            record['seconds'], exit_code, _format_bytes(record['output_bytes']),
+            record['host'][:20], command))
+    total = sum([r['seconds'] for r in records])
+    lines.append('%8.1f seconds in total for %d commands' % (total, len(records)))
+    return lines
+
+
+def _print_trace_summary(records=None, limit=10):
+    lines = _trace_summary(records, limit)
+    if lines:
+        print
+        print "Slowest commands:"
+        for line in lines:
+            print line
+
+
+def _record_span(name, category, start_time, end_time, host=None, args=None):
+    if host is None:
+        host = _local_hostname()
+    span = {
+        'name': name,
+        'category': category,
+        'start': start_time,
+        'end': end_time,
+        'host': host,
+        'thread': threading.currentThread().getName(),
+        'args': args or {},
+    }
+    _trace_lock.acquire()
+    try:
+        trace_spans.append(span)
+    finally:
+        _trace_lock.release()
+
+
+@contextmanager
+def _span(name, category, host=None, args=None):
+    """Record the time spent in the with block as a span"""
+    start_time = time.time()
+    try:
+        yield
+    finally:
+        _record_span(name, category, start_time, time.time(), host, args)
+
+
+def _chrome_trace_events(spans=None, merged_traces=None):
+    """Convert the spans to Chrome trace events, with a process for each
+    host and a thread for each thread on that host"""
+    if spans is None:
+        spans = trace_spans
+    if merged_traces is None:
+        merged_traces = _merged_traces
+    pids = {}
+    tids = {}
+    events = []
+
+    def pid_for(host):
+        if host not in pids:
+            pids[host] = len(pids) + 1
+            events.append({'name': 'process_name', 'ph': 'M', 'pid': pids[host],
+                           'tid': 0, 'args': {'name': host}})
+        return pids[host]
+
+    def tid_for(host, thread):
+        if (host, thread) not in tids:
+            tids[(host, thread)] = len(tids) + 1
+            events.append({'name': 'thread_name', 'ph': 'M',
+                           'pid': pid_for(host), 'tid': tids[(host, thread)],
+                           'args': {'name': thread}})
+        return tids[(host, thread)]
+
+    for span in spans:
+        events.append({
+            'name': span['name'],
+            'cat': span['category'],
+            'ph': 'X',
+            'ts': int(span['start'] * 1000000),
+            'dur': int((span['end'] - span['start']) * 1000000),
+            'pid': pid_for(span['host']),
+            'tid': tid_for(span['host'], span['thread']),
+            'args': span['args'],
+        })
+
+    for host, merged_events in merged_traces:
+        # the threads of the other trace keep their names, but move into
+        # the process for this host
+        thread_names = {}
+        for event in merged_events:
+            if event.get('ph') == 'M' and event.get('name') == 'thread_name':
+                thread_names[event['tid']] = event['args']['name']
+        for event in merged_events:
+            if event.get('ph') == 'M':
+                continue
+            event = dict(event)
+            thread = thread_names.get(event.get('tid'), str(event.get('tid')))
+            event['pid'] = pid_for(host)
+            event['tid'] = tid_for(host, thread)
+            events.append(event)
+    return events
+
+
+def _write_chrome_trace(profile_file):
+    f = open(profile_file, 'w')
+    try:
+        json.dump({'traceEvents': _chrome_trace_events(),
+                   'displayTimeUnit': 'ms'}, f)
+    finally:
+        f.close()
+
+
+def _merge_chrome_trace(profile_file, host):
+    """Add the events from another Chrome trace file, putting them all in
+    the process for host"""
+    f = open(profile_file)
+    try:
+        trace = json.load(f)
+    finally:
+        f.close()
+    _trace_lock.acquire()
+    try:
+        _merged_traces.append((host, trace.get('traceEvents', [])))
+    finally:
+        _trace_lock.release()
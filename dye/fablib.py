@@ -1,16 +1,28 @@
 import os
 from os import path
+import atexit
+from contextlib import contextmanager
 from datetime import datetime
 import getpass
+import json
+import pipes
+import Queue
 import re
+import subprocess
+import threading
 import time
+import urlparse
 
 from fabric.context_managers import cd, hide, settings
-from fabric.operations import require, prompt, get, run, sudo, local
+from fabric.decorators import runs_once
+from fabric.network import normalize
+from fabric.operations import require, prompt, get, put, run, sudo, local
 from fabric.state import env
 from fabric.contrib import files
 from fabric import utils
 
+from dye import command_trace
+
 
 def _setup_paths(project_settings):
     # first merge in variables from project_settings - but ignore __doc__ etc
@@ -20,6 +32,7 @@ def _setup_paths(project_settings):
 
     # allow for project_settings having set up some of these differently
     env.setdefault('verbose', False)
+    env.setdefault('trace_file', None)
     env.setdefault('use_sudo', True)
     env.setdefault('cvs_rsh', 'CVS_RSH="ssh"')
     env.setdefault('default_branch', {'production': 'master', 'staging': 'master'})
@@ -28,10 +41,59 @@ def _setup_paths(project_settings):
     # TODO: change dev -> current
     env.setdefault('vcs_root_dir', path.join(env.server_project_home, 'dev'))
     env.setdefault('prev_root', path.join(env.server_project_home, 'previous'))
+    # old versions are moved here, and then deleted in the background - it
+    # must be on the same filesystem as prev_root
+    env.setdefault('trash_dir', path.join(env.server_project_home, 'trash'))
     env.setdefault('next_dir', path.join(env.server_project_home, 'next'))
     env.setdefault('dump_dir', path.join(env.server_project_home, 'dbdumps'))
+    env.setdefault('deploy_history_file',
+                   path.join(env.server_project_home, 'deploy_history.jsonl'))
     env.setdefault('deploy_dir', path.join(env.vcs_root_dir, 'deploy'))
     env.setdefault('settings', '%(project_name)s.settings' % env)
+    # a URL for graceful_reload to check once the new code is running - this
+    # is fetched on the server, so http://localhost/ with a ServerAlias is fine
+    env.setdefault('health_check_url', None)
+    env.setdefault('health_check_timeout', 60)
+    # paths that warm_up fetches after deploy
+    env.setdefault('warm_up_urls', [])
+    # for sizing WSGIDaemonProcess - the share of the memory our WSGI daemon
+    # processes can use, and the size of a process if none are running to
+    # measure
+    env.setdefault('wsgi_memory_fraction', 0.5)
+    env.setdefault('wsgi_worker_rss_mb', 150)
+    # with webserver = 'nginx' the app is run by gunicorn, listening on a
+    # socket that stays put while the releases move around
+    env.setdefault('gunicorn_socket',
+                   path.join(env.server_project_home, 'gunicorn.sock'))
+    env.setdefault('gunicorn_pidfile',
+                   path.join(env.server_project_home, 'gunicorn.pid'))
+    env.setdefault('gunicorn_user', None)
+    # git checkouts can be shallow (git_clone_depth) or leave out the file
+    # contents until they are needed (git_partial_clone), and can share the
+    # objects of a mirror on the server, so each fetch from the repository
+    # is only done once per server
+    env.setdefault('git_clone_depth', None)
+    env.setdefault('git_partial_clone', False)
+    env.setdefault('git_use_mirror', False)
+    env.setdefault('git_mirror_dir', path.join(env.server_home, 'git_mirrors',
+                                               env.project_name + '.git'))
+    # send the new commits from here as a git bundle, rather than the server
+    # fetching them from the repository
+    env.setdefault('git_push_bundle', False)
+    env.setdefault('submodule_cache_dir', None)
+    # how many old versions to keep for rollback - and optionally, the
+    # oldest to keep and the disk space they can use between them (the
+    # latest old version is always kept)
+    env.setdefault('versions_to_keep', 5)
+    env.setdefault('versions_max_age_days', None)
+    env.setdefault('versions_disk_budget_mb', None)
+    # rolling_deploy takes each batch of hosts out of the load balancer with
+    # lb_drain_hook(host) and puts them back with lb_restore_hook(host) - set
+    # these in localfab.py.  rolling_min_capacity is the fewest hosts that
+    # must stay in service.
+    env.setdefault('lb_drain_hook', _lb_drain_stub)
+    env.setdefault('lb_restore_hook', _lb_restore_stub)
+    env.setdefault('rolling_min_capacity', None)
 
     if env.project_type == "django":
         env.setdefault('relative_django_dir', env.project_name)
@@ -84,17 +146,38 @@ def _get_python():
     return env.python_bin
 
 
-def _get_tasks_bin():
+def _get_tasks_bin(in_next=False):
+    if in_next:
+        # the same tasks.py, but in the next directory
+        relative_deploy_dir = path.relpath(env.deploy_dir, env.vcs_root_dir)
+        return path.join(env.next_dir, relative_deploy_dir, 'tasks.py')
     if 'tasks_bin' not in env:
         env.tasks_bin = path.join(env.deploy_dir, 'tasks.py')
     return env.tasks_bin
 
 
-def _tasks(tasks_args, verbose=False):
-    tasks_cmd = _get_tasks_bin()
+def _tasks(tasks_args, verbose=False, in_next=False):
+    tasks_cmd = _get_tasks_bin(in_next)
     if env.verbose or verbose:
         tasks_cmd += ' -v'
-    sudo_or_run(tasks_cmd + ' ' + tasks_args)
+    if env.get('profile_file'):
+        # get tasks.py to profile itself, then fetch its trace and merge it
+        # into ours
+        remote_profile = '/tmp/dye_tasks_profile_%s_%d.json' % (
+            env.project_name, os.getpid())
+        tasks_cmd += ' --profile=' + remote_profile
+        result = sudo_or_run(tasks_cmd + ' ' + tasks_args)
+        local_profile = env.profile_file + '.tasks.tmp'
+        with settings(hide('running'), warn_only=True):
+            get(remote_profile, local_profile)
+            sudo_or_run('rm -f ' + remote_profile)
+        if path.exists(local_profile):
+            command_trace._merge_chrome_trace(local_profile,
+                '%s tasks.py' % env.host_string)
+            os.remove(local_profile)
+        return result
+    else:
+        return sudo_or_run(tasks_cmd + ' ' + tasks_args)
 
 
 def _get_svn_user_and_pass():
@@ -111,6 +194,21 @@ def verbose(verbose=True):
     env.verbose = verbose
 
 
+def trace_commands(trace_file='fab_trace.jsonl'):
+    """Append a JSON line to trace_file for every remote command, with the
+    host, start and end time, exit code and output size"""
+    env.trace_file = path.abspath(trace_file)
+
+
+def profile(profile_file='fab_profile.json'):
+    """Write a Chrome trace event file of the following tasks when fab
+    finishes, showing every remote command on a track for its host, and
+    the tasks, steps, manage.py commands and SQL that tasks.py ran on the
+    server.  Use like: fab production profile deploy"""
+    env.profile_file = path.abspath(profile_file)
+    atexit.register(command_trace._write_chrome_trace, env.profile_file)
+
+
 def deploy_clean(revision=None):
     """ delete the entire install and do a clean install """
     if env.environment == 'production':
@@ -143,7 +241,9 @@ def deploy(revision=None, keep=None):
     * keep is the number of old versions to keep around for rollback (default
       5)"""
     require('server_project_home', provided_by=env.valid_envs)
-    check_for_local_changes()
+    phases = []
+    with _deploy_phase(phases, 'check_local_changes'):
+        check_for_local_changes()
 
     _create_dir_if_not_exists(env.server_project_home)
 
@@ -153,40 +253,286 @@ def deploy(revision=None, keep=None):
     # TODO: if dev/ is found to be a link, ask the user if the apache config
     # has been updated to point at current/ - and if so then delete dev/
     # _migrate_from_dev_to_current()
-    create_copy_for_next()
-    checkout_or_update(in_next=True, revision=revision)
-    # remove any old pyc files - essential if the .py file has been removed
+    with _deploy_phase(phases, 'copy'):
+        create_copy_for_next()
+    with _deploy_phase(phases, 'checkout'):
+        checkout_or_update(in_next=True, revision=revision)
+        # remove any orphaned pyc files - essential if the .py file has
+        # been removed
+        if env.project_type == "django":
+            rm_pyc_files(env.next_dir,
+                         path.join(env.next_dir, env.relative_ve_dir))
+    deployed_revision = _deployed_revision(env.next_dir)
+    with _deploy_phase(phases, 'virtualenv'):
+        # create the deploy virtualenv if we use it
+        create_deploy_virtualenv(in_next=True)
+
+    # do everything we can in the next directory, while the old version
+    # carries on being served: settings, submodules and static files
+    with _deploy_phase(phases, 'prepare'):
+        _tasks('deploy_prepare:' + env.environment, in_next=True)
+        db_changes = _db_changes_pending()
+        if db_changes and env.get('rolling_deploy_db_changes') is False:
+            utils.abort('there are database changes to make, and the hosts '
+                        'not deployed yet would use the changed database - '
+                        'see "fab -d rolling_deploy", and give db_changes=true '
+                        'if the old code works with it')
+        conf_changed = _webserver_conf_changed()
     if env.project_type == "django":
-        rm_pyc_files(path.join(env.next_dir, env.relative_django_dir))
-    # create the deploy virtualenv if we use it
-    create_deploy_virtualenv(in_next=True)
-
-    # we only have to disable this site after creating the rollback copy
-    # (do this so that apache carries on serving other sites on this server
-    # and the maintenance page for this vhost)
+        with _deploy_phase(phases, 'compile'):
+            # the .pyc files record where the .py file was - so give them the
+            # path it will have after the switch
+            _tasks('compile_python:' + env.vcs_root_dir, in_next=True)
+
+    # we only need to take the site down if the database is changing, and
+    # only for this vhost (so apache carries on serving the other sites on
+    # this server, and the maintenance page for this one)
     downtime_start = datetime.now()
-    link_webserver_conf(maintenance=True)
-    with settings(warn_only=True):
-        webserver_cmd('reload')
-    next_to_current_to_rollback()
+    if db_changes:
+        with _deploy_phase(phases, 'maintenance_on'):
+            link_webserver_conf(maintenance=True)
+            with settings(warn_only=True):
+                webserver_cmd('reload')
+    with _deploy_phase(phases, 'dump'):
+        # when the database isn't changing the site stays up, so we dump
+        # before the switch rather than leaving a gap between switching the
+        # code and reloading it
+        _dump_db_in_previous_directory(env.vcs_root_dir)
+    if not db_changes:
+        downtime_start = datetime.now()
+    with _deploy_phase(phases, 'switch'):
+        next_to_current_to_rollback(dump=False)
+    if db_changes:
+        with _deploy_phase(phases, 'update_db'):
+            _tasks('deploy_db:' + env.environment)
+        # the site is down anyway, so finish off before bringing it back
+        _tasks('deploy_finish:' + env.environment)
+
+    # straight after the switch, so the old processes don't carry on with
+    # the new code on disk any longer than they have to
+    with _deploy_phase(phases, 'reload'):
+        if db_changes or conf_changed:
+            _reload_webserver_and_app()
+        else:
+            # only our WSGI daemon processes need to change
+            graceful_reload()
+        downtime_end = datetime.now()
+    if not db_changes:
+        _tasks('deploy_finish:' + env.environment)
+    with _deploy_phase(phases, 'warm_up'):
+        warm_up()
+
+    with _deploy_phase(phases, 'cleanup'):
+        delete_old_rollback_versions(keep)
+        if env.environment == 'production':
+            setup_db_dumps()
+
+    _report_downtime(downtime_start, downtime_end)
+    _record_deploy_history(deployed_revision, phases,
+                           downtime_end - downtime_start)
+    command_trace._print_trace_summary()
+
+
+def _lb_drain_stub(host):
+    utils.puts('load balancer: take %s out (set env.lb_drain_hook to do '
+               'this for real)' % host)
+
+
+def _lb_restore_stub(host):
+    utils.puts('load balancer: put %s back (set env.lb_restore_hook to do '
+               'this for real)' % host)
+
+
+def _rolling_batches(hosts, batch_size, min_capacity=None):
+    """Split the hosts into batches of batch_size for rolling_deploy,
+    checking that at least min_capacity hosts will be in service while each
+    batch is being deployed"""
+    if batch_size < 1:
+        utils.abort('batch_size must be at least 1')
+    if min_capacity is not None and len(hosts) - batch_size < min_capacity:
+        utils.abort('deploying %d of %d hosts at a time would leave fewer than '
+                    '%d in service' % (batch_size, len(hosts), min_capacity))
+    return [hosts[i:i + batch_size] for i in range(0, len(hosts), batch_size)]
+
+
+@runs_once
+def rolling_deploy(batch_size=1, min_capacity=None, revision=None, keep=None,
+                   db_changes=False):
+    """ deploy to the hosts a batch at a time, so the site stays up
+
+    Each batch is taken out of the load balancer (see env.lb_drain_hook),
+    deployed, and put back once env.health_check_url answers on every host
+    in it (asking each host directly, not through the load balancer) - and
+    only then is the next batch started.  If a batch fails, its hosts that
+    still answer are put back.
+
+    The first host deployed changes the shared database while the hosts in
+    the later batches are still running the old code, so by default this
+    stops if there are database changes to make.  Set db_changes=true once
+    you are sure the old code works with the new database - add columns and
+    tables in one deploy, and only remove the ones the old code used in a
+    later one (expand, then contract).
+
+    * batch_size is the number of hosts to deploy at once (default 1)
+    * min_capacity is the fewest hosts that must stay in service (default
+      rolling_min_capacity from project_settings, if set)
+    * revision and keep are passed on to deploy """
+    hosts = list(env.hosts)
+    if not hosts:
+        utils.abort('no hosts - give an environment first, eg. fab production rolling_deploy')
+    if min_capacity is None:
+        min_capacity = env.rolling_min_capacity
+    if min_capacity is not None:
+        min_capacity = int(min_capacity)
+    batches = _rolling_batches(hosts, int(batch_size), min_capacity)
+    allow_db_changes = str(db_changes).lower() in ('true', 'yes', '1')
+    if not env.health_check_url:
+        utils.warn('health_check_url is not set, so hosts will go back into '
+                   'the load balancer without being checked')
+    for number, batch in enumerate(batches):
+        utils.puts('rolling deploy: batch %d of %d: %s' % (
+            number + 1, len(batches), ', '.join(batch)))
+        for host in batch:
+            env.lb_drain_hook(host)
+        # anything going wrong - an abort, a hook failing, Ctrl-C - must not
+        # leave the batch out of the load balancer without saying so
+        batch_done = False
+        try:
+            for host in batch:
+                with settings(host_string=host, host=normalize(host)[1],
+                              rolling_deploy_db_changes=allow_db_changes):
+                    deploy(revision, keep)
+                    _wait_for_health_check()
+            batch_done = True
+        finally:
+            if not batch_done:
+                _restore_healthy_hosts(batch)
+        for host in batch:
+            env.lb_restore_hook(host)
+
+
+def _restore_healthy_hosts(batch):
+    """After a batch failed, put the hosts that still answer the health
+    check back into the load balancer, and say how to put the others back"""
+    drained = []
+    for host in batch:
+        # this runs while another exception is on its way up, so nothing
+        # here may raise and hide it
+        try:
+            healthy = False
+            if env.health_check_url:
+                with settings(host_string=host, host=normalize(host)[1]):
+                    healthy = _health_check_ok()
+            if healthy:
+                env.lb_restore_hook(host)
+        except (SystemExit, Exception):
+            healthy = False
+        if not healthy:
+            drained.append(host)
+    if drained:
+        utils.warn('rolling deploy stopped - %s left out of the load balancer '
+                   '(once fixed, put them back with "fab %s lb_restore:%s"), and '
+                   'the later batches were not deployed' % (', '.join(drained),
+                   env.environment, ','.join(drained)))
+    else:
+        utils.warn('rolling deploy stopped - the later batches were not '
+                   'deployed')
 
-    # Use tasks.py deploy:env to actually do the deployment, including
-    # creating the virtualenv if it thinks it necessary, ignoring
-    # env.use_virtualenv as tasks.py knows nothing about it.
-    _tasks('deploy:' + env.environment)
 
-    # bring this vhost back in, reload the webserver and touch the WSGI
-    # handler (which reloads the wsgi app)
-    link_webserver_conf()
-    webserver_cmd('reload')
-    downtime_end = datetime.now()
-    touch_wsgi()
+@runs_once
+def lb_restore(*hosts):
+    """ put hosts back into the load balancer (default all of them) - eg.
+    after a rolling_deploy stopped part way """
+    for host in hosts or env.hosts:
+        env.lb_restore_hook(host)
 
-    delete_old_rollback_versions(keep)
-    if env.environment == 'production':
-        setup_db_dumps()
 
-    _report_downtime(downtime_start, downtime_end)
+def _webserver_conf_changed(new_dir=None):
+    """Whether the webserver conf in new_dir (by default the next directory)
+    is different from the one in use"""
+    if env.webserver is None:
+        return False
+    if new_dir is None:
+        new_dir = env.next_dir
+    conf_file = path.relpath(_render_webserver_conf(new_dir), new_dir)
+    with settings(hide('running', 'stdout'), warn_only=True):
+        result = sudo_or_run('cmp -s %s %s' % (
+            path.join(env.vcs_root_dir, conf_file),
+            path.join(new_dir, conf_file)))
+    return result.failed
+
+
+def _reload_webserver_and_app():
+    """Bring this vhost back in (or pick up the new conf), reload the
+    webserver and the app, and wait for the app to answer"""
+    link_webserver_conf()
+    webserver_cmd('reload')
+    _reload_wsgi_app()
+    _wait_for_health_check()
+
+
+def _db_changes_pending():
+    """Ask tasks.py in the next directory whether deploy_db has anything to
+    do.  If we can't tell, assume it does."""
+    with settings(hide('running', 'stdout'), warn_only=True):
+        result = _tasks('db_changes_pending:' + env.environment, in_next=True)
+    if result.failed:
+        return True
+    for line in result.splitlines():
+        if line.startswith('pending migration:'):
+            utils.puts(line)
+    return 'db changes pending: no' not in result
+
+
+# the phases of deploy, in order, as recorded in the deploy history
+deploy_phase_names = ['check_local_changes', 'copy', 'checkout', 'virtualenv',
+                      'prepare', 'compile', 'maintenance_on', 'dump', 'switch',
+                      'update_db', 'reload', 'warm_up', 'cleanup']
+
+
+@contextmanager
+def _deploy_phase(phases, name):
+    """Time the commands in the with block, appending (name, seconds) to
+    phases"""
+    start_time = time.time()
+    try:
+        yield
+    finally:
+        phases.append((name, time.time() - start_time))
+
+
+def _deployed_revision(vcs_root_dir):
+    """The VCS revision checked out in vcs_root_dir, or None"""
+    revision_cmd = {
+        'git': 'git rev-parse HEAD',
+        'svn': 'svnversion',
+    }
+    if env.repo_type not in revision_cmd:
+        return None
+    with cd(vcs_root_dir):
+        with settings(hide('running', 'stdout'), warn_only=True):
+            revision = sudo_or_run(revision_cmd[env.repo_type])
+    if revision.failed:
+        return None
+    return revision.strip()
+
+
+def _record_deploy_history(revision, phases, downtime):
+    """Append the phase timings of this deploy to the deploy history file
+    on the server, as a line of JSON"""
+    record = {
+        'time': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'host': env.host_string,
+        'environment': env.environment,
+        'revision': revision,
+        'phases': dict(phases),
+        'total': sum([seconds for name, seconds in phases]),
+        'downtime': downtime.total_seconds(),
+        'wsgi_sizing': env.get('wsgi_sizing'),
+    }
+    with settings(hide('running', 'stdout'), warn_only=True):
+        files.append(env.deploy_history_file, json.dumps(record, sort_keys=True),
+                     use_sudo=env.use_sudo)
 
 
 def _report_downtime(downtime_start, downtime_end):
@@ -196,6 +542,95 @@ def _report_downtime(downtime_start, downtime_end):
                (downtime_start, downtime_end))
 
 
+def _percentile(values, percent):
+    """The value percent of the way through the sorted values, using the
+    nearest rank"""
+    values = sorted(values)
+    index = int(round(percent / 100.0 * (len(values) - 1)))
+    return values[index]
+
+
+def _phase_seconds(deploy_record, name):
+    """How long the named phase took - total and downtime are top level"""
+    if name in ('total', 'downtime'):
+        return deploy_record.get(name)
+    return deploy_record['phases'].get(name)
+
+
+def _deploy_phase_stats(history, recent=10, regression_factor=1.5,
+                        min_regression_seconds=5.0):
+    """Work out the stats for each phase from the deploy history (oldest
+    first).  The latest deploy is compared with the median of the recent
+    deploys before it, and flagged as regressed if it is regression_factor
+    times slower, and at least min_regression_seconds slower.
+
+    Returns a list of dictionaries, one per phase, in deploy order."""
+    if not history:
+        return []
+    latest = history[-1]
+    previous = history[-recent - 1:-1]
+    phase_names = [name for name in deploy_phase_names if name in latest['phases']]
+    phase_names += sorted([name for name in latest['phases']
+                           if name not in deploy_phase_names])
+    stats = []
+    for name in phase_names + ['total', 'downtime']:
+        last = _phase_seconds(latest, name)
+        if last is None:
+            continue
+        values = [_phase_seconds(d, name) for d in history]
+        values = [v for v in values if v is not None]
+        previous_values = [_phase_seconds(d, name) for d in previous]
+        previous_values = [v for v in previous_values if v is not None]
+        regressed = False
+        if previous_values:
+            baseline = _percentile(previous_values, 50)
+            regressed = (last > baseline * regression_factor and
+                         last - baseline >= min_regression_seconds)
+        stats.append({
+            'phase': name,
+            'last': last,
+            'median': _percentile(values, 50),
+            'p90': _percentile(values, 90),
+            'trend': values[-5:],
+            'regressed': regressed,
+        })
+    return stats
+
+
+def deploy_stats(recent=10):
+    """Show how long each phase of recent deploys took, with percentiles,
+    and flag the phases that were slower in the latest deploy than in the
+    recent deploys before it.  recent is the number of deploys to compare
+    with (default 10)"""
+    require('deploy_history_file', provided_by=env.valid_envs)
+    if not files.exists(env.deploy_history_file):
+        utils.abort('No deploy history found at %s' % env.deploy_history_file)
+    with settings(hide('running', 'stdout')):
+        history_lines = sudo_or_run('cat ' + env.deploy_history_file)
+    history = []
+    for line in history_lines.splitlines():
+        try:
+            history.append(json.loads(line))
+        except ValueError:
+            continue
+    if not history:
+        utils.abort('No deploys recorded in %s' % env.deploy_history_file)
+
+    latest = history[-1]
+    print "%d deploys recorded, latest at %s (revision %s)" % (
+        len(history), latest['time'], latest['revision'])
+    print
+    print "%-20s %8s %8s %8s  %-34s" % ('phase', 'last', 'median', 'p90',
+                                       'last 5 deploys')
+    for phase in _deploy_phase_stats(history, recent=int(recent)):
+        trend = ' '.join(['%.1f' % value for value in phase['trend']])
+        flag = ''
+        if phase['regressed']:
+            flag = '  <-- REGRESSED'
+        print "%-20s %8.1f %8.1f %8.1f  %-34s%s" % (phase['phase'],
+            phase['last'], phase['median'], phase['p90'], trend, flag)
+
+
 def set_up_celery_daemon():
     require('vcs_root_dir', 'project_name', provided_by=env)
     for command in ('celerybeat', 'celeryd'):
@@ -253,67 +688,148 @@ def create_copy_for_next():
     if files.exists(env.vcs_root_dir):
         # cp -a - amongst other things this preserves links and timestamps
         # so the compare that bootstrap.py does to see if the virtualenv
-        # needs an update should still work.
-        sudo_or_run('cp -a %s %s' % (env.vcs_root_dir, env.next_dir))
+        # needs an update should still work.  The /. copies the directory
+        # vcs_root_dir links to, rather than the link.
+        sudo_or_run('cp -a %s/. %s' % (env.vcs_root_dir, env.next_dir))
 
 
-def next_to_current_to_rollback():
+def next_to_current_to_rollback(dump=True):
     """Move the current version to the previous directory (so we can roll back
     to it, move the next version to the current version (so it will be used) and
-    do a db dump in the rollback directory."""
+    do a db dump in the rollback directory (unless dump is false, when the
+    dump has already been done)."""
     # create directory for it
     # if this is the initial deploy, the vcs_root_dir won't exist yet.  In that
     # case just skip the rollback version.
+    prev_dir = None
     if files.exists(env.vcs_root_dir):
         _create_dir_if_not_exists(env.prev_root)
         prev_dir = path.join(env.prev_root, time.strftime("%Y-%m-%d_%H-%M-%S"))
-        sudo_or_run('mv %s %s' % (env.vcs_root_dir, prev_dir))
+    _switch_current_to(env.next_dir, prev_dir)
+    if dump and prev_dir:
         _dump_db_in_previous_directory(prev_dir)
-    sudo_or_run('mv %s %s' % (env.next_dir, env.vcs_root_dir))
 
 
-def create_copy_for_rollback():
-    """Move the current version to the previous directory (so we can roll back
-    to it, move the next version to the current version (so it will be used) and
-    do a db dump in the rollback directory."""
-    # create directory for it
-    prev_dir = path.join(env.prev_root, time.strftime("%Y-%m-%d_%H-%M-%S"))
-    _create_dir_if_not_exists(prev_dir)
-    # cp -a
-    sudo_or_run('cp %s %s' % (env.vcs_root_dir, prev_dir))
-    _dump_db_in_previous_directory(prev_dir)
+def _switch_current_to(new_dir, prev_dir):
+    """Make new_dir the current version, and move the current version (if
+    there is one) to prev_dir.
+
+    vcs_root_dir is a symlink to the real directory (named after the time it
+    was switched in), so the switch is one rename of a new symlink over the
+    old one - vcs_root_dir is never missing, and never has a mix of the two
+    versions.  If vcs_root_dir is still a real directory, from before we used
+    the symlink, it has to be moved out of the way first, so that one time
+    there is a short gap."""
+    release_dir = '%s-%s' % (env.vcs_root_dir,
+                             time.strftime("%Y-%m-%d_%H-%M-%S"))
+    new_link = env.vcs_root_dir + '.new'
+    with settings(hide('warnings', 'stdout'), warn_only=True):
+        old_release_dir = sudo_or_run('readlink %s' % env.vcs_root_dir)
+    sudo_or_run('mv %s %s' % (new_dir, release_dir))
+    sudo_or_run('ln -sfn %s %s' % (release_dir, new_link))
+    if old_release_dir.failed and files.exists(env.vcs_root_dir):
+        sudo_or_run('mv %s %s' % (env.vcs_root_dir, prev_dir))
+    sudo_or_run('mv -T %s %s' % (new_link, env.vcs_root_dir))
+    if not old_release_dir.failed and prev_dir is not None:
+        sudo_or_run('mv %s %s' % (old_release_dir.strip(), prev_dir))
 
 
-def _dump_db_in_previous_directory(prev_dir):
+def _dump_db_in_previous_directory(prev_dir, required=False):
+    """Dump the database into prev_dir, so that version can be rolled back to
+    with its database.  A failed dump is only a warning, unless required."""
     require('django_settings_dir', provided_by=env.valid_envs)
     if (env.project_type == 'django' and
             files.exists(path.join(env.django_settings_dir, 'local_settings.py'))):
         # dump database (provided local_settings has been set up properly)
         with cd(prev_dir):
             # just in case there is some other reason why the dump fails
-            with settings(warn_only=True):
+            with settings(warn_only=not required):
                 _tasks('dump_db')
+    elif required:
+        utils.abort('cannot dump the database - is %s set up?' %
+                    path.join(env.django_settings_dir, 'local_settings.py'))
+
+
+def _versions_to_delete(versions, keep, max_age_days=None, budget_mb=None,
+                        sizes_mb=None, now=None):
+    """Which of the old versions (named by time, so oldest first when sorted)
+    to delete, to keep at most "keep" of them (0 for no limit), none older
+    than max_age_days, and no more than budget_mb between them (sizes_mb has
+    the size of each).  The latest version is always kept."""
+    versions = sorted(versions)
+    to_delete = set()
+    if keep:
+        to_delete.update(versions[:-keep])
+    if max_age_days is not None:
+        if now is None:
+            now = datetime.now()
+        for version in versions:
+            try:
+                created = datetime.strptime(version, "%Y-%m-%d_%H-%M-%S")
+            except ValueError:
+                continue
+            if (now - created).days >= max_age_days:
+                to_delete.add(version)
+    if budget_mb is not None:
+        total_mb = 0
+        for version in reversed(versions):
+            total_mb += sizes_mb.get(version, 0)
+            if total_mb > budget_mb:
+                to_delete.add(version)
+    if versions:
+        to_delete.discard(versions[-1])
+    return [version for version in versions if version in to_delete]
+
+
+def _empty_trash():
+    """Delete everything in the trash directory in the background, at idle
+    I/O priority so the site doesn't notice"""
+    with settings(hide('running', 'stdout'), warn_only=True):
+        has_ionice = not sudo_or_run('which ionice').failed
+    low_priority = 'nice'
+    if has_ionice:
+        low_priority += ' ionice -c3'
+    # anything left by an earlier run that was cut short goes too
+    delete_cmd = ('find %s -mindepth 1 -maxdepth 1 -print0 | '
+                  'xargs -0 -r -n 1 -P 4 rm -rf' % env.trash_dir)
+    sudo_or_run("nohup %s sh -c '%s' > /dev/null 2>&1 < /dev/null &"
+                % (low_priority, delete_cmd), pty=False)
 
 
 def delete_old_rollback_versions(keep=None):
-    """Delete old rollback directories, keeping the last "keep" (default 5)"."""
-    require('prev_root', provided_by=env.valid_envs)
-    # the -1 argument ensures one directory per line
-    prev_versions = run('ls -1 ' + env.prev_root).split('\n')
+    """Delete old rollback directories, keeping the last "keep" (default 5),
+    and also going by versions_max_age_days and versions_disk_budget_mb.
+
+    The old versions are moved into the trash directory (which is quick) and
+    deleted from there in the background."""
+    require('prev_root', 'trash_dir', provided_by=env.valid_envs)
     if keep is None:
-        if 'versions_to_keep' in env:
-            keep = env.versions_to_keep
-        else:
-            keep = 5
-    else:
-        keep = int(keep)
-    if keep == 0:
+        keep = env.versions_to_keep
+    keep = int(keep)
+    if keep == 0 and env.versions_max_age_days is None and \
+            env.versions_disk_budget_mb is None:
         return
-    versions_to_keep = -1 * int(keep)
-    prev_versions_to_delete = prev_versions[:versions_to_keep]
+    with settings(hide('running', 'stdout')):
+        # the -1 argument ensures one directory per line
+        prev_versions = sudo_or_run('ls -1 ' + env.prev_root).split()
+    sizes_mb = None
+    if env.versions_disk_budget_mb is not None and prev_versions:
+        sizes_mb = {}
+        with cd(env.prev_root):
+            with settings(hide('running', 'stdout')):
+                du_lines = sudo_or_run('du -sm ' + ' '.join(prev_versions))
+        for line in du_lines.splitlines():
+            size, version = line.split(None, 1)
+            sizes_mb[version.strip()] = int(size)
+    prev_versions_to_delete = _versions_to_delete(prev_versions, keep,
+        env.versions_max_age_days, env.versions_disk_budget_mb, sizes_mb)
+    if not prev_versions_to_delete:
+        return
+    _create_dir_if_not_exists(env.trash_dir)
     for version_to_delete in prev_versions_to_delete:
-        sudo_or_run('rm -rf ' + path.join(
-            env.prev_root, version_to_delete.strip()))
+        sudo_or_run('mv %s %s' % (path.join(env.prev_root, version_to_delete),
+                                  path.join(env.trash_dir, version_to_delete)))
+    _empty_trash()
 
 
 def list_previous():
@@ -324,7 +840,7 @@ def list_previous():
 
 
 def rollback(version='last', migrate=False, restore_db=False):
-    """Redeploy one of the old versions.
+    """Redeploy one of the old versions, without stopping the webserver.
 
     Arguments are 'version', 'migrate' and 'restore_db':
 
@@ -337,7 +853,11 @@ def rollback(version='last', migrate=False, restore_db=False):
       migration status and run the migrations to match the database versions.
       The default is False
 
-    Note that migrate and restore_db cannot both be True."""
+    Note that migrate and restore_db cannot both be True.
+
+    Nothing is copied - the old version is renamed into place, and the
+    version being rolled back from becomes the latest old version (so you
+    can roll forward to it again)."""
     require('prev_root', 'vcs_root_dir', provided_by=env.valid_envs)
     if migrate and restore_db:
         utils.abort('rollback cannot do both migrate and restore_db')
@@ -347,28 +867,51 @@ def rollback(version='last', migrate=False, restore_db=False):
     if version == 'last':
         # get the latest directory from prev_dir
         # list directories in env.prev_root, use last one
-        version = run('ls ' + env.prev_root).split('\n')[-1]
+        version = run('ls ' + env.prev_root).split('\n')[-1].strip()
     # check version specified exists
     rollback_dir = path.join(env.prev_root, version)
     if not files.exists(rollback_dir):
         utils.abort("Cannot rollback to version %s, it does not exist, use list_previous to see versions available" % version)
 
-    webserver_cmd("stop")
-    # first copy this version out of the way
-    create_copy_for_rollback()
+    conf_changed = _webserver_conf_changed(rollback_dir)
     if migrate:
         # run the south migrations back to the old version
         # but how to work out what the old version is??
         pass
     if restore_db:
-        # feed the dump file into mysql command
+        # the database tasks are run by the tasks.py of the version we're
+        # leaving (older versions may not have them), so check it does
+        with settings(hide('running', 'stdout')):
+            description = _tasks('--task-description restore_db_to_next '
+                                 'swap_in_next_db')
+        if 'no such task found' in description:
+            utils.abort('rollback: the tasks.py in %s is too old to do '
+                        'restore_db' % env.vcs_root_dir)
+        # keep the database as it is now with the version we're leaving
+        _dump_db_in_previous_directory(env.vcs_root_dir, required=True)
+        if not files.exists(path.join(rollback_dir, 'db_dump.sql')):
+            utils.abort('rollback: there is no db_dump.sql in %s to restore' %
+                        rollback_dir)
+        # load the old database alongside the one in use (a table at a time,
+        # in parallel) while the site is still up
         with cd(rollback_dir):
-            _tasks('load_dbdump')
-    # delete everything - don't want stray files left over
-    sudo_or_run('rm -rf %s' % env.vcs_root_dir)
-    # cp -a from rollback_dir to vcs_root_dir
-    sudo_or_run('cp -a %s %s' % (rollback_dir, env.vcs_root_dir))
-    webserver_cmd("start")
+            _tasks('restore_db_to_next')
+        # only this vhost goes down, and only while the code and the database
+        # are swapped - the other sites on this server carry on
+        link_webserver_conf(maintenance=True)
+        with settings(warn_only=True):
+            webserver_cmd('reload')
+        # one RENAME TABLE - the database in use is kept as <name>_prev.
+        # The site is down, so it doesn't matter that this is before the
+        # code is swapped, and it means tasks.py is still ours
+        _tasks('swap_in_next_db')
+    # swap in the rollback version
+    prev_dir = path.join(env.prev_root, time.strftime("%Y-%m-%d_%H-%M-%S"))
+    _switch_current_to(rollback_dir, prev_dir)
+    if restore_db or conf_changed:
+        _reload_webserver_and_app()
+    else:
+        graceful_reload()
 
 
 def local_test():
@@ -444,6 +987,141 @@ def _check_git_branch():
                     default=default_branch, validate=validate_branch)
 
 
+def _fan_out_commands():
+    """The read-only commands that fan_out can run on all the hosts"""
+    commands = {'list_previous': 'ls -1 %s' % env.prev_root}
+    version_cmd = {'git': 'git log -1 --oneline', 'svn': 'svnversion'}
+    status_cmd = {'git': 'git status --short', 'svn': 'svn status --quiet'}
+    if env.repo_type in version_cmd:
+        commands['version'] = 'cd %s && %s' % (
+            env.vcs_root_dir, version_cmd[env.repo_type])
+        commands['local_changes'] = 'cd %s && %s' % (
+            env.vcs_root_dir, status_cmd[env.repo_type])
+    if env.webserver:
+        # the hosts needn't all be the same linux
+        commands['configtest'] = \
+            'if [ -f /etc/redhat-release ]; then %s; else %s; fi' % (
+                _webserver_configtests[env.webserver + '_redhat'],
+                _webserver_configtests[env.webserver + '_debian'])
+    return commands
+
+
+def _run_ssh(host_string, command):
+    """Run command on the host with the ssh command, returning the exit code
+    (None if ssh couldn't be run) and the output"""
+    user, host, port = normalize(host_string)
+    if env.use_sudo:
+        # no one to type a password, so fail rather than ask for one
+        command = 'sudo -n sh -c ' + pipes.quote(command)
+    ssh_cmd = ['ssh', '-o', 'BatchMode=yes', '-p', str(port)]
+    # connect the way fabric would
+    key_filenames = env.get('key_filename') or []
+    if isinstance(key_filenames, basestring):
+        key_filenames = [key_filenames]
+    for key_filename in key_filenames:
+        ssh_cmd += ['-i', key_filename]
+    if env.get('gateway'):
+        gateway_user, gateway_host, gateway_port = normalize(env.gateway)
+        ssh_cmd += ['-o', 'ProxyJump=%s@%s:%s' % (gateway_user, gateway_host,
+                                                  gateway_port)]
+    ssh_cmd += ['%s@%s' % (user, host), command]
+    start_time = time.time()
+    try:
+        popen = subprocess.Popen(ssh_cmd, stdout=subprocess.PIPE,
+                                 stderr=subprocess.STDOUT)
+    except OSError, e:
+        command_trace._record_command(command, start_time, time.time(), None,
+            host=host_string, trace_file=env.get('trace_file'), category='remote')
+        return None, str(e)
+    output = popen.communicate()[0]
+    command_trace._record_command(command, start_time, time.time(),
+        popen.returncode, len(output), host=host_string,
+        trace_file=env.get('trace_file'), category='remote')
+    return popen.returncode, output
+
+
+def _fan_out(hosts, command, limit=10, run_command=_run_ssh):
+    """Run command on all the hosts at once, talking to at most limit hosts
+    at a time.  Returns a dictionary of host: (exit code, output, seconds)"""
+    pending = Queue.Queue()
+    for host in hosts:
+        pending.put(host)
+    results = {}
+    results_lock = threading.Lock()
+
+    def worker():
+        while True:
+            try:
+                host = pending.get_nowait()
+            except Queue.Empty:
+                return
+            start_time = time.time()
+            try:
+                exit_code, output = run_command(host, command)
+            except Exception, e:
+                # every host must get a result, or the table can't be made
+                exit_code, output = None, str(e)
+            results_lock.acquire()
+            try:
+                results[host] = (exit_code, output, time.time() - start_time)
+            finally:
+                results_lock.release()
+
+    threads = [threading.Thread(target=worker, name='fan_out_%d' % i)
+               for i in range(max(1, min(int(limit), len(hosts))))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def _fan_out_table(hosts, results, output_width=60):
+    """Return the lines of a table of the results of _fan_out, with the
+    first line of the output from each host"""
+    lines = ['%-30s %5s %7s  %s' % ('host', 'exit', 'seconds', 'output')]
+    failed = 0
+    for host in hosts:
+        exit_code, output, seconds = results[host]
+        if exit_code != 0:
+            failed += 1
+        if exit_code is None:
+            exit_code = '?'
+        output_lines = output.strip().splitlines() or ['']
+        summary = output_lines[0].strip()
+        if len(output_lines) > 1:
+            summary += ' (+%d lines)' % (len(output_lines) - 1)
+        if len(summary) > output_width:
+            summary = summary[:output_width - 3] + '...'
+        lines.append('%-30s %5s %7.1f  %s' % (host[:30], exit_code, seconds, summary))
+    lines.append('%d hosts, %d failed' % (len(hosts), failed))
+    return lines
+
+
+@runs_once
+def fan_out(command='version', limit=10, full=False):
+    """ run a read-only command on all the hosts at once, and show a table of
+    the results.
+
+    command is one of version, list_previous, local_changes or configtest;
+    limit is how many hosts to talk to at a time; full=true shows all the
+    output from each host as well """
+    commands = _fan_out_commands()
+    if command not in commands:
+        utils.abort('fan_out can run: %s' % ', '.join(sorted(commands.keys())))
+    hosts = env.hosts
+    if not hosts:
+        utils.abort('no hosts - give an environment first, eg. fab staging fan_out')
+    results = _fan_out(hosts, commands[command], limit)
+    for line in _fan_out_table(hosts, results):
+        print line
+    if str(full).lower() in ('true', 'yes', '1'):
+        for host in hosts:
+            print
+            print '[%s]' % host
+            print results[host][1].rstrip()
+
+
 def check_for_local_changes():
     """ check if there are local changes on the remote server """
     require('repo_type', 'vcs_root_dir', provided_by=env.valid_envs)
@@ -515,18 +1193,173 @@ def _checkout_or_update_svn(vcs_root_dir, revision=None):
                 sudo_or_run(cmd)
 
 
+def _git_clone_options():
+    """The options for a shallow and/or partial clone or fetch"""
+    options = ''
+    if env.git_clone_depth:
+        options += ' --depth %d' % int(env.git_clone_depth)
+    if env.git_partial_clone:
+        options += ' --filter=blob:none'
+    return options
+
+
+def _set_git_remote_url(remote, url):
+    """Point the remote at url, unless it already does - run it inside the
+    repository"""
+    with settings(hide('running', 'stdout'), warn_only=True):
+        current_url = sudo_or_run('git config --get remote.%s.url' % remote)
+    if current_url.failed:
+        sudo_or_run('git remote add %s %s' % (remote, url))
+    elif current_url.strip() != url:
+        sudo_or_run('git remote set-url %s %s' % (remote, url))
+
+
+def _update_git_mirror():
+    """Fetch the new objects from the repository into the mirror on the
+    server, cloning it first if need be.  The mirror is never pruned, as the
+    checkouts in previous/ may still use objects from deleted branches."""
+    if files.exists(env.git_mirror_dir):
+        with cd(env.git_mirror_dir):
+            _set_git_remote_url('origin', env.repository)
+            sudo_or_run('git fetch origin')
+    else:
+        _create_dir_if_not_exists(path.dirname(env.git_mirror_dir))
+        partial_option = ''
+        if env.git_partial_clone:
+            partial_option = ' --filter=blob:none'
+        sudo_or_run('git clone --mirror%s %s %s' % (partial_option,
+                    env.repository, env.git_mirror_dir))
+
+
+def _push_git_bundle(vcs_root_dir, revision):
+    """Bundle up the commits of our local copy of revision (a branch, tag or
+    commit) that the server doesn't have, copy the bundle over and fetch it,
+    making a new repository in vcs_root_dir if need be.  A branch is
+    fetched as origin/<branch> and a tag as the tag, so git checkout can
+    use the same name on the server."""
+    with settings(hide('running', 'warnings'), warn_only=True):
+        local_commit = local('git rev-parse --verify --quiet %s^{commit}' %
+                             revision, capture=True)
+    if local_commit.failed or not local_commit.strip():
+        utils.abort('Cannot make a git bundle - there is no branch, tag or '
+                    'commit %s here' % revision)
+    local_commit = local_commit.strip()
+    local_ref = local('git rev-parse --symbolic-full-name %s' % revision,
+                      capture=True).strip()
+    if local_ref.startswith('refs/heads/'):
+        server_ref = 'refs/remotes/origin/' + local_ref[len('refs/heads/'):]
+    elif local_ref.startswith('refs/'):
+        server_ref = local_ref
+    else:
+        # a commit - keep a ref to it so the server doesn't garbage collect it
+        server_ref = 'refs/dye/deploy'
+
+    is_checkout = files.exists(path.join(vcs_root_dir, '.git'))
+    server_head = None
+    if is_checkout:
+        with cd(vcs_root_dir):
+            with settings(hide('running', 'stdout', 'warnings'), warn_only=True):
+                has_commit = sudo_or_run('git cat-file -e %s^{commit}' %
+                                         local_commit)
+                head = sudo_or_run('git rev-parse HEAD')
+        if has_commit.succeeded:
+            # which includes the server being ahead of us - there's nothing
+            # to bundle, but the ref still has to point at the commit
+            utils.puts('The server already has %s - no bundle needed' % revision)
+            with cd(vcs_root_dir):
+                sudo_or_run('git update-ref %s %s' % (server_ref, local_commit))
+            return
+        if not head.failed:
+            server_head = head.strip()
+
+    # git bundle only records refs, so give the commit a temporary one
+    bundle_ref = 'refs/dye/bundle'
+    bundle_range = bundle_ref
+    if server_head:
+        with settings(hide('running', 'warnings'), warn_only=True):
+            known = local('git cat-file -e %s^{commit}' % server_head, capture=True)
+        # only send what the server doesn't have - if we don't know its
+        # commit we have to send the lot
+        if known.succeeded:
+            bundle_range += ' ^' + server_head
+    bundle_name = 'dye_%s_%d.bundle' % (env.project_name, os.getpid())
+    local_bundle = path.join('/tmp', bundle_name)
+    remote_bundle = path.join('/tmp', bundle_name)
+    local('git update-ref %s %s' % (bundle_ref, local_commit))
+    try:
+        local('git bundle create %s %s' % (local_bundle, bundle_range))
+    finally:
+        local('git update-ref -d %s' % bundle_ref)
+    try:
+        put(local_bundle, remote_bundle, use_sudo=env.use_sudo)
+    finally:
+        os.remove(local_bundle)
+
+    if not is_checkout:
+        sudo_or_run('git init %s' % vcs_root_dir)
+    with cd(vcs_root_dir):
+        sudo_or_run("git fetch %s '+%s:%s'" %
+                    (remote_bundle, bundle_ref, server_ref))
+    sudo_or_run('rm -f ' + remote_bundle)
+
+
+def _fetch_git(vcs_root_dir, revision=None):
+    """Fetch the new commits into an existing checkout - from a bundle sent
+    from here, from the mirror, or from the repository"""
+    with cd(vcs_root_dir):
+        _set_git_remote_url('origin', env.repository)
+    if env.git_push_bundle:
+        if revision is None:
+            revision = env.default_branch.get(env.environment, 'master')
+        _push_git_bundle(vcs_root_dir, revision)
+    elif env.git_use_mirror:
+        _update_git_mirror()
+        with cd(vcs_root_dir):
+            # share the objects in the mirror, and fetch from it, so
+            # nothing more comes over the network
+            files.append(path.join(vcs_root_dir, '.git', 'objects', 'info',
+                                   'alternates'),
+                         path.join(env.git_mirror_dir, 'objects'),
+                         use_sudo=env.use_sudo)
+            sudo_or_run("git fetch %s '+refs/heads/*:refs/remotes/origin/*' "
+                        "'+refs/tags/*:refs/tags/*'" % env.git_mirror_dir)
+    else:
+        with cd(vcs_root_dir):
+            sudo_or_run('git fetch%s origin' % _git_clone_options())
+
+
+def _clone_git(vcs_root_dir):
+    default_branch = env.default_branch.get(env.environment, 'master')
+    if env.git_push_bundle:
+        _push_git_bundle(vcs_root_dir, default_branch)
+        with cd(vcs_root_dir):
+            sudo_or_run('git checkout -b %s origin/%s' %
+                        (default_branch, default_branch))
+            _set_git_remote_url('origin', env.repository)
+    elif env.git_use_mirror:
+        _update_git_mirror()
+        # clone from the mirror, sharing its objects, then point origin at
+        # the real repository
+        with cd(env.server_project_home):
+            sudo_or_run('git clone --reference %s -b %s %s %s' %
+                    (env.git_mirror_dir, default_branch, env.git_mirror_dir,
+                     vcs_root_dir))
+        with cd(vcs_root_dir):
+            _set_git_remote_url('origin', env.repository)
+    else:
+        with cd(env.server_project_home):
+            sudo_or_run('git clone%s -b %s %s %s' % (_git_clone_options(),
+                    default_branch, env.repository, vcs_root_dir))
+
+
 def _checkout_or_update_git(vcs_root_dir, revision=None):
     # if the .git directory exists, do an update, otherwise do
     # a clone
     if files.exists(path.join(vcs_root_dir, ".git")):
-        with cd(vcs_root_dir):
-            sudo_or_run('git remote rm origin')
-            sudo_or_run('git remote add origin %s' % env.repository)
-            # fetch now, merge later (if on branch)
-            sudo_or_run('git fetch origin')
-
         if revision is None:
             revision = env.revision
+        # fetch now, merge later (if on branch)
+        _fetch_git(vcs_root_dir, revision)
 
         with cd(vcs_root_dir):
             stash_result = sudo_or_run('git stash')
@@ -536,19 +1369,74 @@ def _checkout_or_update_git(vcs_root_dir, revision=None):
                 rev_is_branch = sudo_or_run('git branch -r | grep %s' % revision)
             # use old fabric style here to support Ubuntu 10.04
             if not rev_is_branch.failed:
-                sudo_or_run('git merge origin/%s' % revision)
+                if env.git_clone_depth:
+                    # a shallow fetch may not reach back to the commit we
+                    # are on, and then there is no history to merge with -
+                    # so just move the branch to the new commit
+                    sudo_or_run('git checkout -B %s origin/%s' %
+                                (revision, revision))
+                else:
+                    sudo_or_run('git merge origin/%s' % revision)
             # if we did a stash, now undo it
             if not stash_result.startswith("No local changes"):
                 sudo_or_run('git stash pop')
     else:
-        with cd(env.server_project_home):
-            default_branch = env.default_branch.get(env.environment, 'master')
-            sudo_or_run('git clone -b %s %s %s' %
-                    (default_branch, env.repository, vcs_root_dir))
-
-    if files.exists(path.join(vcs_root_dir, ".gitmodules")):
-        with cd(vcs_root_dir):
-            sudo_or_run('git submodule update --init')
+        _clone_git(vcs_root_dir)
+
+    _update_git_submodules(vcs_root_dir)
+
+
+# the lines of git ls-files --stage for the submodules and .gitmodules - the
+# same as dye.tasklib.uptodate._git_submodules_signature
+git_submodules_signature_cmd = \
+    "git ls-files --stage | awk '$1 == \"160000\" || $4 == \".gitmodules\"'"
+
+
+def _update_submodule_cache(vcs_root_dir):
+    """Fetch the submodule repositories into the bare repository in
+    env.submodule_cache_dir, which the submodules are cloned with
+    --reference to"""
+    cache_dir = env.submodule_cache_dir
+    if not files.exists(cache_dir):
+        sudo_or_run('git init --bare --quiet %s' % cache_dir)
+    with cd(vcs_root_dir):
+        with settings(hide('running', 'stdout'), warn_only=True):
+            urls = sudo_or_run("git config --file .gitmodules --get-regexp "
+                               "'^submodule\..*\.url$'")
+    urls = [line.split(None, 1)[1] for line in urls.splitlines() if ' ' in line]
+    with cd(cache_dir):
+        with settings(hide('running', 'stdout')):
+            remotes = sudo_or_run('git remote').split()
+        names = []
+        for url in urls:
+            name = re.sub(r'[^A-Za-z0-9]+', '_', url)
+            if name not in remotes:
+                sudo_or_run('git remote add %s %s' % (name, url))
+            names.append(name)
+        if names:
+            sudo_or_run('git fetch --quiet --multiple ' + ' '.join(names))
+
+
+def _update_git_submodules(vcs_root_dir):
+    """git submodule update --init, fetching in parallel - unless .gitmodules
+    and the submodule commits are the same as the last time the submodules
+    were updated, by this, bootstrap.py or tasks.py"""
+    if not files.exists(path.join(vcs_root_dir, ".gitmodules")):
+        return
+    with cd(vcs_root_dir):
+        with settings(hide('running', 'stdout'), warn_only=True):
+            signature = sudo_or_run(git_submodules_signature_cmd)
+            previous = sudo_or_run('cat .git/dye_submodules')
+    if not previous.failed and previous.strip() == signature.strip():
+        utils.puts('git submodules are up to date')
+        return
+    submodule_cmd = 'git -c submodule.fetchJobs=0 submodule update --init'
+    if env.get('submodule_cache_dir'):
+        _update_submodule_cache(vcs_root_dir)
+        submodule_cmd += ' --reference ' + env.submodule_cache_dir
+    with cd(vcs_root_dir):
+        sudo_or_run(submodule_cmd)
+        sudo_or_run(git_submodules_signature_cmd + ' > .git/dye_submodules')
 
 
 def _checkout_or_update_cvs(vcs_root_dir, revision=None):
@@ -576,11 +1464,24 @@ def _checkout_or_update_cvs(vcs_root_dir, revision=None):
                                                       env.cvs_project))
 
 
-def sudo_or_run(command):
-    if env.use_sudo:
-        return sudo(command)
-    else:
-        return run(command)
+def sudo_or_run(command, **kwargs):
+    result = None
+    start_time = time.time()
+    try:
+        if env.use_sudo:
+            result = sudo(command, **kwargs)
+        else:
+            result = run(command, **kwargs)
+    finally:
+        exit_code = None
+        output_bytes = None
+        if result is not None:
+            exit_code = result.return_code
+            output_bytes = len(result)
+        command_trace._record_command(command, start_time, time.time(),
+            exit_code, output_bytes, host=env.host_string,
+            trace_file=env.get('trace_file'), category='remote')
+    return result
 
 
 def create_deploy_virtualenv(in_next=False):
@@ -612,6 +1513,20 @@ def clean_db(revision=None):
     _tasks("clean_db")
 
 
+def rebuild_db():
+    """ build a new database from scratch alongside the one in use, and then
+    swap it in - the old one is kept for swap_in_prev_db """
+    if env.environment == 'production':
+        utils.abort('do not rebuild the production database!!!')
+    _tasks("rebuild_db")
+
+
+def swap_in_prev_db():
+    """ go back to the database from before the last rebuild_db or rollback
+    with restore_db - run it again to undo it """
+    _tasks("swap_in_prev_db")
+
+
 def get_remote_dump(filename='/tmp/db_dump.sql', local_filename='./db_dump.sql',
         rsync=True):
     """ do a remote database dump and copy it to the local filesystem """
@@ -657,14 +1572,239 @@ def touch_wsgi():
     sudo_or_run('touch ' + path.join(wsgi_dir, 'wsgi_handler.py'))
 
 
-def rm_pyc_files(py_dir=None):
-    """Remove all the old pyc files to prevent stale files being used"""
-    require('django_dir', provided_by=env.valid_envs)
+def _wsgi_process_group():
+    """The WSGIDaemonProcess group of this project, from the webserver conf
+    in the current version (or env.wsgi_process_group if set)"""
+    if env.get('wsgi_process_group'):
+        return env.wsgi_process_group
+    if env.webserver is None:
+        return None
+    conf_file = path.join(env.vcs_root_dir, env.webserver,
+                          env.environment + '.conf')
+    with settings(hide('running', 'stdout'), warn_only=True):
+        output = sudo_or_run("grep -h '^[[:space:]]*WSGIDaemonProcess' " + conf_file)
+    if output.failed or not output.strip():
+        return None
+    return output.splitlines()[0].split()[1]
+
+
+def _wsgi_daemon_pids(group):
+    """The process ids of the daemon processes of the group.  They can only
+    be found if WSGIDaemonProcess has display-name=%{GROUP}"""
+    with settings(hide('running', 'stdout'), warn_only=True):
+        # the [(] stops grep finding itself
+        output = sudo_or_run("ps -eo pid,args | grep '[(]wsgi:%s)'" % group)
+    if output.failed:
+        return []
+    return [line.split()[0] for line in output.splitlines() if line.strip()]
+
+
+def _uses_gunicorn():
+    return env.webserver == 'nginx'
+
+
+def _gunicorn_master_pid(pidfile=None):
+    if pidfile is None:
+        pidfile = env.gunicorn_pidfile
+    with settings(hide('running', 'stdout', 'warnings'), warn_only=True):
+        pid = sudo_or_run('cat %s' % pidfile)
+        if pid.failed or not pid.strip().isdigit():
+            return None
+        # check it is still running
+        if sudo_or_run('kill -0 %s' % pid.strip()).failed:
+            return None
+    return pid.strip()
+
+
+def _gunicorn_worker_pids():
+    master_pid = _gunicorn_master_pid()
+    if master_pid is None:
+        return []
+    with settings(hide('running', 'stdout'), warn_only=True):
+        output = sudo_or_run('pgrep -P %s' % master_pid)
+    if output.failed:
+        return []
+    return output.split()
+
+
+def _app_process_pids():
+    """The processes the app runs in - gunicorn workers or WSGI daemon
+    processes"""
+    if _uses_gunicorn():
+        return _gunicorn_worker_pids()
+    group = _wsgi_process_group()
+    if group is None:
+        return []
+    return _wsgi_daemon_pids(group)
+
+
+def _reload_wsgi_app():
+    """Get the app to load the new code - the apache WSGI daemon processes
+    reload when the handler is touched, gunicorn has to be told"""
+    if _uses_gunicorn():
+        gunicorn_reload()
+    else:
+        touch_wsgi()
+
+
+def gunicorn_start():
+    """Start gunicorn running wsgi_handler.application, sized for this
+    server in the same way as WSGIDaemonProcess"""
+    require('vcs_root_dir', 've_dir', provided_by=env.valid_envs)
+    sizing = _wsgi_sizing()
+    gunicorn_cmd = ('%s --daemon --pid %s --bind unix:%s --workers %d '
+        '--threads %d --max-requests %d --name %s' % (
+        path.join(env.ve_dir, 'bin', 'gunicorn'), env.gunicorn_pidfile,
+        env.gunicorn_socket, sizing['processes'], sizing['threads'],
+        sizing['maximum_requests'], env.project_name))
+    if env.gunicorn_user:
+        gunicorn_cmd += ' --user %s' % env.gunicorn_user
+    with cd(path.join(env.vcs_root_dir, 'wsgi')):
+        sudo_or_run(gunicorn_cmd + ' wsgi_handler:application')
+    _wait_for(lambda: _gunicorn_master_pid() is not None, 'gunicorn to start')
+
+
+def gunicorn_stop():
+    """Stop gunicorn, letting the workers finish their requests"""
+    master_pid = _gunicorn_master_pid()
+    if master_pid is not None:
+        sudo_or_run('kill -TERM %s' % master_pid)
+
+
+def gunicorn_reload():
+    """Switch gunicorn to the new code without refusing any connections.
+
+    USR2 makes the master start a new master (with new workers loading the
+    new code) that shares the listening socket.  Once that is running,
+    WINCH makes the old workers finish the requests they have and exit.
+    Then TERM stops the old master - gracefully, so it waits for any old
+    workers still busy (QUIT would be the quick shutdown, dropping them).
+    Starts gunicorn if it isn't running."""
+    old_pid = _gunicorn_master_pid()
+    if old_pid is None:
+        gunicorn_start()
+        return
+    sudo_or_run('kill -USR2 %s' % old_pid)
+
+    def new_master_started():
+        new_pid = _gunicorn_master_pid()
+        return new_pid is not None and new_pid != old_pid
+    _wait_for(new_master_started, 'the new gunicorn master to start')
+    sudo_or_run('kill -WINCH %s' % old_pid)
+    _wait_for_health_check()
+    sudo_or_run('kill -TERM %s' % old_pid)
+
+    def old_master_stopped():
+        with settings(hide('running', 'stdout', 'warnings'), warn_only=True):
+            return sudo_or_run('kill -0 %s' % old_pid).failed
+    _wait_for(old_master_stopped, 'the old gunicorn master to stop')
+
+
+def _wait_for(condition, description, timeout=None):
+    """Call condition once a second until it returns true, or abort"""
+    if timeout is None:
+        timeout = env.health_check_timeout
+    give_up_time = time.time() + float(timeout)
+    while not condition():
+        if time.time() > give_up_time:
+            utils.abort('Gave up waiting for %s after %s seconds' %
+                        (description, timeout))
+        time.sleep(1)
+
+
+def _curl_this_host(url):
+    """The curl options to fetch url from the webserver on the host it is
+    run on - with the right Host header (and certificate name), but not
+    going out through the load balancer that the name points at"""
+    parts = urlparse.urlsplit(url)
+    if parts.hostname in (None, 'localhost', '127.0.0.1'):
+        return url
+    port = parts.port or {'https': 443}.get(parts.scheme, 80)
+    return '--resolve %s:%d:127.0.0.1 %s' % (parts.hostname, port, url)
+
+
+def _health_check_ok():
+    with settings(hide('running', 'stdout', 'warnings'), warn_only=True):
+        result = sudo_or_run('curl --silent --fail --max-time 10 '
+            '--output /dev/null %s' % _curl_this_host(env.health_check_url))
+    return not result.failed
+
+
+def _wait_for_health_check():
+    """Wait until env.health_check_url answers, if it is set"""
+    if env.health_check_url:
+        _wait_for(_health_check_ok, env.health_check_url)
+        utils.puts('%s is answering' % env.health_check_url)
+
+
+def graceful_reload():
+    """Reload the WSGI app without reloading the webserver, recycling this
+    project's WSGI daemon processes one at a time so the others carry on
+    serving requests, then wait until env.health_check_url answers.
+
+    If the daemon processes can't be found (add display-name=%{GROUP} to
+    WSGIDaemonProcess) the WSGI handler is touched instead, and each
+    process reloads on its next request.
+
+    With nginx, gunicorn does a binary upgrade instead - see gunicorn_reload."""
+    require('vcs_root_dir', provided_by=env.valid_envs)
+    if _uses_gunicorn():
+        gunicorn_reload()
+        _wait_for_health_check()
+        return
+    group = _wsgi_process_group()
+    pids = []
+    if group:
+        pids = _wsgi_daemon_pids(group)
+    if not pids:
+        touch_wsgi()
+    for pid in pids:
+        # the daemon process finishes the requests it has and exits, and
+        # apache starts a new one with the new code
+        with settings(warn_only=True):
+            sudo_or_run('kill -INT %s' % pid)
+
+        def replaced():
+            new_pids = _wsgi_daemon_pids(group)
+            return pid not in new_pids and len(new_pids) >= len(pids)
+        _wait_for(replaced, 'WSGI daemon process %s to be replaced' % pid)
+    _wait_for_health_check()
+
+
+def warm_up():
+    """Fetch each of env.warm_up_urls (paths, relative to
+    env.health_check_url or http://localhost/) once the new code is running.
+
+    That only warms up the WSGI daemon processes that happen to answer.  To
+    have every process load the URLconf, views and templates before it
+    takes its first request, set wsgi_warm_up = True in project_settings.py
+    so that wsgi_handler.py does it as each process starts."""
+    if not env.warm_up_urls:
+        return
+    require('vcs_root_dir', provided_by=env.valid_envs)
+    base_url = env.health_check_url or 'http://localhost/'
+    for url in env.warm_up_urls:
+        with settings(hide('running', 'stdout'), warn_only=True):
+            sudo_or_run('curl --silent --output /dev/null --max-time %s %s' % (
+                env.health_check_timeout,
+                _curl_this_host(urlparse.urljoin(base_url, url))))
+
+
+def rm_pyc_files(py_dir=None, ve_dir=None):
+    """Remove the pyc files whose .py file has gone, to prevent stale files
+    being used.  (python recompiles the others if they are out of date.)"""
+    require('django_dir', 've_dir', provided_by=env.valid_envs)
     if py_dir is None:
         py_dir = env.django_dir
+    if ve_dir is None:
+        ve_dir = env.ve_dir
+    # one walk of the tree (not going into .git or the virtualenv), and one
+    # shell for each batch of files found
     with settings(warn_only=True):
-        with cd(py_dir):
-            sudo_or_run('find . -name \*.pyc | xargs rm')
+        sudo_or_run("find %s -path %s -prune -o -name .git -prune -o "
+            "\\( -name '*.pyc' -o -name '*.pyo' \\) -exec sh -c "
+            "'for f; do [ -e \"${f%%?}\" ] || rm -f \"$f\"; done' sh {} +" %
+            (py_dir, ve_dir))
 
 
 def _delete_file(path):
@@ -696,6 +1836,7 @@ def link_webserver_conf(maintenance=False):
         if not files.exists(vcs_config_live):
             utils.abort('No %s conf file found - expected %s' %
                     (env.webserver, vcs_config_live))
+        vcs_config_live = _render_webserver_conf(env.vcs_root_dir)
         _delete_file(webserver_conf)
         _link_files(vcs_config_live, webserver_conf)
 
@@ -706,10 +1847,118 @@ def link_webserver_conf(maintenance=False):
     webserver_configtest()
 
 
+# placeholders in the webserver conf, and the sizing values they are
+# replaced with
+wsgi_conf_placeholders = [
+    ('@WSGI_PROCESSES@', 'processes'),
+    ('@WSGI_THREADS@', 'threads'),
+    ('@WSGI_MAXIMUM_REQUESTS@', 'maximum_requests'),
+]
+
+
+def _wsgi_daemon_sizing(cpus, memory_mb, worker_rss_mb, memory_fraction=0.5,
+                        threads_per_cpu=10):
+    """Choose the WSGIDaemonProcess processes, threads and maximum-requests
+    for a host.
+
+    We want a process per CPU, as long as they fit in our share of the
+    memory (allowing them to grow by half between recycles).  The threads
+    make up the rest of threads_per_cpu requests per CPU, and the less
+    spare memory there is, the sooner processes are recycled."""
+    budget_mb = memory_mb * memory_fraction
+    by_memory = int(budget_mb // (worker_rss_mb * 1.5))
+    processes = max(1, min(cpus, by_memory))
+    threads = int(round(cpus * threads_per_cpu / float(processes)))
+    threads = max(5, min(25, threads))
+    headroom = budget_mb / (processes * worker_rss_mb)
+    if headroom < 2:
+        maximum_requests = 200
+    elif headroom < 4:
+        maximum_requests = 500
+    else:
+        maximum_requests = 1000
+    return {
+        'processes': processes,
+        'threads': threads,
+        'maximum_requests': maximum_requests,
+    }
+
+
+def _host_facts():
+    """The CPU count and memory of the server, and the largest resident
+    size of our running WSGI daemon processes"""
+    with settings(hide('running', 'stdout'), warn_only=True):
+        cpus = sudo_or_run('grep -c ^processor /proc/cpuinfo')
+        memory_kb = sudo_or_run("awk '/^MemTotal:/ {print $2}' /proc/meminfo")
+    facts = {'cpus': 1, 'memory_mb': 1024, 'worker_rss_mb': env.wsgi_worker_rss_mb,
+             'worker_rss_measured': False}
+    if not cpus.failed and cpus.strip().isdigit():
+        facts['cpus'] = int(cpus)
+    if not memory_kb.failed and memory_kb.strip().isdigit():
+        facts['memory_mb'] = int(memory_kb) // 1024
+    pids = _app_process_pids()
+    if pids:
+        with settings(hide('running', 'stdout'), warn_only=True):
+            rss_kb = sudo_or_run('ps -o rss= -p ' + ','.join(pids))
+        rss_kb = [int(rss) for rss in rss_kb.split() if rss.isdigit()]
+        if rss_kb:
+            facts['worker_rss_mb'] = max(rss_kb) // 1024
+            facts['worker_rss_measured'] = True
+    return facts
+
+
+def _wsgi_sizing():
+    """Work out the WSGIDaemonProcess sizing for this host (once per host).
+    wsgi_processes, wsgi_threads and wsgi_maximum_requests in
+    project_settings override the values chosen."""
+    if not env.get('wsgi_sizing') or env.get('wsgi_sizing_host') != env.host_string:
+        facts = _host_facts()
+        sizing = _wsgi_daemon_sizing(facts['cpus'], facts['memory_mb'],
+            facts['worker_rss_mb'], memory_fraction=env.wsgi_memory_fraction)
+        for key in sizing:
+            if env.get('wsgi_' + key):
+                sizing[key] = int(env['wsgi_' + key])
+        sizing.update(facts)
+        env.wsgi_sizing = sizing
+        env.wsgi_sizing_host = env.host_string
+        utils.puts('WSGI daemon sizing for %s: processes=%d threads=%d '
+            'maximum-requests=%d (%d CPUs, %dMB memory, %dMB per process)' % (
+            env.host_string, sizing['processes'], sizing['threads'],
+            sizing['maximum_requests'], sizing['cpus'], sizing['memory_mb'],
+            sizing['worker_rss_mb']))
+    return env.wsgi_sizing
+
+
+def _render_webserver_conf(vcs_root_dir):
+    """If the webserver conf for this environment has @WSGI_...@
+    placeholders, fill them in with the sizing for this host and write the
+    result to <environment>.rendered.conf beside it - so it only changes when
+    the conf or the sizing chosen does.  Returns the conf file to link to."""
+    conf_stub = path.join(vcs_root_dir, env.webserver, env.environment)
+    conf_file = conf_stub + '.conf'
+    with settings(hide('running', 'stdout'), warn_only=True):
+        has_placeholders = not sudo_or_run("grep -q '@WSGI_' %s" % conf_file).failed
+    if not has_placeholders:
+        return conf_file
+    sizing = _wsgi_sizing()
+    rendered_file = conf_stub + '.rendered.conf'
+    # the measured host facts go in the deploy history, not in here - they
+    # change every deploy, and _webserver_conf_changed compares this file
+    header = '# generated from %s for %s' % (path.basename(conf_file),
+                                             env.host_string)
+    sed_args = ' '.join(["-e 's/%s/%s/g'" % (placeholder, sizing[key])
+                         for placeholder, key in wsgi_conf_placeholders])
+    sudo_or_run("(echo '%s'; sed %s %s) > %s" % (header, sed_args, conf_file,
+                                                 rendered_file))
+    return rendered_file
+
+
 def _webserver_conf_path():
     webserver_conf_dir = {
         'apache_redhat': '/etc/httpd/conf.d',
         'apache_debian': '/etc/apache2/sites-available',
+        'nginx_redhat': '/etc/nginx/conf.d',
+        'nginx_debian': '/etc/nginx/sites-available',
     }
     key = env.webserver + '_' + _linux_type()
     if key in webserver_conf_dir:
@@ -720,16 +1969,20 @@ def _webserver_conf_path():
                 (env.webserver, _linux_type()))
 
 
+_webserver_configtests = {
+    'apache_redhat': '/usr/sbin/httpd -S',
+    'apache_debian': '/usr/sbin/apache2ctl -S',
+    'nginx_redhat': '/usr/sbin/nginx -t',
+    'nginx_debian': '/usr/sbin/nginx -t',
+}
+
+
 def webserver_configtest():
     """ test webserver configuration """
-    tests = {
-        'apache_redhat': '/usr/sbin/httpd -S',
-        'apache_debian': '/usr/sbin/apache2ctl -S',
-    }
     if env.webserver:
         key = env.webserver + '_' + _linux_type()
-        if key in tests:
-            sudo(tests[key])
+        if key in _webserver_configtests:
+            sudo(_webserver_configtests[key])
         else:
             utils.abort('webserver %s is not supported (linux type %s)' %
                     (env.webserver, _linux_type()))
@@ -750,6 +2003,8 @@ def webserver_cmd(cmd):
     cmd_strings = {
         'apache_redhat': '/etc/init.d/httpd',
         'apache_debian': '/etc/init.d/apache2',
+        'nginx_redhat': '/etc/init.d/nginx',
+        'nginx_debian': '/etc/init.d/nginx',
     }
     if env.webserver:
         key = env.webserver + '_' + _linux_type()
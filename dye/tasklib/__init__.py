@@ -1,7 +1,14 @@
 # import all functions that don't start with _
+#
+# These are not imported lazily: tasks.py finds tasks by name among the
+# public functions here (and localtasks replaces them here), and .tasklib
+# imports .django, .database and .uptodate itself, so every run of tasks.py
+# needs all four.  The slow third party and stdlib modules (MySQLdb,
+# multiprocessing, inspect) are what is imported lazily, where they are used.
 from .database import *
 from .django import *
 from .tasklib import *
+from .uptodate import *
 
 # the global dictionary
 from .environment import env
@@ -1,11 +1,15 @@
 import os
 from os import path
-import MySQLdb
+import re
+import shutil
+import tempfile
 
 from .exceptions import InvalidArgumentError, InvalidProjectError
 from .util import (_check_call_wrapper, _capture_command,
                    _call_command, _create_dir_if_not_exists, CalledProcessError,
                    _ask_for_password, _get_file_contents)
+from dye.command_trace import _span
+from . import parallel
 
 # this is a global dictionary
 from .environment import env
@@ -82,12 +86,19 @@ def _get_mysql_root_password():
     return db_details['root_password']
 
 
+def _import_mysqldb():
+    """MySQLdb is slow to import, and only needed by MySQL projects, so only
+    import it when we first talk to MySQL"""
+    import MySQLdb
+    return MySQLdb
+
+
 def _create_db_connection(**kwargs):
     if db_details['host']:
         kwargs.set_default('host', db_details['host'])
     if db_details['port']:
         kwargs.set_default('port', db_details['port'])
-    return MySQLdb.connect(**kwargs)
+    return _import_mysqldb().connect(**kwargs)
 
 
 def _get_user_db_cursor(**cursor_kwargs):
@@ -125,6 +136,13 @@ def _close_root_db_connection():
         root_db_conn = None
 
 
+def _execute(cursor, sql):
+    """cursor.execute(sql), recording the time taken for the trace.
+    Quoted values are left out of the trace, as they may be passwords."""
+    with _span(re.sub(r"'[^']*'", "'?'", sql), 'sql'):
+        return cursor.execute(sql)
+
+
 def _create_mysql_args(db_name=None):
     user = db_details['user']
     password = db_details['password']
@@ -162,7 +180,7 @@ def _mysql_exec_as_root(*mysql_cmd_list):
     cursor = _get_root_db_cursor()
     try:
         for cmd in mysql_cmd_list:
-            cursor.execute(cmd)
+            _execute(cursor, cmd)
     finally:
         cursor.close()
 
@@ -173,7 +191,7 @@ def _test_mysql_user_exists(user=None):
         user = db_details['user']
     cursor = _get_root_db_cursor()
     try:
-        rows = cursor.execute("SELECT 1 FROM mysql.user WHERE user = '%s'" % user)
+        rows = _execute(cursor, "SELECT 1 FROM mysql.user WHERE user = '%s'" % user)
     finally:
         cursor.close()
     return rows != 0
@@ -189,6 +207,7 @@ def _test_mysql_user_password_works(user=None, password=None):
         'user': user,
         'passwd': password,
     }
+    MySQLdb = _import_mysqldb()
     try:
         db_conn = _create_db_connection(**kwargs)
     except MySQLdb.OperationalError as e:
@@ -208,7 +227,7 @@ def _test_mysql_root_password(password):
 def _db_exists(db_name):
     cursor = _get_root_db_cursor()
     try:
-        cursor.execute("SHOW DATABASES")
+        _execute(cursor, "SHOW DATABASES")
         db_list = [row[0] for row in cursor.fetchall()]
     finally:
         cursor.close()
@@ -218,7 +237,7 @@ def _db_exists(db_name):
 def _db_table_exists(table_name):
     cursor = _get_user_db_cursor()
     try:
-        rows = cursor.execute("SHOW TABLES LIKE '%s'" % table_name)
+        rows = _execute(cursor, "SHOW TABLES LIKE '%s'" % table_name)
     finally:
         cursor.close()
     return rows != 0
@@ -290,8 +309,9 @@ def drop_db(db_name=None):
     _mysql_exec_as_root('DROP DATABASE IF EXISTS %s' % db_name)
 
 
-def dump_db(dump_filename='db_dump.sql', for_rsync=False):
+def dump_db(dump_filename='db_dump.sql', for_rsync=False, database='default'):
     """Dump the database in the current working directory"""
+    _set_django_db_settings(database)
     if not db_details['engine'].endswith('mysql'):
         raise InvalidArgumentError('dump_db only knows how to dump mysql so far')
     dump_cmd = ['mysqldump'] + _create_mysql_args()
@@ -324,6 +344,253 @@ def restore_db(dump_filename):
     dump_file.close()
 
 
+# the comment mysqldump puts before each table
+_dump_table_re = re.compile(r'^-- Table structure for table `([^`]+)`')
+
+
+# an AUTO_INCREMENT column definition, and the first column of a key
+_auto_increment_re = re.compile(r'`([^`]+)` .*\bAUTO_INCREMENT\b')
+_key_first_column_re = re.compile(
+    r'(PRIMARY |UNIQUE |FULLTEXT |SPATIAL )?KEY (`[^`]*` )?\(`([^`]+)`')
+
+
+def _defer_keys(create_lines):
+    """Take the indexes (apart from the primary key) and the foreign keys out
+    of the lines of a CREATE TABLE statement, so they can be added once the
+    rows are loaded.  Returns the new lines, the indexes and the foreign
+    keys.
+
+    An AUTO_INCREMENT column has to be at the start of a key, so if the
+    primary key doesn't start with it, the first key that does is kept."""
+    columns = []
+    keys = []
+    constraints = []
+    # AUTO_INCREMENT columns that don't have a key yet
+    needs_key = set()
+    for line in create_lines[1:-1]:
+        definition = line.strip().rstrip(',')
+        key_match = _key_first_column_re.match(definition)
+        key_column = key_match and key_match.group(3)
+        if definition.startswith('CONSTRAINT '):
+            constraints.append(definition)
+        elif (key_match and not definition.startswith('PRIMARY ') and
+                key_column not in needs_key):
+            keys.append(definition)
+        else:
+            columns.append('  ' + definition)
+            match = _auto_increment_re.match(definition)
+            if match:
+                needs_key.add(match.group(1))
+            needs_key.discard(key_column)
+    lines = [create_lines[0]]
+    lines += [column + ',\n' for column in columns[:-1]]
+    lines += [columns[-1] + '\n', create_lines[-1]]
+    return lines, keys, constraints
+
+
+def _add_keys_sql(table, keys):
+    return 'ALTER TABLE `%s` %s;\n' % (table, ', '.join(['ADD ' + k for k in keys]))
+
+
+def _split_mysqldump(dump_file, out_dir):
+    """Split the output of mysqldump into a file of SQL for each table, in
+    out_dir.  Each file starts with the SET statements from the top of the
+    dump, turns off the unique and foreign key checks, and adds the indexes
+    after the rows are loaded.
+
+    Returns a list of (table, sql_file), and the SQL to add the foreign keys
+    once all the tables are loaded."""
+    header = []
+    tables = []
+    foreign_keys = []
+    out = None
+    table = None
+    keys = []
+    create_lines = None
+    for line in dump_file:
+        match = _dump_table_re.match(line)
+        if match:
+            if out is not None:
+                if keys:
+                    out.write(_add_keys_sql(table, keys))
+                out.close()
+            table = match.group(1)
+            keys = []
+            sql_file = path.join(out_dir, '%d.sql' % len(tables))
+            tables.append((table, sql_file))
+            out = open(sql_file, 'w')
+            out.writelines(header)
+            out.write('SET unique_checks=0;\nSET foreign_key_checks=0;\n')
+        elif out is None:
+            if line.startswith('CREATE TABLE'):
+                raise InvalidProjectError('The dump has no "-- Table structure '
+                    'for table" comments (was it made with --skip-comments or '
+                    '--compact?) so it cannot be split into tables - use '
+                    'restore_db instead')
+            header.append(line)
+            continue
+        if create_lines is not None:
+            create_lines.append(line)
+            if line.startswith(')'):
+                create_lines, keys, constraints = _defer_keys(create_lines)
+                out.writelines(create_lines)
+                create_lines = None
+                if constraints:
+                    foreign_keys.append(_add_keys_sql(table, constraints))
+        elif line.startswith('CREATE TABLE'):
+            create_lines = [line]
+        else:
+            out.write(line)
+    if out is not None:
+        if keys:
+            out.write(_add_keys_sql(table, keys))
+        out.close()
+    return tables, ''.join(foreign_keys)
+
+
+def _db_tables(db_name):
+    cursor = _get_root_db_cursor()
+    try:
+        _execute(cursor, "SHOW FULL TABLES FROM `%s` WHERE Table_type = 'BASE TABLE'"
+                 % db_name)
+        return [row[0] for row in cursor.fetchall()]
+    finally:
+        cursor.close()
+
+
+def _next_db_name():
+    return db_details['name'] + '_next'
+
+
+def _prev_db_name():
+    return db_details['name'] + '_prev'
+
+
+def _set_django_db_settings(database):
+    # django.py imports this module, so it has to be imported here
+    from .django import set_django_db_settings
+    set_django_db_settings(database=database)
+
+
+def _recreate_db(db_name):
+    """Make an empty database that the normal user can use"""
+    drop_db(db_name)
+    create_db_if_not_exists(db_name)
+    grant_all_privileges_for_database(db_name)
+
+
+def restore_db_to_next(dump_filename='db_dump.sql', jobs=None,
+                       database='default'):
+    """Restore a database dump file into <name>_next, leaving the database
+    in use alone.  The tables are loaded in parallel (jobs at a time - by
+    default the -j given to tasks.py, or one per CPU), with the indexes
+    added after the rows and the unique and foreign key checks off.  Use
+    swap_in_next_db to start using it."""
+    _set_django_db_settings(database)
+    if not db_details['engine'].endswith('mysql'):
+        raise InvalidProjectError('restore_db_to_next only knows how to restore mysql so far')
+    if jobs is None:
+        jobs = env.get('jobs')
+    if jobs is None:
+        # multiprocessing is slow to import, so keep it out of tasks.py startup
+        import multiprocessing
+        jobs = multiprocessing.cpu_count()
+    next_db = _next_db_name()
+    _recreate_db(next_db)
+    split_dir = tempfile.mkdtemp()
+    try:
+        dump_file = open(dump_filename)
+        try:
+            tables, foreign_keys = _split_mysqldump(dump_file, split_dir)
+        finally:
+            dump_file.close()
+
+        def load_table(sql_file):
+            def load():
+                f = open(sql_file)
+                try:
+                    _check_call_wrapper(['mysql'] + _create_mysql_args(next_db),
+                                        stdin=f)
+                finally:
+                    f.close()
+            return load
+
+        steps = [(table, load_table(sql_file), ()) for table, sql_file in tables]
+        if foreign_keys:
+            steps.append(('foreign_keys',
+                lambda: _mysql_exec('SET foreign_key_checks=0;\n' + foreign_keys,
+                                    next_db),
+                [table for table, sql_file in tables]))
+        if env['verbose']:
+            print 'Restoring %d tables from %s into %s, %d at a time' % (
+                len(tables), dump_filename, next_db, int(jobs))
+        parallel._run_steps(steps, int(jobs))
+    finally:
+        shutil.rmtree(split_dir)
+    # make sure swap_in_next_db won't swap in a partial database
+    missing = set([table for table, sql_file in tables]) - set(_db_tables(next_db))
+    if not tables or missing:
+        raise InvalidProjectError('%s is missing tables from %s: %s' % (
+            next_db, dump_filename, ', '.join(sorted(missing)) or 'all of them'))
+
+
+def swap_in_next_db(database='default'):
+    """Move the tables of <name>_next into the database in use, and the
+    tables that were there into <name>_prev, in one RENAME TABLE - so
+    anything using the database sees either all the old tables or all the
+    new ones."""
+    _set_django_db_settings(database)
+    db_name = db_details['name']
+    next_db = _next_db_name()
+    prev_db = _prev_db_name()
+    if not _db_exists(next_db):
+        raise InvalidProjectError('there is no %s to swap in' % next_db)
+    current_tables = _db_tables(db_name)
+    next_tables = _db_tables(next_db)
+    if current_tables and not next_tables:
+        raise InvalidProjectError('%s has no tables - not swapping it in' % next_db)
+    _recreate_db(prev_db)
+    renames = ['`%s`.`%s` TO `%s`.`%s`' % (db_name, table, prev_db, table)
+               for table in current_tables]
+    renames += ['`%s`.`%s` TO `%s`.`%s`' % (next_db, table, db_name, table)
+                for table in next_tables]
+    if renames:
+        _mysql_exec_as_root('RENAME TABLE ' + ', '.join(renames))
+    drop_db(next_db)
+
+
+def swap_in_prev_db(database='default'):
+    """Go back to the database from before the last swap_in_next_db, by
+    exchanging the tables of the database in use and <name>_prev in one
+    RENAME TABLE.  Do it again to undo it."""
+    _set_django_db_settings(database)
+    db_name = db_details['name']
+    next_db = _next_db_name()
+    prev_db = _prev_db_name()
+    if not _db_exists(prev_db):
+        raise InvalidProjectError('there is no %s to swap in' % prev_db)
+    # <name>_next is somewhere to put the tables on the way
+    _recreate_db(next_db)
+    current_tables = _db_tables(db_name)
+    renames = ['`%s`.`%s` TO `%s`.`%s`' % (db_name, table, next_db, table)
+               for table in current_tables]
+    renames += ['`%s`.`%s` TO `%s`.`%s`' % (prev_db, table, db_name, table)
+                for table in _db_tables(prev_db)]
+    renames += ['`%s`.`%s` TO `%s`.`%s`' % (next_db, table, prev_db, table)
+                for table in current_tables]
+    if renames:
+        _mysql_exec_as_root('RENAME TABLE ' + ', '.join(renames))
+    drop_db(next_db)
+
+
+def restore_db_in_parallel(dump_filename='db_dump.sql', jobs=None,
+                           database='default'):
+    """Restore a database dump file with restore_db_to_next, and then swap
+    it in with swap_in_next_db"""
+    restore_db_to_next(dump_filename, jobs, database)
+    swap_in_next_db(database)
+
+
 def _create_mysqldump_cron_file(cron_file, dump_file_stub):
     # write something like:
     # #!/bin/sh
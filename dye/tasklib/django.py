@@ -1,13 +1,26 @@
 import os
 from os import path
 import sys
+import fnmatch
+import hashlib
+import imp
+import json
 import random
+import re
+import shutil
 import subprocess
+import time
+import zlib
 
 from .database import (ensure_user_and_db_exist, create_db_if_not_exists,
-    grant_all_privileges_for_database, _db_table_exists, drop_db)
+    grant_all_privileges_for_database, _db_table_exists, drop_db,
+    _get_user_db_cursor, _close_user_db_connection, _execute, _import_mysqldb,
+    _db_tables, _next_db_name, swap_in_next_db)
 from .exceptions import InvalidProjectError, ShellCommandError
 from .util import _check_call_wrapper
+from dye.command_trace import _record_command
+from .uptodate import _forget_task
+from . import parallel
 # global dictionary for state
 from .environment import env
 
@@ -34,11 +47,14 @@ def _manage_py(args, cwd=None):
     if env['verbose']:
         print 'Executing manage command: %s' % ' '.join(manage_cmd)
     output_lines = []
+    start_time = time.time()
     try:
         # TODO: make compatible with python 2.3
         popen = subprocess.Popen(manage_cmd, cwd=cwd, stdout=subprocess.PIPE,
                                 stderr=subprocess.STDOUT)
     except OSError, e:
+        _record_command(manage_cmd, start_time, time.time(), None,
+                        trace_file=env.get('trace_file'), category='manage_py')
         print "Failed to execute command: %s: %s" % (manage_cmd, e)
         raise e
     for line in iter(popen.stdout.readline, ""):
@@ -46,6 +62,9 @@ def _manage_py(args, cwd=None):
             print line,
         output_lines.append(line)
     returncode = popen.wait()
+    _record_command(manage_cmd, start_time, time.time(), returncode,
+                    sum([len(line) for line in output_lines]),
+                    trace_file=env.get('trace_file'), category='manage_py')
     if returncode != 0:
         error_msg = "Failed to execute command: %s: returned %s\n%s" % \
             (manage_cmd, returncode, "\n".join(output_lines))
@@ -113,12 +132,19 @@ def clean_db(database='default'):
         # DROP DATABASE
         drop_db(db_details['name'])
         drop_db('test_' + db_details['name'])
+    # the database will need to be rebuilt, whatever deploy thinks
+    _forget_task('update_db')
 
 
-def _get_cache_table():
+def _import_settings():
     # import settings from the django dir
     sys.path.append(env['django_settings_dir'])
     import settings
+    return settings
+
+
+def _get_cache_table():
+    settings = _import_settings()
     if not hasattr(settings, 'CACHES'):
         return None
     if not settings.CACHES['default']['BACKEND'].endswith('DatabaseCache'):
@@ -126,6 +152,7 @@ def _get_cache_table():
     return settings.CACHES['default']['LOCATION']
 
 
+@parallel.depends_on('link_local_settings', 'update_git_submodules')
 def update_db(syncdb=True, drop_test_db=True, force_use_migrations=False, database='default'):
     """ create the database, and do syncdb and migrations
     Note that if syncdb is true, then migrations will always be done if one of
@@ -170,12 +197,160 @@ def update_db(syncdb=True, drop_test_db=True, force_use_migrations=False, databa
             _manage_py(['migrate', '--noinput'])
 
 
+# the files South treats as migrations
+_migration_file_re = re.compile(r'^(?!__init__)\w+\.py$')
+
+
+def _migrations_on_disk():
+    """The (app label, migration name) of every South migration of the
+    django_apps"""
+    migrations = set()
+    for app in env['django_apps']:
+        migrations_dir = path.join(env['django_dir'], app, 'migrations')
+        if not path.isdir(migrations_dir):
+            continue
+        app_label = app.rstrip('/').split('/')[-1].split('.')[-1]
+        for filename in os.listdir(migrations_dir):
+            if _migration_file_re.match(filename):
+                migrations.add((app_label, filename[:-len('.py')]))
+    return migrations
+
+
+def _applied_migrations():
+    """The (app label, migration name) of every migration South has applied,
+    from a single query.  None if we can't ask the database."""
+    from .database import db_details
+    if not db_details['engine'].endswith('mysql'):
+        return None
+    MySQLdb = _import_mysqldb()
+    try:
+        cursor = _get_user_db_cursor()
+    except MySQLdb.Error:
+        # no database yet, or we can't get in
+        return None
+    try:
+        try:
+            _execute(cursor, "SELECT app_name, migration FROM south_migrationhistory")
+        except MySQLdb.ProgrammingError, e:
+            if e.args[0] == 1146:  # table doesn't exist - nothing applied
+                return set()
+            raise
+        return set([(app_name, migration) for app_name, migration in cursor.fetchall()])
+    finally:
+        cursor.close()
+
+
+def _pending_migrations(database='default'):
+    """The sorted (app label, migration name) of the migrations on disk that
+    have not been applied to the database, or None if we can't tell"""
+    set_django_db_settings(database=database)
+    applied = _applied_migrations()
+    if applied is None:
+        return None
+    return sorted(_migrations_on_disk() - applied)
+
+
+# a settings module for manage.py that uses the <name>_next database
+_next_db_settings_module = 'dye_next_db_settings'
+_next_db_settings_template = """# written by dye tasks.py to build the database alongside the one in use
+from %(settings)s import *
+try:
+    DATABASES[%(database)r]['NAME'] = %(name)r
+except NameError:
+    DATABASE_NAME = %(name)r
+"""
+
+
+def _settings_module():
+    """The name of the settings module, as imported by manage.py - the
+    settings.py in django_settings_dir, unless manage_py_settings says"""
+    if 'manage_py_settings' in env:
+        return env['manage_py_settings']
+    relative_dir = path.relpath(env['django_settings_dir'], env['django_dir'])
+    if relative_dir == os.curdir:
+        return 'settings'
+    if relative_dir.startswith(os.pardir):
+        raise InvalidProjectError('%s is not inside %s, so set '
+            'manage_py_settings to the name of the settings module' %
+            (env['django_settings_dir'], env['django_dir']))
+    return relative_dir.replace(os.sep, '.') + '.settings'
+
+
+def _write_next_db_settings(next_db, database='default'):
+    """Write the settings module (next to manage.py) that is the usual
+    settings with the database name changed to next_db.  Returns the path
+    of the file."""
+    settings_file = path.join(env['django_dir'], _next_db_settings_module + '.py')
+    f = open(settings_file, 'w')
+    try:
+        f.write(_next_db_settings_template % {
+            'settings': _settings_module(),
+            'database': database,
+            'name': next_db,
+        })
+    finally:
+        f.close()
+    return settings_file
+
+
+def _check_next_db(next_db, database='default'):
+    """Check the database update_db has just built is fit to swap in"""
+    if not _db_tables(next_db):
+        raise InvalidProjectError('%s has no tables - not swapping it in' % next_db)
+    pending = _pending_migrations(database)
+    if pending:
+        raise InvalidProjectError('%s has %d migrations still to run - not '
+            'swapping it in' % (next_db, len(pending)))
+
+
+def rebuild_db(database='default'):
+    """Build the database from scratch as <name>_next, alongside the one in
+    use, check it, and swap it in with one RENAME TABLE.  The site carries
+    on using the old database until the swap, and it is kept as <name>_prev
+    afterwards - swap_in_prev_db goes back to it.
+
+    For sqlite this is just clean_db and update_db."""
+    set_django_db_settings(database=database)
+    from .database import db_details
+    if not db_details['engine'].endswith('mysql'):
+        clean_db(database)
+        update_db(database=database)
+        return
+    db_name = db_details['name']
+    next_db = _next_db_name()
+    drop_db(next_db)
+    settings_file = _write_next_db_settings(next_db, database)
+    old_settings = env.get('manage_py_settings')
+    env['manage_py_settings'] = _next_db_settings_module
+    # point everything at the next database while it is built
+    db_details['name'] = next_db
+    _close_user_db_connection()
+    try:
+        update_db(database=database)
+        _check_next_db(next_db, database)
+    finally:
+        db_details['name'] = db_name
+        _close_user_db_connection()
+        if old_settings is None:
+            del env['manage_py_settings']
+        else:
+            env['manage_py_settings'] = old_settings
+        for old_file in (settings_file, settings_file + 'c'):
+            if path.exists(old_file):
+                os.remove(old_file)
+    swap_in_next_db(database)
+    drop_db('test_' + next_db)
+    # the database changed under update_db's feet, so check again next time
+    _forget_task('update_db')
+
+
 def create_test_db(drop_after_create=True, database='default'):
     set_django_db_settings(database=database)
     from .database import db_details
     create_db_if_not_exists('test_' + db_details['name'], drop_after_create=drop_after_create)
 
 
+@parallel.depends_on('create_private_settings')
 def link_local_settings(environment):
     """ link local_settings.py.environment as local_settings.py """
     if not env['quiet']:
@@ -224,6 +399,7 @@ def link_local_settings(environment):
     env['environment'] = environment
 
 
+@parallel.depends_on()
 def create_private_settings():
     """ create private settings file
     - contains generated DB password and secret key"""
@@ -247,7 +423,389 @@ def create_private_settings():
         #os.chmod(private_settings_file, 0400)
 
 
-def collect_static():
+# the finders we know how to emulate for the incremental collect_static
+static_file_system_finder = 'django.contrib.staticfiles.finders.FileSystemFinder'
+static_app_directories_finder = \
+    'django.contrib.staticfiles.finders.AppDirectoriesFinder'
+default_static_finders = (static_file_system_finder,
+                          static_app_directories_finder)
+# the same files that collectstatic ignores by default
+static_ignore_patterns = ['CVS', '.*', '*~']
+
+
+def _static_manifest_path(static_root):
+    """The manifest lives next to STATIC_ROOT, not inside it"""
+    return path.normpath(static_root) + '.manifest.json'
+
+
+def _load_static_manifest(manifest_path):
+    if not path.isfile(manifest_path):
+        return {}
+    f = open(manifest_path)
+    try:
+        try:
+            return json.load(f)
+        except ValueError:
+            # a broken manifest just means we check every file again
+            return {}
+    finally:
+        f.close()
+
+
+def _save_static_manifest(manifest_path, manifest):
+    # write to a temporary file and rename, so an interrupted run cannot
+    # leave a half written manifest behind
+    tmp_path = manifest_path + '.tmp'
+    f = open(tmp_path, 'w')
+    try:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    finally:
+        f.close()
+    os.rename(tmp_path, manifest_path)
+
+
+def _file_hash(file_path):
+    md5 = hashlib.md5()
+    f = open(file_path, 'rb')
+    try:
+        for chunk in iter(lambda: f.read(65536), ''):
+            md5.update(chunk)
+    finally:
+        f.close()
+    return md5.hexdigest()
+
+
+def _static_ignored(name):
+    for pattern in static_ignore_patterns:
+        if fnmatch.fnmatchcase(name, pattern):
+            return True
+    return False
+
+
+def _walk_static_dir(source_dir, prefix, sources):
+    for dirpath, dirnames, filenames in os.walk(source_dir):
+        dirnames[:] = [d for d in dirnames if not _static_ignored(d)]
+        for filename in filenames:
+            if _static_ignored(filename):
+                continue
+            source = path.join(dirpath, filename)
+            rel_path = path.relpath(source, source_dir)
+            if prefix:
+                rel_path = path.join(prefix, rel_path)
+            # the first file found wins, as it does for collectstatic
+            sources.setdefault(rel_path, source)
+
+
+def _find_app_dir(app):
+    """Find the directory of an app without importing it (importing apps
+    can require the settings to be configured)"""
+    search_path = None
+    app_dir = None
+    for part in app.split('.'):
+        try:
+            app_file, app_dir, _ = imp.find_module(part, search_path)
+        except ImportError:
+            return None
+        if app_file is not None:
+            app_file.close()
+        search_path = [app_dir]
+    return app_dir
+
+
+def _find_static_sources(settings):
+    """Work out where collectstatic would copy each file from.
+
+    Returns a dictionary of path relative to STATIC_ROOT -> source file, or
+    None if the project uses finders other than the default ones."""
+    finders = getattr(settings, 'STATICFILES_FINDERS', default_static_finders)
+    if [f for f in finders if f not in default_static_finders]:
+        return None
+    sources = {}
+    for finder in finders:
+        if finder == static_file_system_finder:
+            for static_dir in getattr(settings, 'STATICFILES_DIRS', ()):
+                prefix = ''
+                if isinstance(static_dir, (list, tuple)):
+                    prefix, static_dir = static_dir
+                static_dir = path.join(env['django_dir'], static_dir)
+                _walk_static_dir(static_dir, prefix, sources)
+        elif finder == static_app_directories_finder:
+            sys.path.append(env['django_dir'])
+            for app in settings.INSTALLED_APPS:
+                app_dir = _find_app_dir(app)
+                if app_dir is None:
+                    continue
+                app_static_dir = path.join(app_dir, 'static')
+                if path.isdir(app_static_dir):
+                    _walk_static_dir(app_static_dir, '', sources)
+    return sources
+
+
+def _replace_static_file(source, target, link=False):
+    """Copy or hardlink source to target.  We never write into an existing
+    target, as it may be a hardlink shared with another release."""
+    target_dir = path.dirname(target)
+    if not path.isdir(target_dir):
+        os.makedirs(target_dir)
+    tmp_target = target + '.dye-tmp'
+    if path.lexists(tmp_target):
+        os.remove(tmp_target)
+    if link:
+        os.link(source, tmp_target)
+    else:
+        shutil.copy2(source, tmp_target)
+    os.rename(tmp_target, target)
+
+
+def _collect_static_incremental(static_root, sources, previous_static_root=None,
+                                save_manifest=True):
+    """Bring static_root up to date with sources, using the manifest
+    to only process files that have been added, changed or removed.
+
+    If previous_static_root is given, files that are unchanged from it are
+    hardlinked rather than copied.
+
+    Returns a dictionary with the number of files skipped, copied,
+    linked and removed.  It also contains 'changed', the list of files that
+    were copied or linked, 'stale', a list of (path, old hash) for the
+    files that were changed or removed, and 'manifest', the new manifest.
+    With save_manifest=False the caller has to save the manifest - so the
+    files are only taken as done once they have been post processed."""
+    start_time = time.time()
+    manifest_path = _static_manifest_path(static_root)
+    old_manifest = _load_static_manifest(manifest_path)
+    previous_manifest = {}
+    if previous_static_root:
+        previous_manifest = _load_static_manifest(
+            _static_manifest_path(previous_static_root))
+
+    new_manifest = {}
+    counts = {'skipped': 0, 'copied': 0, 'linked': 0, 'removed': 0,
+              'changed': [], 'stale': []}
+    for rel_path, source in sources.items():
+        source_stat = os.stat(source)
+        old_entry = old_manifest.get(rel_path)
+        # only read the file if it looks different to last time
+        if (old_entry and old_entry['source'] == source and
+                old_entry['size'] == source_stat.st_size and
+                old_entry['mtime'] == source_stat.st_mtime):
+            content_hash = old_entry['hash']
+        else:
+            content_hash = _file_hash(source)
+        new_manifest[rel_path] = {
+            'source': source,
+            'hash': content_hash,
+            'size': source_stat.st_size,
+            'mtime': source_stat.st_mtime,
+        }
+
+        target = path.join(static_root, rel_path)
+        if (old_entry and old_entry['hash'] == content_hash and
+                path.isfile(target)):
+            counts['skipped'] += 1
+            continue
+        counts['changed'].append(rel_path)
+        if old_entry and old_entry['hash'] != content_hash:
+            counts['stale'].append((rel_path, old_entry['hash']))
+
+        previous_entry = previous_manifest.get(rel_path)
+        if previous_entry and previous_entry['hash'] == content_hash:
+            previous_file = path.join(previous_static_root, rel_path)
+            if path.isfile(previous_file):
+                try:
+                    _replace_static_file(previous_file, target, link=True)
+                    counts['linked'] += 1
+                    continue
+                except OSError:
+                    # probably on a different filesystem - just copy
+                    pass
+        _replace_static_file(source, target)
+        counts['copied'] += 1
+
+    for rel_path in old_manifest:
+        if rel_path not in new_manifest:
+            target = path.join(static_root, rel_path)
+            if path.lexists(target):
+                os.remove(target)
+            counts['removed'] += 1
+            counts['stale'].append((rel_path, old_manifest[rel_path]['hash']))
+
+    if save_manifest:
+        _save_static_manifest(manifest_path, new_manifest)
+    counts['manifest'] = new_manifest
+    counts['seconds'] = time.time() - start_time
+    return counts
+
+
+# files worth precompressing - everything else is usually compressed already
+static_compress_extensions = ['.css', '.js', '.html', '.htm', '.txt', '.xml',
+                              '.json', '.svg', '.ico', '.eot', '.ttf', '.otf']
+# the file Django's ManifestStaticFilesStorage reads the hashed names from
+static_hashed_names_file = 'staticfiles.json'
+
+
+def _hashed_name(rel_path, content_hash):
+    """css/site.css -> css/site.0123456789ab.css"""
+    root, ext = path.splitext(rel_path)
+    return '%s.%s%s' % (root, content_hash[:12], ext)
+
+
+def _gzip_compress(data):
+    # wbits of 16 + MAX_WBITS gives us the gzip header and trailer
+    compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def _write_static_file(target, data):
+    tmp_target = target + '.dye-tmp'
+    f = open(tmp_target, 'wb')
+    try:
+        f.write(data)
+    finally:
+        f.close()
+    os.rename(tmp_target, target)
+
+
+def _remove_static_variants(file_path):
+    for suffix in ('', '.gz', '.br'):
+        if path.lexists(file_path + suffix):
+            os.remove(file_path + suffix)
+
+
+def _brotli_available():
+    try:
+        import brotli
+    except ImportError:
+        return False
+    return True
+
+
+def _post_process_static_file(args):
+    """Write the hashed name copy and the compressed siblings of one file.
+    This runs in the worker processes of _post_process_static."""
+    static_root, rel_path, content_hash, hash_names, use_brotli = args
+    source = path.join(static_root, rel_path)
+    targets = [source]
+    if hash_names:
+        hashed_target = path.join(static_root, _hashed_name(rel_path, content_hash))
+        try:
+            _replace_static_file(source, hashed_target, link=True)
+        except OSError:
+            _replace_static_file(source, hashed_target)
+        targets.append(hashed_target)
+
+    if path.splitext(rel_path)[1].lower() not in static_compress_extensions:
+        return
+    f = open(source, 'rb')
+    try:
+        data = f.read()
+    finally:
+        f.close()
+    compressed = [('.gz', _gzip_compress(data))]
+    if use_brotli:
+        import brotli
+        compressed.append(('.br', brotli.compress(data)))
+    for suffix, compressed_data in compressed:
+        for target in targets:
+            # no point in serving a "compressed" file that is bigger
+            if len(compressed_data) < len(data):
+                _write_static_file(target + suffix, compressed_data)
+            elif path.lexists(target + suffix):
+                os.remove(target + suffix)
+
+
+def _post_process_static(static_root, changed, stale, hash_names=True,
+                         use_brotli=False, processes=None, manifest=None):
+    """Write precompressed .gz (and optionally .br) siblings and content
+    hashed copies for the changed files, using a pool of processes.
+
+    Stale hashed copies of changed and removed files are deleted, and the
+    map of names to hashed names is rewritten for the whole manifest (by
+    default the one saved next to static_root)."""
+    for rel_path, old_hash in stale:
+        _remove_static_variants(
+            path.join(static_root, _hashed_name(rel_path, old_hash)))
+        if not path.lexists(path.join(static_root, rel_path)):
+            _remove_static_variants(path.join(static_root, rel_path))
+
+    if manifest is None:
+        manifest = _load_static_manifest(_static_manifest_path(static_root))
+    jobs = [(static_root, rel_path, manifest[rel_path]['hash'], hash_names,
+             use_brotli) for rel_path in changed]
+    if processes == 1 or len(jobs) < 2:
+        map(_post_process_static_file, jobs)
+    else:
+        # only import this when we need it, to keep tasks.py startup fast
+        import multiprocessing
+        pool = multiprocessing.Pool(processes)
+        try:
+            pool.map(_post_process_static_file, jobs)
+        finally:
+            pool.close()
+            pool.join()
+
+    if hash_names:
+        hashed_names = {}
+        for rel_path, entry in manifest.items():
+            hashed_names[rel_path] = _hashed_name(rel_path, entry['hash'])
+        _save_static_manifest(path.join(static_root, static_hashed_names_file),
+                              {'version': '1.0', 'paths': hashed_names})
+    return len(jobs)
+
+
+@parallel.depends_on('link_local_settings', 'update_git_submodules')
+def collect_static(incremental=True, previous_static_root=None,
+                   post_process=True, brotli=False, processes=None):
+    """Collect the static files into STATIC_ROOT.
+
+    By default this keeps a manifest of the static files and their content
+    hashes next to STATIC_ROOT, and only copies or removes the files that
+    have changed since the last run.  If previous_static_root is set (say
+    the STATIC_ROOT of the previous release) then unchanged files are
+    hardlinked from there instead of being copied.
+
+    The changed files are then post processed by a pool of worker processes
+    (set processes to limit it, defaults to the number of CPUs).  This
+    writes a precompressed .gz copy (and .br if brotli=true, which needs the
+    brotli package - the apache conf serves the .br copies, nginx needs the
+    ngx_brotli module) and a copy with the content hash in the name, for far
+    future caching.  The hashed names are listed in staticfiles.json in
+    STATIC_ROOT.  Set post_process=false to skip this.
+
+    Set incremental=false to run a full "manage.py collectstatic" instead,
+    which also happens if the project uses non-standard STATICFILES_FINDERS.
+    """
+    if post_process and brotli and not _brotli_available():
+        raise InvalidProjectError(
+            "collect_static: brotli=true needs the brotli package installed")
+    if incremental:
+        settings = _import_settings()
+        static_root = getattr(settings, 'STATIC_ROOT', None)
+        if static_root:
+            sources = _find_static_sources(settings)
+            if sources is not None:
+                if not env['quiet']:
+                    print "### Collecting static files into %s" % static_root
+                # if post processing fails or is interrupted, the old
+                # manifest is kept, so the next run does these files again
+                counts = _collect_static_incremental(static_root, sources,
+                    previous_static_root, save_manifest=not post_process)
+                if not env['quiet']:
+                    print ("collect_static: %(skipped)d skipped, "
+                        "%(copied)d copied, %(linked)d linked, "
+                        "%(removed)d removed in %(seconds).1f seconds" % counts)
+                if post_process:
+                    start_time = time.time()
+                    processed = _post_process_static(static_root,
+                        counts['changed'], counts['stale'],
+                        use_brotli=brotli, processes=processes,
+                        manifest=counts['manifest'])
+                    _save_static_manifest(_static_manifest_path(static_root),
+                                          counts['manifest'])
+                    if not env['quiet']:
+                        print "collect_static: post processed %d files in " \
+                            "%.1f seconds" % (processed, time.time() - start_time)
+                return counts
     return _manage_py(["collectstatic", "--noinput"])
 
 
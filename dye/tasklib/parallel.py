@@ -0,0 +1,199 @@
+"""Run tasks, and the steps inside tasks, concurrently when they don't
+depend on each other.
+
+Tasks declare what they depend on with the depends_on decorator.  The
+steps are run on a pool of threads (most of the work is done by
+subprocesses, and the tasks share the global env) and the output of each
+step is prefixed with its name.  When a step fails, only the steps that
+depend on it are cancelled - the others carry on.
+"""
+import sys
+import threading
+import Queue
+
+# this is a global dictionary
+from .environment import env
+
+
+def depends_on(*task_names):
+    """Declare the tasks that must be finished before this one can start.
+
+        @parallel.depends_on('link_local_settings')
+        def update_db():
+            ...
+
+    Tasks without a declaration are assumed to depend on everything that
+    came before them, and to be needed by everything after them."""
+    def decorator(task):
+        task.depends_on = task_names
+        return task
+    return decorator
+
+
+def _declared_dependencies(task):
+    """The names of the tasks that task depends on, or None if it hasn't
+    said."""
+    return getattr(task, 'depends_on', None)
+
+
+class _PrefixedOutput(object):
+    """Stand in for sys.stdout that adds the name of the current step to the
+    start of every line, and keeps the lines of different threads apart.
+    Threads that aren't running a step write straight through."""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+    def prefix(self):
+        return getattr(self.local, 'prefix', None)
+
+    def set_prefix(self, prefix):
+        self.local.prefix = prefix
+        self.local.partial = ''
+
+    def write(self, text):
+        prefix = self.prefix()
+        if prefix is None:
+            self.stream.write(text)
+            return
+        lines = (self.local.partial + text).split('\n')
+        self.local.partial = lines.pop()
+        if lines:
+            self.lock.acquire()
+            try:
+                for line in lines:
+                    self.stream.write('[%s] %s\n' % (prefix, line))
+            finally:
+                self.lock.release()
+
+    def flush_partial(self):
+        if getattr(self.local, 'partial', ''):
+            self.write('\n')
+        self.local.prefix = None
+
+    def flush(self):
+        self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+# sys.stdout is replaced by one _PrefixedOutput while any steps are running,
+# however many _run_steps calls (from however many threads) are going on
+_output = None
+_output_users = 0
+_output_lock = threading.Lock()
+
+
+def _start_output():
+    global _output, _output_users
+    _output_lock.acquire()
+    try:
+        if _output_users == 0:
+            _output = _PrefixedOutput(sys.stdout)
+            sys.stdout = _output
+        _output_users += 1
+        return _output
+    finally:
+        _output_lock.release()
+
+
+def _stop_output():
+    global _output, _output_users
+    _output_lock.acquire()
+    try:
+        _output_users -= 1
+        if _output_users == 0:
+            sys.stdout = _output.stream
+            _output = None
+    finally:
+        _output_lock.release()
+
+
+def _prefixing():
+    """True if this thread is running a step whose output is prefixed - then
+    subprocesses should send their output through sys.stdout rather than
+    straight to the terminal."""
+    output = _output
+    return output is not None and output.prefix() is not None
+
+
+def _run_step(name, prefix, function, output, results):
+    output.set_prefix(prefix)
+    try:
+        try:
+            function()
+            results.put((name, None))
+        except BaseException:
+            results.put((name, sys.exc_info()))
+    finally:
+        output.flush_partial()
+
+
+def _run_steps(steps, jobs=None):
+    """Run the steps, each of which is (name, function, depends) where
+    depends is the list of names of earlier steps it needs to be done first.
+
+    With jobs of 1 the steps are run in order, stopping at the first failure.
+    Otherwise up to jobs steps are run at once.  If any steps fail, the rest
+    carry on unless they depend on a failed step, and then the exception
+    from the first failure is raised."""
+    if jobs is None:
+        jobs = env.get('jobs', 1)
+    if jobs <= 1:
+        for name, function, depends in steps:
+            function()
+        return
+
+    output = _start_output()
+    # steps run from inside another step are named after both
+    parent_prefix = output.prefix()
+    results = Queue.Queue()
+    pending = list(steps)
+    done = set()
+    failures = []
+    failed = set()
+    running = 0
+    try:
+        while pending or running:
+            for step in list(pending):
+                name, function, depends = step
+                blocked_by = [d for d in depends if d in failed]
+                if blocked_by:
+                    pending.remove(step)
+                    failed.add(name)
+                    print "Cancelled %s as %s failed" % (name, ', '.join(blocked_by))
+                elif running < jobs and not [d for d in depends if d not in done]:
+                    pending.remove(step)
+                    running += 1
+                    prefix = name
+                    if parent_prefix is not None:
+                        prefix = '%s/%s' % (parent_prefix, name)
+                    thread = threading.Thread(target=_run_step, name=name,
+                        args=(name, prefix, function, output, results))
+                    thread.setDaemon(True)
+                    thread.start()
+            if not running:
+                break
+            # a timeout, as a blocking get() can't be interrupted by Ctrl-C
+            while True:
+                try:
+                    name, exc_info = results.get(timeout=1)
+                    break
+                except Queue.Empty:
+                    pass
+            running -= 1
+            if exc_info is None:
+                done.add(name)
+            else:
+                failed.add(name)
+                failures.append((name, exc_info))
+                print "%s failed: %s" % (name, getattr(exc_info[1], 'msg', exc_info[1]))
+    finally:
+        _stop_output()
+
+    if failures:
+        exc_info = failures[0][1]
+        raise exc_info[0], exc_info[1], exc_info[2]
@@ -18,15 +18,27 @@
 
 """
 
+import json
 import os
 from os import path
+import py_compile
+import re
 import sys
+import tempfile
 
 from .exceptions import TasksError
 from .django import (collect_static, create_private_settings,
         _install_django_jenkins, link_local_settings, _manage_py,
-        _manage_py_jenkins, clean_db, update_db)
-from .util import _check_call_wrapper, _call_wrapper, _rm_all_pyc
+        _manage_py_jenkins, clean_db, update_db, _pending_migrations)
+from .util import (_capture_command, _check_call_wrapper, _call_wrapper,
+        _rm_orphaned_pyc, _stale_py_files)
+from .uptodate import (_run_unless_up_to_date, _git_revision, _hash_files,
+        _is_up_to_date, _forget_task, _migrations_hash, _record_up_to_date,
+        _requirements_hash, _settings_hash, _task_inputs,
+        _git_submodules_signature, _record_submodules_updated,
+        _submodules_up_to_date)
+from . import parallel
+from dye.command_trace import _print_trace_summary, _span
 # this is a global dictionary
 from .environment import env
 
@@ -76,16 +88,66 @@ def _setup_paths(project_settings, localtasks):
     env.setdefault('python_bin', chosen_python)
 
 
+def _submodule_urls(vcs_root_dir):
+    output = _capture_command(['git', 'config', '--file',
+        path.join(vcs_root_dir, '.gitmodules'), '--get-regexp',
+        r'^submodule\..*\.url$'])
+    return [line.split(None, 1)[1] for line in output.splitlines() if ' ' in line]
+
+
+def _update_submodule_cache(cache_dir, urls):
+    """Fetch the submodule repositories into one bare repository, which the
+    submodules can then be cloned with --reference to"""
+    if not path.isdir(cache_dir):
+        _check_call_wrapper(['git', 'init', '--bare', '--quiet', cache_dir])
+    git_cmd = ['git', '--git-dir=' + cache_dir]
+    remotes = _capture_command(git_cmd + ['remote']).split()
+    names = []
+    for url in urls:
+        name = re.sub(r'[^A-Za-z0-9]+', '_', url)
+        if name not in remotes:
+            _check_call_wrapper(git_cmd + ['remote', 'add', name, url])
+        names.append(name)
+    if names:
+        _check_call_wrapper(git_cmd + ['fetch', '--quiet', '--multiple'] + names)
+
+
+@parallel.depends_on()
 def update_git_submodules():
-    """If this is a git project then check for submodules and update"""
-    git_modules_file = path.join(env['vcs_root_dir'], '.gitmodules')
-    if path.exists(git_modules_file):
+    """If this is a git project then check for submodules and update.
+
+    This is skipped if the .gitmodules file and the submodule commits are
+    the same as the last time the submodules were updated, whether by this,
+    bootstrap.py or fab.  The submodules are fetched in parallel (with -j, or
+    as many as git likes) and if submodule_cache_dir is set in
+    project_settings, they share the objects in a cache repository there."""
+    vcs_root_dir = env['vcs_root_dir']
+    git_modules_file = path.join(vcs_root_dir, '.gitmodules')
+    if not path.exists(git_modules_file):
+        return
+    signature = _git_submodules_signature(vcs_root_dir)
+    if _submodules_up_to_date(vcs_root_dir, signature):
         if not env['quiet']:
-            print "### updating git submodules"
-            git_submodule_cmd = 'git submodule update --init'
-        else:
-            git_submodule_cmd = 'git submodule --quiet update --init'
-        _check_call_wrapper(git_submodule_cmd, cwd=env['vcs_root_dir'], shell=True)
+            print "### git submodules are up to date - skipping"
+        return
+    if not env['quiet']:
+        print "### updating git submodules"
+    # 0 lets git decide how many to fetch at once
+    jobs = env.get('jobs', 1)
+    if jobs <= 1:
+        jobs = 0
+    git_submodule_cmd = ['git', '-c', 'submodule.fetchJobs=%d' % jobs,
+                         'submodule']
+    if env['quiet']:
+        git_submodule_cmd.append('--quiet')
+    git_submodule_cmd += ['update', '--init']
+    cache_dir = env.get('submodule_cache_dir')
+    if cache_dir:
+        _update_submodule_cache(cache_dir, _submodule_urls(vcs_root_dir))
+        git_submodule_cmd += ['--reference', cache_dir]
+    _check_call_wrapper(git_submodule_cmd, cwd=vcs_root_dir)
+    if signature is not None:
+        _record_submodules_updated(vcs_root_dir, signature)
 
 
 def run_tests(*extra_args):
@@ -140,7 +202,7 @@ def run_jenkins():
     """ make sure the local settings is correct and the database exists """
     env['verbose'] = True
     # don't want any stray pyc files causing trouble
-    _rm_all_pyc()
+    _rm_orphaned_pyc()
     _install_django_jenkins()
     create_private_settings()
     link_local_settings('jenkins')
@@ -157,8 +219,31 @@ def _infer_environment():
         raise TasksError('no environment set, or pre-existing')
 
 
-def deploy(environment=None):
-    """Do all the required steps in order"""
+def _step(name, task):
+    """Make a deploy step that always runs task"""
+    def step():
+        with _span(name, 'step'):
+            task()
+    return (name, step, parallel._declared_dependencies(task) or ())
+
+
+def _up_to_date_step(name, task, args=(), inputs=None, outputs=()):
+    """Make a deploy step that runs task unless it is up to date.
+
+    inputs is a function returning the inputs, so that they are worked out
+    when the step starts, after the steps it depends on are done."""
+    def step():
+        with _span(name, 'step'):
+            step_inputs = None
+            if inputs is not None:
+                step_inputs = inputs()
+            _run_unless_up_to_date(name, task, args, step_inputs, outputs)
+    depends = parallel._declared_dependencies(task) or ()
+    return (name, step, depends)
+
+
+def _set_deploy_environment(environment=None, force=False):
+    env['force_tasks'] = force
     if environment:
         env['environment'] = environment
     else:
@@ -166,18 +251,206 @@ def deploy(environment=None):
         if env['verbose']:
             print "Inferred environment as %s" % env['environment']
 
-    create_private_settings()
-    link_local_settings(env['environment'])
-    update_git_submodules()
-    update_db()
-
-    collect_static()
 
+def _syncdb_inputs():
+    """What decides the tables syncdb creates - everything except the
+    migrations, which we can ask the database about"""
+    return {'environment': env['environment'],
+            'settings': _settings_hash(),
+            'requirements': _requirements_hash()}
+
+
+def _update_db_inputs():
+    return dict(_syncdb_inputs(), migrations=_migrations_hash())
+
+
+def _prepare_steps():
+    """The deploy steps that don't touch the database, so they can be done
+    while the old version of the site is still being served"""
+    settings_dir = env['django_settings_dir']
+    return [
+        _up_to_date_step('create_private_settings', create_private_settings,
+            outputs=[path.join(settings_dir, 'private_settings.py')]),
+        _up_to_date_step('link_local_settings', link_local_settings,
+            args=(env['environment'],),
+            inputs=lambda: {'settings': _hash_files(
+                path.join(settings_dir, 'settings.py'),
+                path.join(settings_dir, 'local_settings.py.' + env['environment']))},
+            outputs=[path.join(settings_dir, 'local_settings.py')]),
+        # update_git_submodules does its own up to date check, shared with
+        # bootstrap.py and fab
+        _step('update_git_submodules', update_git_submodules),
+        _up_to_date_step('collect_static', collect_static,
+            inputs=lambda: {'revision': _git_revision(),
+                            'settings': _settings_hash(),
+                            'requirements': _requirements_hash()}),
+    ]
+
+
+def _update_db_step():
+    def step():
+        with _span('update_db', 'step'):
+            # the database has the last word - if it has been restored from
+            # an old dump, say, the state file can be wrong
+            if _pending_migrations():
+                _forget_task('update_db')
+            _run_unless_up_to_date('update_db', update_db,
+                                   inputs=_update_db_inputs())
+            # whether it ran or was up to date, the database now has the
+            # tables for these settings
+            _record_up_to_date('syncdb', _syncdb_inputs())
+    return ('update_db', step, parallel._declared_dependencies(update_db))
+
+
+def _finish_deploy():
     if hasattr(env['localtasks'], 'post_deploy'):
         env['localtasks'].post_deploy(env['environment'])
 
     print "\n*** Finished deploying %s for %s." % (
             env['project_name'], env['environment'])
+    _print_trace_summary()
+
+
+def deploy(environment=None, force=False):
+    """Do all the required steps
+
+    Steps whose inputs (the git revision, settings, requirements and
+    migrations) have not changed since they last succeeded are skipped.
+    Set force=true to do every step anyway.
+
+    When tasks.py is run with -j the steps that don't depend on each other
+    (for example updating the git submodules and the database) are run at
+    the same time."""
+    _set_deploy_environment(environment, force)
+    parallel._run_steps(_prepare_steps() + [_update_db_step()])
+    _finish_deploy()
+
+
+def deploy_prepare(environment=None, force=False):
+    """Do the steps of deploy that don't touch the database - settings,
+    submodules and static files.  fab deploy runs this in the next
+    directory, while the old version of the site is still being served."""
+    _set_deploy_environment(environment, force)
+    parallel._run_steps(_prepare_steps())
+
+
+def deploy_db(environment=None, force=False):
+    """Do the database step of deploy (update_db), unless it is up to date.
+    It is always done if the database says there are migrations to run."""
+    _set_deploy_environment(environment, force)
+    parallel._run_steps([_update_db_step()])
+
+
+def deploy_finish(environment=None):
+    """Run the post_deploy hook from localtasks and report that the deploy
+    is done"""
+    _set_deploy_environment(environment)
+    _finish_deploy()
+
+
+def _compile_file(files):
+    """Compile py_file, recording dfile as its path.  Returns the error, if
+    there is one."""
+    py_file, dfile = files
+    try:
+        py_compile.compile(py_file, dfile=dfile, doraise=True)
+    except py_compile.PyCompileError as e:
+        return e.msg
+    return None
+
+
+def compile_python(final_dir=None):
+    """Compile the .py files that don't have an up to date .pyc, one process
+    per CPU, so the app doesn't have to compile them as it starts up.  The
+    virtualenv is left alone, as pip compiles what it installs.
+
+    final_dir is where this directory will be once it is deployed - the .pyc
+    files record the path to the .py file for tracebacks."""
+    vcs_root_dir = env['vcs_root_dir']
+    py_files = _stale_py_files(vcs_root_dir, [env.get('ve_dir')])
+    if final_dir is None:
+        final_dir = vcs_root_dir
+    jobs = [(py_file, path.join(final_dir, path.relpath(py_file, vcs_root_dir)))
+            for py_file in py_files]
+    if not jobs:
+        return
+    # multiprocessing is slow to import, so keep it out of tasks.py startup
+    import multiprocessing
+    pool = multiprocessing.Pool()
+    try:
+        errors = pool.map(_compile_file, jobs)
+    finally:
+        pool.close()
+        pool.join()
+    # a syntax error is not our problem - the app will report it
+    if env['verbose']:
+        for error in errors:
+            if error:
+                print error
+        print "compiled %d python files" % len(jobs)
+
+
+def db_changes_pending(environment=None):
+    """Report whether deploy_db has anything to do, so fab deploy knows
+    whether it needs to put the site into maintenance mode.  Prints
+    "db changes pending: yes" or "db changes pending: no".
+
+    The migrations on disk are compared with the ones the database says
+    have been applied.  If we can't ask the database, we go by whether
+    update_db is up to date."""
+    _set_deploy_environment(environment)
+    pending = _pending_migrations()
+    if pending is None:
+        changes = not _is_up_to_date('update_db',
+                                     _task_inputs(inputs=_update_db_inputs()))
+    elif pending:
+        for app_label, migration in pending:
+            print "pending migration: %s %s" % (app_label, migration)
+        changes = True
+    else:
+        # syncdb is still needed if the apps or settings have changed
+        changes = not _is_up_to_date('syncdb', _syncdb_inputs())
+    if changes:
+        print "db changes pending: yes"
+    else:
+        print "db changes pending: no"
+
+
+def _slowest_imports_lines(profile, limit=20):
+    """The lines of a table of the imports that took longest, not counting
+    the imports inside them"""
+    lines = ['%8s %8s  %s' % ('self', 'total', 'module (imported by)')]
+    slowest = sorted(profile['imports'], key=lambda i: i['self'], reverse=True)
+    for record in slowest[:limit]:
+        imported_by = record['parent'] or 'wsgi_handler'
+        lines.append('%8.3f %8.3f  %s (%s)' % (
+            record['self'], record['seconds'], record['name'], imported_by))
+    return lines
+
+
+def slowest_imports(limit=20, profile_file=None):
+    """Show the imports that made the WSGI handler slow to load.  Set
+    DYE_PROFILE_IMPORTS=1 in the environment of the WSGI daemon processes
+    and reload them first - they write dye_import_profile_<project>.json in
+    the temp directory (or DYE_PROFILE_IMPORTS_FILE if set there, in which
+    case pass the same path as profile_file)."""
+    if profile_file is None:
+        profile_file = path.join(tempfile.gettempdir(),
+            'dye_import_profile_%s.json' % env['project_name'])
+    if not path.isfile(profile_file):
+        raise TasksError('No import profile found at %s - set '
+            'DYE_PROFILE_IMPORTS=1 for the WSGI daemon processes and reload '
+            'them' % profile_file)
+    f = open(profile_file)
+    try:
+        profile = json.load(f)
+    finally:
+        f.close()
+    print "wsgi_handler.py took %.2f seconds to load in process %s" % (
+        profile['total'], profile['pid'])
+    print "%d imports loaded new modules, the slowest were:" % len(profile['imports'])
+    for line in _slowest_imports_lines(profile, int(limit)):
+        print line
 
 
 def patch_south():
@@ -0,0 +1,243 @@
+"""Up to date checks, so that deploy can skip the steps where nothing they
+depend on has changed.
+
+Each step declares its inputs as a dictionary of name -> value, where the
+values are things like file hashes, the git revision and the requirements
+hash.  When the step succeeds we record a signature of its inputs in the
+task state file.  Next time round, if the signature is the same (and the
+outputs of the step still exist) the step is skipped.
+
+An input with the value None means "can't tell", and the step will always
+be run.
+"""
+import hashlib
+import json
+import os
+from os import path
+import threading
+
+from .util import _capture_command
+# this is a global dictionary
+from .environment import env
+
+# steps may be run in parallel threads, and they all share the state file
+_task_state_lock = threading.Lock()
+
+
+def _task_state_file():
+    """Keep the state inside .git if we can, so it is not seen as a local
+    change, and so it is copied along with the rest of the checkout"""
+    if 'task_state_file' in env:
+        return env['task_state_file']
+    git_dir = path.join(env['vcs_root_dir'], '.git')
+    if path.isdir(git_dir):
+        return path.join(git_dir, 'dye_task_state.json')
+    return path.join(env['vcs_root_dir'], '.dye_task_state.json')
+
+
+def _load_task_state():
+    state_file = _task_state_file()
+    if not path.isfile(state_file):
+        return {}
+    f = open(state_file)
+    try:
+        try:
+            return json.load(f)
+        except ValueError:
+            # a broken state file just means we run everything
+            return {}
+    finally:
+        f.close()
+
+
+def _save_task_state(state):
+    state_file = _task_state_file()
+    tmp_file = state_file + '.tmp'
+    f = open(tmp_file, 'w')
+    try:
+        json.dump(state, f, indent=1, sort_keys=True)
+    finally:
+        f.close()
+    os.rename(tmp_file, state_file)
+
+
+def _hash_files(*file_paths):
+    """Hash the names and contents of the files.  Missing files are
+    included as missing, so creating them changes the hash.
+
+    The names are taken relative to vcs_root_dir, so the hashes are the
+    same when the checkout is moved (as fab deploy does when it moves the
+    next directory to be the current one)."""
+    vcs_root_dir = env.get('vcs_root_dir')
+    md5 = hashlib.md5()
+    for file_path in file_paths:
+        if vcs_root_dir and file_path.startswith(vcs_root_dir + os.sep):
+            md5.update(path.relpath(file_path, vcs_root_dir))
+        else:
+            md5.update(file_path)
+        if path.isfile(file_path):
+            f = open(file_path, 'rb')
+            try:
+                md5.update(f.read())
+            finally:
+                f.close()
+        else:
+            md5.update('\0missing')
+    return md5.hexdigest()
+
+
+def _hash_dir(dir_path, extension='.py'):
+    """Hash all the files ending in extension under dir_path"""
+    file_paths = []
+    for dirpath, dirnames, filenames in os.walk(dir_path):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            if filename.endswith(extension):
+                file_paths.append(path.join(dirpath, filename))
+    return _hash_files(*file_paths)
+
+
+def _git_revision():
+    """The revision checked out in vcs_root_dir, plus a hash of any
+    uncommitted changes.  None if this is not a git checkout."""
+    git_dir = path.join(env['vcs_root_dir'], '.git')
+    if not path.isdir(git_dir):
+        return None
+    git_cmd = ['git', '--git-dir=' + git_dir,
+               '--work-tree=' + env['vcs_root_dir']]
+    revision = _capture_command(git_cmd + ['rev-parse', 'HEAD']).strip()
+    if not revision:
+        return None
+    changes = _capture_command(git_cmd + ['diff', 'HEAD'])
+    if changes:
+        revision += '+' + hashlib.md5(changes).hexdigest()
+    return revision
+
+
+def _git_submodules_signature(vcs_root_dir=None):
+    """The .gitmodules and gitlink lines of the git index - if these haven't
+    changed, the submodules don't need updating.  None if this is not a git
+    checkout.
+
+    ve_mgr.py and fablib work this out in the same way, and share the
+    record of the last successful update in .git/dye_submodules."""
+    if vcs_root_dir is None:
+        vcs_root_dir = env['vcs_root_dir']
+    git_dir = path.join(vcs_root_dir, '.git')
+    if not path.isdir(git_dir):
+        return None
+    lines = _capture_command(['git', '--git-dir=' + git_dir, 'ls-files',
+                              '--stage']).splitlines()
+    return '\n'.join([line for line in lines
+        if line.startswith('160000 ') or line.endswith('\t.gitmodules')])
+
+
+def _submodules_state_file(vcs_root_dir):
+    return path.join(vcs_root_dir, '.git', 'dye_submodules')
+
+
+def _submodules_up_to_date(vcs_root_dir, signature):
+    state_file = _submodules_state_file(vcs_root_dir)
+    if signature is None or env.get('force_tasks') or not path.isfile(state_file):
+        return False
+    f = open(state_file)
+    try:
+        return f.read().strip() == signature
+    finally:
+        f.close()
+
+
+def _record_submodules_updated(vcs_root_dir, signature):
+    f = open(_submodules_state_file(vcs_root_dir), 'w')
+    try:
+        f.write(signature + '\n')
+    finally:
+        f.close()
+
+
+def _requirements_hash():
+    if env.get('requirements_per_env'):
+        requirements_file = path.join(env['local_requirements_dir'],
+                                      '%s.txt' % env['environment'])
+    elif 'local_requirements_file' in env:
+        requirements_file = env['local_requirements_file']
+    else:
+        return None
+    return _hash_files(requirements_file)
+
+
+def _migrations_hash():
+    md5 = hashlib.md5()
+    for app in env['django_apps']:
+        md5.update(_hash_dir(path.join(env['django_dir'], app, 'migrations')))
+    return md5.hexdigest()
+
+
+def _settings_hash():
+    """settings.py, and the local and private settings it imports"""
+    settings_files = [path.join(env['django_settings_dir'], name) for name in
+        ('settings.py', 'local_settings.py', 'private_settings.py')]
+    return _hash_files(*settings_files)
+
+
+def _inputs_signature(inputs):
+    return hashlib.md5(json.dumps(inputs, sort_keys=True)).hexdigest()
+
+
+def _is_up_to_date(name, inputs, outputs=()):
+    if env.get('force_tasks'):
+        return False
+    if None in inputs.values():
+        return False
+    for output in outputs:
+        if not path.exists(output):
+            return False
+    return _load_task_state().get(name) == _inputs_signature(inputs)
+
+
+def _record_up_to_date(name, inputs):
+    _task_state_lock.acquire()
+    try:
+        state = _load_task_state()
+        state[name] = _inputs_signature(inputs)
+        _save_task_state(state)
+    finally:
+        _task_state_lock.release()
+
+
+def _forget_task(name):
+    """Make sure the task is run next time"""
+    _task_state_lock.acquire()
+    try:
+        state = _load_task_state()
+        if name in state:
+            del state[name]
+            _save_task_state(state)
+    finally:
+        _task_state_lock.release()
+
+
+def _task_inputs(args=(), inputs=None):
+    if inputs is None:
+        inputs = {}
+    # the arguments are always an input
+    return dict(inputs, args=list(args))
+
+
+def _run_unless_up_to_date(name, task, args=(), inputs=None, outputs=()):
+    """Run task(*args) unless the inputs are the same as the last time it
+    succeeded, and the outputs all exist."""
+    inputs = _task_inputs(args, inputs)
+    if _is_up_to_date(name, inputs, outputs):
+        if not env['quiet']:
+            print "### %s is up to date - skipping" % name
+        return
+    task(*args)
+    _record_up_to_date(name, inputs)
+
+
+def clean_task_state():
+    """Forget which tasks are up to date, so the next deploy does every step"""
+    state_file = _task_state_file()
+    if path.exists(state_file):
+        os.remove(state_file)
@@ -1,9 +1,13 @@
 import os
 from os import path
 from getpass import getpass
+import sys
+import time
 
 from .environment import env
 from .exceptions import InvalidPasswordError
+from . import parallel
+from dye.command_trace import _record_command
 
 # make sure WindowsError is available
 import __builtin__
@@ -64,14 +68,40 @@ except ImportError:
                 (self.cmd, self.returncode)
 
 
+def _call_command_through_stdout(argv, **kwargs):
+    """_call_command, but with the output copied to sys.stdout, so that when
+    run by a parallel step it gets the name of the step on each line.
+    Returns the exit code and the number of bytes of output."""
+    popen = subprocess.Popen(argv, stdout=subprocess.PIPE,
+                             stderr=subprocess.STDOUT, **kwargs)
+    output_bytes = 0
+    for line in iter(popen.stdout.readline, ''):
+        output_bytes += len(line)
+        sys.stdout.write(line)
+    return popen.wait(), output_bytes
+
+
 def _call_wrapper(argv, **kwargs):
+    if hasattr(argv, '__iter__'):
+        command = ' '.join(argv)
+    else:
+        command = argv
     if env['verbose']:
-        if hasattr(argv, '__iter__'):
-            command = ' '.join(argv)
-        else:
-            command = argv
         print "Executing command: %s" % command
-    return _call_command(argv, **kwargs)
+    returncode = None
+    # we only know the size of the output when it comes through us
+    output_bytes = None
+    start_time = time.time()
+    try:
+        if (parallel._prefixing() and 'stdout' not in kwargs and
+                'stderr' not in kwargs):
+            returncode, output_bytes = _call_command_through_stdout(argv, **kwargs)
+        else:
+            returncode = _call_command(argv, **kwargs)
+    finally:
+        _record_command(command, start_time, time.time(), returncode,
+                        output_bytes, trace_file=env.get('trace_file'))
+    return returncode
 
 
 def _check_call_wrapper(argv, accepted_returncode_list=[0], **kwargs):
@@ -93,10 +123,50 @@ def _create_dir_if_not_exists(dir_path, world_writeable=False, owner=None):
         _check_call_wrapper(['chown', '-R', owner, dir_path])
 
 
-def _rm_all_pyc():
-    """Remove all pyc files, to be sure"""
-    _call_wrapper('find . -name \*.pyc -print0 | xargs -0 rm', shell=True,
-                  cwd=env['vcs_root_dir'])
+def _walk_project(root_dir, skip_dirs=()):
+    """os.walk, but not going into .git or skip_dirs"""
+    skip_dirs = set([path.abspath(d) for d in skip_dirs if d])
+    for dirpath, dirnames, filenames in os.walk(root_dir):
+        dirnames[:] = [d for d in dirnames if d != '.git' and
+                       path.abspath(path.join(dirpath, d)) not in skip_dirs]
+        yield dirpath, filenames
+
+
+def _orphaned_pyc_files(root_dir, skip_dirs=()):
+    """The .pyc and .pyo files under root_dir that have no .py file next to
+    them, found in a single walk of the tree."""
+    orphans = []
+    for dirpath, filenames in _walk_project(root_dir, skip_dirs):
+        names = set(filenames)
+        for name in filenames:
+            if name.endswith(('.pyc', '.pyo')) and name[:-1] not in names:
+                orphans.append(path.join(dirpath, name))
+    return orphans
+
+
+def _rm_orphaned_pyc(root_dir=None):
+    """Remove the pyc files left behind when their .py file was removed.
+    (python recompiles any others that are out of date.)  The virtualenv
+    is left alone - pip cleans up after itself."""
+    if root_dir is None:
+        root_dir = env['vcs_root_dir']
+    for pyc_file in _orphaned_pyc_files(root_dir, [env.get('ve_dir')]):
+        os.remove(pyc_file)
+
+
+def _stale_py_files(root_dir, skip_dirs=()):
+    """The .py files under root_dir without a .pyc at least as new as them"""
+    stale = []
+    for dirpath, filenames in _walk_project(root_dir, skip_dirs):
+        names = set(filenames)
+        for name in filenames:
+            if not name.endswith('.py'):
+                continue
+            py_file = path.join(dirpath, name)
+            if name + 'c' not in names or \
+                    path.getmtime(py_file + 'c') < path.getmtime(py_file):
+                stale.append(py_file)
+    return stale
 
 
 def _ask_for_password(prompt, test_fn=None, max_attempts=3):
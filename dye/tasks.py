@@ -16,6 +16,13 @@ Options:
     -d, --deploydir DEPLOYDIR  Set the deploy dir (where to find project_settings.py
                                and, optionally, localtasks.py)  Defaults to the
                                directory that contains tasks.py
+    -j, --jobs JOBS            Run up to JOBS tasks (and steps inside tasks) at
+                               once, when they don't depend on each other.  The
+                               output of each task is prefixed with its name.
+    --trace FILE               Append a JSON line to FILE for every command run,
+                               with its timing, exit code and output size.
+    --profile FILE             Write a Chrome trace event file to FILE, showing
+                               the tasks, steps, commands and SQL statements.
     -q, --quiet                Print less output while executing (note: not none)
     -v, --verbose              Print extra output while executing
     -h, --help                 Print this help text
@@ -36,14 +43,19 @@ $ ./tasks.py deploy:environment=staging,arg2=somevalue
 
 import os
 import sys
+import types
 import docopt
-import inspect
 
 from dye import tasklib
+from dye.tasklib import parallel
+from dye.command_trace import _span, _write_chrome_trace
 from dye.tasklib.exceptions import TasksError
 
 localtasks = None
 
+# the index of task name -> function, built the first time it is needed
+_task_index = None
+
 
 def invalid_command(cmd):
     print "Tasks.py:"
@@ -56,23 +68,29 @@ def invalid_command(cmd):
 def get_public_callables(mod):
     callables = []
     if mod:
-        # getmembers returns a list of tuples of from ('name', <function>)
-        all_functions = inspect.getmembers(mod, inspect.isfunction)
-        callables = [func[0] for func in all_functions
-                if not func[0].startswith('_')]
+        # look at the module dictionary directly, rather than using inspect,
+        # which is slow to import
+        callables = [name for name, value in vars(mod).items()
+                     if isinstance(value, types.FunctionType)
+                     and not name.startswith('_')]
+        callables.sort()
     return callables
 
 
-def tasklib_list():
-    return get_public_callables(tasklib)
-
-
-def localtasks_list():
-    return get_public_callables(localtasks)
+def task_index():
+    """Return the dictionary of task name -> function.  localtasks have
+    priority over tasklib.  The index is only built once per run."""
+    global _task_index
+    if _task_index is None:
+        _task_index = {}
+        for mod in (tasklib, localtasks):
+            for name in get_public_callables(mod):
+                _task_index[name] = getattr(mod, name)
+    return _task_index
 
 
 def tasks_available():
-    tasks = list(set(tasklib_list() + localtasks_list()))
+    tasks = task_index().keys()
     tasks.sort()
     return tasks
 
@@ -95,6 +113,7 @@ def print_description(task_name, task_function):
     else:
         print "No description found for %s" % task_name
     print
+    import inspect
     argspec = inspect.getargspec(task_function)
     if len(argspec.args) == 0:
         if argspec.varargs is None:
@@ -115,12 +134,8 @@ def print_description(task_name, task_function):
 def describe_task(args):
     for arg in args:
         task = arg.split(':', 1)[0]
-        if hasattr(localtasks, task):
-            taskf = getattr(localtasks, task)
-            print_description(task, taskf)
-        elif hasattr(tasklib, task):
-            taskf = getattr(tasklib, task)
-            print_description(task, taskf)
+        if task in task_index():
+            print_description(task, task_index()[task])
         else:
             print "%s: no such task found" % task
             print
@@ -165,8 +180,62 @@ def convert_task_bits(task_bits):
     return task, pos_args, kwargs_dict
 
 
+def _all_dependencies(declared, known_tasks):
+    """The declared dependencies of a task, and theirs in turn, looked up in
+    known_tasks.  None if any of them don't declare their dependencies, as
+    then they could depend on anything."""
+    if declared is None:
+        return None
+    dependencies = set()
+    to_visit = list(declared)
+    while to_visit:
+        name = to_visit.pop()
+        if name in dependencies:
+            continue
+        dependencies.add(name)
+        if name in known_tasks:
+            task_declared = parallel._declared_dependencies(known_tasks[name])
+            if task_declared is None:
+                return None
+            to_visit.extend(task_declared)
+    return dependencies
+
+
+def task_steps(task_calls):
+    """Turn the list of (name, function, args, kwargs) into steps for
+    parallel._run_steps.  Each task depends on all the tasks before it,
+    unless both it and the earlier task declare their dependencies with
+    depends_on and it doesn't need the earlier one (directly, or through
+    the tasks it depends on) - only then can they run at the same time."""
+    known_tasks = dict(task_index())
+    for name, f, pos_args, kwargs in task_calls:
+        known_tasks[name] = f
+    steps = []
+    # the (step name, declared dependencies) of the tasks so far
+    earlier = []
+    for name, f, pos_args, kwargs in task_calls:
+        step_name = name
+        step_names = [step[0] for step in steps]
+        count = 1
+        while step_name in step_names:
+            count += 1
+            step_name = '%s#%d' % (name, count)
+        declared = _all_dependencies(parallel._declared_dependencies(f),
+                                     known_tasks)
+        depends = [earlier_name for earlier_name, earlier_declared in earlier
+                   if declared is None or earlier_declared is None or
+                   earlier_name.split('#')[0] in declared]
+        earlier.append((step_name, declared))
+
+        def call(f=f, pos_args=pos_args, kwargs=kwargs, step_name=step_name):
+            with _span(step_name, 'task'):
+                f(*pos_args, **kwargs)
+        steps.append((step_name, call, depends))
+    return steps
+
+
 def main(argv):
-    global localtasks
+    global localtasks, _task_index
 
     options = docopt.docopt(__doc__, argv, help=False)
 
@@ -183,6 +252,8 @@ def main(argv):
     # than silently fail.
     if os.path.isfile(os.path.join(tasklib.env['deploy_dir'], 'localtasks.py')):
         import localtasks
+    # localtasks may have changed, so rebuild the index when we next need it
+    _task_index = None
 
     if options['--help']:
         print_help_text()
@@ -195,6 +266,18 @@ def main(argv):
         return 2
     tasklib.env['verbose'] = options['--verbose']
     tasklib.env['quiet'] = options['--quiet']
+    if options['--jobs']:
+        if not options['--jobs'].isdigit() or int(options['--jobs']) < 1:
+            print "--jobs must be a positive number"
+            return 2
+        tasklib.env['jobs'] = int(options['--jobs'])
+    else:
+        # tasks that can do better than one at a time choose for themselves
+        tasklib.env.pop('jobs', None)
+    if options['--trace']:
+        tasklib.env['trace_file'] = os.path.abspath(options['--trace'])
+    if options['--profile']:
+        tasklib.env['profile_file'] = os.path.abspath(options['--profile'])
 
     try:
         import project_settings
@@ -209,24 +292,26 @@ def main(argv):
     # now set up the various paths required
     tasklib._setup_paths(project_settings, localtasks)
     # process arguments - just call the function with that name
+    task_calls = []
     for arg in options['<tasks>']:
         fname, pos_args, kwargs = convert_task_bits(arg)
         # work out which function to call - localtasks have priority
-        f = None
-        if fname in localtasks_list():
-            f = getattr(localtasks, fname)
-        elif fname in tasklib_list():
-            f = getattr(tasklib, fname)
-        else:
+        f = task_index().get(fname)
+        if f is None:
             invalid_command(fname)
             return 2
+        task_calls.append((fname, f, pos_args, kwargs))
 
-        # call the function
+    # call the functions
+    try:
         try:
-            f(*pos_args, **kwargs)
+            parallel._run_steps(task_steps(task_calls))
         except TasksError as e:
             print >>sys.stderr, e.msg
             return e.exit_code
+    finally:
+        if 'profile_file' in tasklib.env:
+            _write_chrome_trace(tasklib.env['profile_file'])
 
 
 if __name__ == '__main__':
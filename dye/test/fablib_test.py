@@ -0,0 +1,256 @@
+import os
+from os import path
+import sys
+import threading
+import time
+import unittest
+
+dye_dir = path.join(path.dirname(__file__), os.pardir)
+sys.path.append(dye_dir)
+import fablib
+
+
+def make_deploy(checkout, tasks_deploy, downtime=10.0):
+    return {
+        'time': '2013-01-01 12:00:00',
+        'revision': 'abc',
+        'phases': {'checkout': checkout, 'tasks_deploy': tasks_deploy},
+        'total': checkout + tasks_deploy,
+        'downtime': downtime,
+    }
+
+
+class TestDeployPhaseStats(unittest.TestCase):
+
+    def test_percentile_of_single_value_is_that_value(self):
+        self.assertEqual(3, fablib._percentile([3], 90))
+
+    def test_percentile_50_is_median(self):
+        self.assertEqual(3, fablib._percentile([5, 1, 3, 2, 4], 50))
+
+    def test_percentile_100_is_max(self):
+        self.assertEqual(5, fablib._percentile([5, 1, 3, 2, 4], 100))
+
+    def test_no_history_gives_no_stats(self):
+        self.assertEqual([], fablib._deploy_phase_stats([]))
+
+    def test_phases_are_in_deploy_order_with_total_last(self):
+        stats = fablib._deploy_phase_stats([make_deploy(1.0, 2.0)])
+        self.assertEqual(['checkout', 'tasks_deploy', 'total', 'downtime'],
+                         [s['phase'] for s in stats])
+
+    def test_slower_phase_is_flagged_as_regressed(self):
+        history = [make_deploy(10.0, 20.0) for i in range(5)]
+        history.append(make_deploy(10.0, 60.0))
+        stats = dict([(s['phase'], s) for s in fablib._deploy_phase_stats(history)])
+        self.assertTrue(stats['tasks_deploy']['regressed'])
+        self.assertFalse(stats['checkout']['regressed'])
+
+    def test_small_absolute_slowdown_is_not_flagged(self):
+        history = [make_deploy(1.0, 20.0) for i in range(5)]
+        history.append(make_deploy(3.0, 20.0))
+        stats = dict([(s['phase'], s) for s in fablib._deploy_phase_stats(history)])
+        self.assertFalse(stats['checkout']['regressed'])
+
+    def test_trend_holds_last_five_values(self):
+        history = [make_deploy(float(i), 20.0) for i in range(8)]
+        stats = dict([(s['phase'], s) for s in fablib._deploy_phase_stats(history)])
+        self.assertEqual([3.0, 4.0, 5.0, 6.0, 7.0], stats['checkout']['trend'])
+
+
+
+class TestWsgiDaemonSizing(unittest.TestCase):
+
+    def test_one_process_per_cpu_when_memory_allows(self):
+        sizing = fablib._wsgi_daemon_sizing(4, 8192, 150)
+        self.assertEqual(4, sizing['processes'])
+        self.assertEqual(10, sizing['threads'])
+
+    def test_processes_limited_by_memory(self):
+        sizing = fablib._wsgi_daemon_sizing(8, 1024, 150)
+        self.assertEqual(2, sizing['processes'])
+        # the threads make up for the missing processes, up to a limit
+        self.assertEqual(25, sizing['threads'])
+
+    def test_always_at_least_one_process(self):
+        sizing = fablib._wsgi_daemon_sizing(1, 256, 300)
+        self.assertEqual(1, sizing['processes'])
+        self.assertEqual(200, sizing['maximum_requests'])
+
+    def test_recycle_less_often_with_spare_memory(self):
+        sizing = fablib._wsgi_daemon_sizing(2, 16384, 150)
+        self.assertEqual(1000, sizing['maximum_requests'])
+
+
+
+class TestVersionsToDelete(unittest.TestCase):
+    versions = ['2014-01-01_00-00-00', '2014-01-05_00-00-00',
+                '2014-01-09_00-00-00', '2014-01-10_00-00-00']
+
+    def test_keeps_the_latest_versions(self):
+        self.assertEqual(self.versions[:2],
+                         fablib._versions_to_delete(self.versions, 2))
+
+    def test_keep_of_zero_keeps_everything(self):
+        self.assertEqual([], fablib._versions_to_delete(self.versions, 0))
+
+    def test_deletes_versions_older_than_max_age(self):
+        now = fablib.datetime(2014, 1, 10, 12, 0, 0)
+        self.assertEqual(self.versions[:2], fablib._versions_to_delete(
+            self.versions, 0, max_age_days=3, now=now))
+
+    def test_deletes_oldest_versions_over_disk_budget(self):
+        sizes_mb = dict([(version, 100) for version in self.versions])
+        self.assertEqual(self.versions[:1], fablib._versions_to_delete(
+            self.versions, 0, budget_mb=300, sizes_mb=sizes_mb))
+
+    def test_always_keeps_latest_version(self):
+        now = fablib.datetime(2015, 1, 1)
+        sizes_mb = dict([(version, 1000) for version in self.versions])
+        self.assertEqual(self.versions[:-1], fablib._versions_to_delete(
+            self.versions, 1, max_age_days=1, budget_mb=10, sizes_mb=sizes_mb,
+            now=now))
+
+
+
+class TestFanOut(unittest.TestCase):
+    hosts = ['web%d' % i for i in range(6)]
+
+    def setUp(self):
+        self.running = 0
+        self.most_running = 0
+        self.lock = threading.Lock()
+
+    def run_command(self, host, command):
+        self.lock.acquire()
+        self.running += 1
+        self.most_running = max(self.most_running, self.running)
+        self.lock.release()
+        time.sleep(0.01)
+        self.lock.acquire()
+        self.running -= 1
+        self.lock.release()
+        if host == 'web3':
+            return 1, 'failed\n'
+        return 0, '%s: %s\nmore\n' % (host, command)
+
+    def test_fan_out_runs_command_on_every_host(self):
+        results = fablib._fan_out(self.hosts, 'ls', run_command=self.run_command)
+        self.assertEqual(sorted(self.hosts), sorted(results.keys()))
+        self.assertEqual(0, results['web0'][0])
+        self.assertEqual('web0: ls\nmore\n', results['web0'][1])
+
+    def test_fan_out_respects_limit(self):
+        fablib._fan_out(self.hosts, 'ls', limit=2, run_command=self.run_command)
+        self.assertEqual(2, self.most_running)
+
+    def test_fan_out_with_limit_0_still_runs_on_every_host(self):
+        results = fablib._fan_out(self.hosts, 'ls', limit=0,
+                                  run_command=self.run_command)
+        self.assertEqual(sorted(self.hosts), sorted(results.keys()))
+
+    def test_fan_out_records_exceptions_as_failures(self):
+        def run_command(host, command):
+            if host == 'web2':
+                raise ValueError('no route to host')
+            return self.run_command(host, command)
+        results = fablib._fan_out(self.hosts, 'ls', run_command=run_command)
+        self.assertEqual((None, 'no route to host'), results['web2'][:2])
+        lines = fablib._fan_out_table(self.hosts, results)
+        self.assertEqual('6 hosts, 2 failed', lines[-1])
+
+    def test_run_ssh_uses_fabric_key_and_gateway(self):
+        commands = []
+
+        class FakePopen(object):
+            returncode = 0
+
+            def __init__(self, argv, **kwargs):
+                commands.append(argv)
+
+            def communicate(self):
+                return 'ok\n', None
+        real = (fablib.subprocess.Popen, dict(fablib.env))
+        fablib.subprocess.Popen = FakePopen
+        fablib.env.update({'key_filename': '/home/me/.ssh/deploy',
+                           'gateway': 'jump@bastion:2222', 'use_sudo': False})
+        try:
+            fablib._run_ssh('deploy@web1', 'ls')
+        finally:
+            fablib.subprocess.Popen = real[0]
+            fablib.env.clear()
+            fablib.env.update(real[1])
+        self.assertEqual(['ssh', '-o', 'BatchMode=yes', '-p', '22',
+                          '-i', '/home/me/.ssh/deploy',
+                          '-o', 'ProxyJump=jump@bastion:2222',
+                          'deploy@web1', 'ls'], commands[0])
+
+    def test_fan_out_table_has_line_per_host_and_failures(self):
+        results = fablib._fan_out(self.hosts, 'ls', run_command=self.run_command)
+        lines = fablib._fan_out_table(self.hosts, results)
+        self.assertEqual(len(self.hosts) + 2, len(lines))
+        self.assertTrue(lines[1].startswith('web0 '))
+        self.assertTrue(lines[1].endswith('web0: ls (+1 lines)'))
+        self.assertEqual('6 hosts, 1 failed', lines[-1])
+
+
+
+class TestRollingBatches(unittest.TestCase):
+    hosts = ['web1', 'web2', 'web3', 'web4', 'web5']
+
+    def test_hosts_are_split_into_batches(self):
+        self.assertEqual([['web1', 'web2'], ['web3', 'web4'], ['web5']],
+                         fablib._rolling_batches(self.hosts, 2))
+
+    def test_batch_can_leave_minimum_capacity(self):
+        self.assertEqual(2, len(fablib._rolling_batches(self.hosts, 3, 2)))
+
+    def test_batch_too_big_for_minimum_capacity_aborts(self):
+        self.assertRaises(SystemExit, fablib._rolling_batches, self.hosts, 3, 3)
+
+
+class TestRestoreHealthyHosts(unittest.TestCase):
+    def setUp(self):
+        self.restored = []
+        self.real = (fablib._health_check_ok, fablib.env.get('lb_restore_hook'),
+                     fablib.env.get('health_check_url'),
+                     fablib.env.get('environment'))
+        fablib.env.lb_restore_hook = self.restored.append
+        fablib.env.health_check_url = 'http://www.example.org/'
+        fablib.env.environment = 'production'
+
+    def tearDown(self):
+        (fablib._health_check_ok, fablib.env.lb_restore_hook,
+         fablib.env.health_check_url, fablib.env.environment) = self.real
+
+    def test_only_healthy_hosts_are_restored(self):
+        def health_check_ok():
+            if fablib.env.host_string == 'web2':
+                raise KeyError('hook failed')
+            return fablib.env.host_string == 'web1'
+        fablib._health_check_ok = health_check_ok
+        fablib._restore_healthy_hosts(['web1', 'web2', 'web3'])
+        self.assertEqual(['web1'], self.restored)
+
+
+class TestCurlThisHost(unittest.TestCase):
+    def test_localhost_is_fetched_as_is(self):
+        self.assertEqual('http://localhost/health/',
+                         fablib._curl_this_host('http://localhost/health/'))
+
+    def test_site_name_resolves_to_this_host(self):
+        self.assertEqual(
+            '--resolve www.example.org:80:127.0.0.1 http://www.example.org/',
+            fablib._curl_this_host('http://www.example.org/'))
+
+    def test_https_and_explicit_ports_are_kept(self):
+        self.assertEqual(
+            '--resolve www.example.org:443:127.0.0.1 https://www.example.org/',
+            fablib._curl_this_host('https://www.example.org/'))
+        self.assertEqual(
+            '--resolve www.example.org:8080:127.0.0.1 http://www.example.org:8080/',
+            fablib._curl_this_host('http://www.example.org:8080/'))
+
+
+if __name__ == '__main__':
+    unittest.main()
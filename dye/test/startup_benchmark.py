@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+"""Measure the cold start time of tasks.py, and which of the slow to import
+modules it loads.
+
+Usage:
+    startup_benchmark.py [RUNS]
+
+Each run is a new python process running "tasks.py -h" against the example
+project, and we report the fastest and the mean wall clock time.
+"""
+import os
+from os import path
+import subprocess
+import sys
+import time
+
+dye_dir = path.abspath(path.join(path.dirname(__file__), os.pardir))
+example_dir = path.join(dye_dir, os.pardir, '{{cookiecutter.repo_name}}', 'deploy')
+
+# modules that tasks.py should only import when a task needs them
+heavy_modules = ['MySQLdb', 'inspect', 'multiprocessing']
+
+loaded_modules_script = """
+import sys
+sys.argv = ['tasks.py', '-h']
+sys.path.insert(0, %r)
+import tasks
+stdout = sys.stdout
+sys.stdout = open('/dev/null', 'w')
+tasks.main(['-d', %r, '-h'])
+sys.stdout = stdout
+print ' '.join([m for m in %r if m in sys.modules])
+"""
+
+
+def _python_env():
+    python_env = dict(os.environ)
+    python_env['PYTHONPATH'] = os.pathsep.join(
+        [path.join(dye_dir, os.pardir)] +
+        python_env.get('PYTHONPATH', '').split(os.pathsep))
+    return python_env
+
+
+def loaded_heavy_modules():
+    """Return the heavy modules that are imported by tasks.py -h"""
+    script = loaded_modules_script % (dye_dir, example_dir, heavy_modules)
+    output = subprocess.Popen([sys.executable, '-c', script],
+        stdout=subprocess.PIPE, env=_python_env()).communicate()[0]
+    return output.split()
+
+
+def time_startup(runs=10):
+    tasks_py = path.join(dye_dir, 'tasks.py')
+    devnull = open(os.devnull, 'w')
+    timings = []
+    for i in range(runs):
+        start = time.time()
+        subprocess.call([sys.executable, tasks_py, '-d', example_dir, '-h'],
+                        stdout=devnull, env=_python_env())
+        timings.append(time.time() - start)
+    devnull.close()
+    return timings
+
+
+def main(argv):
+    runs = 10
+    if argv:
+        runs = int(argv[0])
+    timings = time_startup(runs)
+    print "tasks.py -h over %d runs: fastest %.1f ms, mean %.1f ms" % (
+        runs, min(timings) * 1000, sum(timings) / len(timings) * 1000)
+    print "heavy modules loaded: %s" % (' '.join(loaded_heavy_modules()) or 'none')
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -1,7 +1,9 @@
 import os
 from os import path
 import sys
+import shutil
 import StringIO
+import tempfile
 import unittest
 import MySQLdb
 
@@ -327,5 +329,86 @@ class TestMysqlDumpCron(MysqlMixin, unittest.TestCase):
         self.assertEqual(expected_output, actual_output)
 
 
+
+class TestSplitMysqldump(unittest.TestCase):
+
+    dump = (
+        "/*!40101 SET NAMES utf8 */;\n"
+        "-- Table structure for table `auth_user`\n"
+        "CREATE TABLE `auth_user` (\n"
+        "  `id` int(11) NOT NULL AUTO_INCREMENT,\n"
+        "  `username` varchar(30) NOT NULL,\n"
+        "  PRIMARY KEY (`id`),\n"
+        "  UNIQUE KEY `username` (`username`)\n"
+        ") ENGINE=InnoDB DEFAULT CHARSET=utf8;\n"
+        "INSERT INTO `auth_user` VALUES (1,'a');\n"
+        "-- Table structure for table `post`\n"
+        "CREATE TABLE `post` (\n"
+        "  `id` int(11) NOT NULL AUTO_INCREMENT,\n"
+        "  `user_id` int(11) NOT NULL,\n"
+        "  PRIMARY KEY (`id`),\n"
+        "  KEY `post_user_id` (`user_id`),\n"
+        "  CONSTRAINT `fk` FOREIGN KEY (`user_id`) REFERENCES `auth_user` (`id`)\n"
+        ") ENGINE=InnoDB DEFAULT CHARSET=utf8;\n"
+        "INSERT INTO `post` VALUES (1,1);\n"
+    )
+
+    def setUp(self):
+        self.split_dir = tempfile.mkdtemp()
+        self.tables, self.foreign_keys = database._split_mysqldump(
+            StringIO.StringIO(self.dump), self.split_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.split_dir)
+
+    def table_sql(self, index):
+        return open(self.tables[index][1]).read()
+
+    def test_split_mysqldump_makes_file_for_each_table(self):
+        self.assertEqual(['auth_user', 'post'], [t[0] for t in self.tables])
+        self.assertTrue('INSERT INTO `post`' in self.table_sql(1))
+        self.assertFalse('INSERT INTO `auth_user`' in self.table_sql(1))
+
+    def test_split_mysqldump_repeats_header_and_turns_off_checks(self):
+        sql = self.table_sql(1)
+        self.assertTrue(sql.startswith("/*!40101 SET NAMES utf8 */;\n"))
+        self.assertTrue('SET unique_checks=0;' in sql)
+        self.assertTrue('SET foreign_key_checks=0;' in sql)
+
+    def test_split_mysqldump_adds_indexes_after_rows(self):
+        sql = self.table_sql(0)
+        self.assertTrue("  `username` varchar(30) NOT NULL,\n"
+                        "  PRIMARY KEY (`id`)\n)" in sql)
+        self.assertTrue(sql.endswith(
+            "ALTER TABLE `auth_user` ADD UNIQUE KEY `username` (`username`);\n"))
+
+    def test_split_mysqldump_returns_foreign_keys_separately(self):
+        self.assertFalse('CONSTRAINT' in self.table_sql(1))
+        self.assertEqual("ALTER TABLE `post` ADD CONSTRAINT `fk` FOREIGN KEY "
+                         "(`user_id`) REFERENCES `auth_user` (`id`);\n",
+                         self.foreign_keys)
+
+    def test_split_mysqldump_keeps_key_for_auto_increment_column(self):
+        lines, keys, constraints = database._defer_keys([
+            "CREATE TABLE `log` (\n",
+            "  `name` varchar(30) NOT NULL,\n",
+            "  `seq` int(11) NOT NULL AUTO_INCREMENT,\n",
+            "  PRIMARY KEY (`name`,`seq`),\n",
+            "  KEY `log_name` (`name`),\n",
+            "  KEY `log_seq` (`seq`),\n",
+            "  KEY `log_seq_name` (`seq`,`name`)\n",
+            ") ENGINE=InnoDB DEFAULT CHARSET=utf8;\n"])
+        self.assertTrue("  KEY `log_seq` (`seq`)\n" in lines)
+        self.assertEqual(["KEY `log_name` (`name`)",
+                          "KEY `log_seq_name` (`seq`,`name`)"], keys)
+
+    def test_split_mysqldump_refuses_dump_without_comments(self):
+        dump = "".join([line for line in self.dump.splitlines(True)
+                        if not line.startswith('--')])
+        self.assertRaises(tasklib.exceptions.InvalidProjectError,
+                          database._split_mysqldump,
+                          StringIO.StringIO(dump), self.split_dir)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -2,11 +2,13 @@ import os
 from os import path
 import sys
 import shutil
+import tempfile
 import unittest
 
 dye_dir = path.join(path.dirname(__file__), os.pardir)
 sys.path.append(dye_dir)
 import tasklib
+from tasklib import django as tasklib_django
 from tasklib.exceptions import InvalidProjectError
 
 example_dir = path.join(dye_dir, os.pardir, '{{cookiecutter.repo_name}}', 'deploy')
@@ -159,5 +161,281 @@ class TestLinkLocalSettings(unittest.TestCase):
     # patch south
 
 
+class FakeMySQLdb(object):
+    class Error(Exception):
+        pass
+
+    class ProgrammingError(Error):
+        pass
+
+
+class FakeCursor(object):
+    def __init__(self, rows=None, error=None):
+        self.rows = rows
+        self.error = error
+        self.queries = []
+
+    def execute(self, sql):
+        self.queries.append(sql)
+        if self.error:
+            raise self.error
+        return len(self.rows)
+
+    def fetchall(self):
+        return self.rows
+
+    def close(self):
+        pass
+
+
+class TestPendingMigrations(unittest.TestCase):
+    def setUp(self):
+        self.testdir = tempfile.mkdtemp()
+        tasklib.env['django_dir'] = self.testdir
+        tasklib.env['django_apps'] = ['main', 'other']
+        migrations_dir = path.join(self.testdir, 'main', 'migrations')
+        os.makedirs(migrations_dir)
+        for filename in ('__init__.py', '0001_initial.py', '0002_add_field.py',
+                         '0002_add_field.pyc'):
+            open(path.join(migrations_dir, filename), 'w').close()
+        tasklib.database.db_details['engine'] = 'django.db.backends.mysql'
+        self.cursor = FakeCursor()
+        self.real_get_cursor = tasklib_django._get_user_db_cursor
+        self.real_import_mysqldb = tasklib_django._import_mysqldb
+        tasklib_django._get_user_db_cursor = lambda: self.cursor
+        tasklib_django._import_mysqldb = lambda: FakeMySQLdb
+
+    def tearDown(self):
+        shutil.rmtree(self.testdir)
+        tasklib_django._get_user_db_cursor = self.real_get_cursor
+        tasklib_django._import_mysqldb = self.real_import_mysqldb
+        tasklib.database._reset_db_details()
+
+    def test_migrations_on_disk_are_found(self):
+        self.assertEqual(
+            set([('main', '0001_initial'), ('main', '0002_add_field')]),
+            tasklib_django._migrations_on_disk())
+
+    def test_unapplied_migrations_are_pending(self):
+        self.cursor.rows = [('main', '0001_initial')]
+        self.assertEqual([('main', '0002_add_field')],
+                         tasklib_django._pending_migrations())
+        self.assertEqual(1, len(self.cursor.queries))
+
+    def test_nothing_pending_when_all_applied(self):
+        self.cursor.rows = [('main', '0001_initial'), ('main', '0002_add_field')]
+        self.assertEqual([], tasklib_django._pending_migrations())
+
+    def test_all_pending_when_there_is_no_history_table(self):
+        self.cursor.error = FakeMySQLdb.ProgrammingError(1146, "doesn't exist")
+        self.assertEqual(2, len(tasklib_django._pending_migrations()))
+
+    def test_cannot_tell_for_sqlite(self):
+        tasklib.database.db_details['engine'] = 'django.db.backends.sqlite3'
+        self.assertEqual(None, tasklib_django._pending_migrations())
+
+
+class TestCollectStaticIncremental(unittest.TestCase):
+    def setUp(self):
+        self.testdir = tempfile.mkdtemp()
+        self.source_dir = path.join(self.testdir, 'source')
+        self.static_root = path.join(self.testdir, 'static')
+        os.makedirs(path.join(self.source_dir, 'css'))
+        self.sources = {
+            'site.js': self.create_source('site.js', 'alert(1);'),
+            path.join('css', 'site.css'):
+                self.create_source(path.join('css', 'site.css'), 'body {}'),
+        }
+
+    def tearDown(self):
+        shutil.rmtree(self.testdir)
+
+    def create_source(self, rel_path, contents):
+        source = path.join(self.source_dir, rel_path)
+        with open(source, 'w') as f:
+            f.write(contents)
+        return source
+
+    def collect(self, previous_static_root=None):
+        return tasklib_django._collect_static_incremental(
+            self.static_root, self.sources, previous_static_root)
+
+    def test_first_run_copies_all_files_and_writes_manifest(self):
+        counts = self.collect()
+        self.assertEqual(2, counts['copied'])
+        self.assertEqual(0, counts['skipped'])
+        self.assertTrue(path.isfile(path.join(self.static_root, 'css', 'site.css')))
+        self.assertTrue(path.isfile(
+            tasklib_django._static_manifest_path(self.static_root)))
+
+    def test_second_run_skips_unchanged_files(self):
+        self.collect()
+        counts = self.collect()
+        self.assertEqual(0, counts['copied'])
+        self.assertEqual(2, counts['skipped'])
+
+    def test_changed_file_is_copied(self):
+        self.collect()
+        self.create_source('site.js', 'alert(2);')
+        counts = self.collect()
+        self.assertEqual(1, counts['copied'])
+        self.assertEqual(1, counts['skipped'])
+        with open(path.join(self.static_root, 'site.js')) as f:
+            self.assertEqual('alert(2);', f.read())
+
+    def test_removed_file_is_removed(self):
+        self.collect()
+        del self.sources['site.js']
+        counts = self.collect()
+        self.assertEqual(1, counts['removed'])
+        self.assertFalse(path.exists(path.join(self.static_root, 'site.js')))
+
+    def test_unchanged_files_are_hardlinked_from_previous_static_root(self):
+        self.collect()
+        previous_static_root = self.static_root
+        self.static_root = path.join(self.testdir, 'next_static')
+        counts = self.collect(previous_static_root)
+        self.assertEqual(2, counts['linked'])
+        self.assertEqual(0, counts['copied'])
+        previous_stat = os.stat(path.join(previous_static_root, 'site.js'))
+        next_stat = os.stat(path.join(self.static_root, 'site.js'))
+        self.assertEqual(previous_stat.st_ino, next_stat.st_ino)
+
+
+class TestPostProcessStatic(unittest.TestCase):
+    def setUp(self):
+        self.testdir = tempfile.mkdtemp()
+        self.source_dir = path.join(self.testdir, 'source')
+        self.static_root = path.join(self.testdir, 'static')
+        os.makedirs(self.source_dir)
+        self.sources = {
+            'site.css': self.create_source('site.css', 'body { color: red; }\n' * 50),
+            'logo.png': self.create_source('logo.png', 'not really a png'),
+        }
+
+    def tearDown(self):
+        shutil.rmtree(self.testdir)
+
+    def create_source(self, rel_path, contents):
+        source = path.join(self.source_dir, rel_path)
+        with open(source, 'w') as f:
+            f.write(contents)
+        return source
+
+    def collect_and_post_process(self):
+        counts = tasklib_django._collect_static_incremental(
+            self.static_root, self.sources)
+        tasklib_django._post_process_static(self.static_root,
+            counts['changed'], counts['stale'], processes=1)
+        manifest = tasklib_django._load_static_manifest(
+            tasklib_django._static_manifest_path(self.static_root))
+        return manifest
+
+    def static_file(self, rel_path):
+        return path.join(self.static_root, rel_path)
+
+    def test_hashed_name_inserts_hash_before_extension(self):
+        self.assertEqual('css/site.0123456789ab.css',
+            tasklib_django._hashed_name('css/site.css', '0123456789abcdef'))
+
+    def test_compressible_files_get_gz_sibling(self):
+        self.collect_and_post_process()
+        self.assertTrue(path.isfile(self.static_file('site.css.gz')))
+        self.assertFalse(path.exists(self.static_file('logo.png.gz')))
+
+    def test_hashed_copies_and_names_file_are_written(self):
+        manifest = self.collect_and_post_process()
+        hashed_css = tasklib_django._hashed_name('site.css', manifest['site.css']['hash'])
+        self.assertTrue(path.isfile(self.static_file(hashed_css)))
+        self.assertTrue(path.isfile(self.static_file(hashed_css + '.gz')))
+        names = tasklib_django._load_static_manifest(
+            self.static_file(tasklib_django.static_hashed_names_file))
+        self.assertEqual(hashed_css, names['paths']['site.css'])
+
+    def test_stale_hashed_copies_are_removed(self):
+        manifest = self.collect_and_post_process()
+        old_hashed_css = tasklib_django._hashed_name(
+            'site.css', manifest['site.css']['hash'])
+        self.create_source('site.css', 'body { color: blue; }\n' * 50)
+        self.collect_and_post_process()
+        self.assertFalse(path.exists(self.static_file(old_hashed_css)))
+        self.assertFalse(path.exists(self.static_file(old_hashed_css + '.gz')))
+
+    def test_failed_post_processing_is_done_again_next_run(self):
+        real = (tasklib_django._import_settings,
+                tasklib_django._find_static_sources,
+                tasklib_django._post_process_static_file)
+        static_root = self.static_root
+        tasklib_django._import_settings = lambda: type('settings', (), {
+            'STATIC_ROOT': static_root})
+        tasklib_django._find_static_sources = lambda settings: self.sources
+
+        def fail(args):
+            raise IOError('No space left on device')
+        try:
+            tasklib_django._post_process_static_file = fail
+            self.assertRaises(IOError, tasklib_django.collect_static,
+                              processes=1)
+            self.assertFalse(path.exists(
+                tasklib_django._static_manifest_path(self.static_root)))
+            tasklib_django._post_process_static_file = real[2]
+            counts = tasklib_django.collect_static(processes=1)
+        finally:
+            (tasklib_django._import_settings,
+             tasklib_django._find_static_sources,
+             tasklib_django._post_process_static_file) = real
+        self.assertEqual(2, len(counts['changed']))
+        self.assertTrue(path.isfile(self.static_file('site.css.gz')))
+        self.assertTrue(path.isfile(
+            tasklib_django._static_manifest_path(self.static_root)))
+
+
+class TestNextDbSettings(unittest.TestCase):
+    def setUp(self):
+        self.testdir = tempfile.mkdtemp()
+        self.old_env = dict(tasklib.env)
+        tasklib.env['django_dir'] = self.testdir
+        tasklib.env['manage_py_settings'] = 'dye_test_settings'
+        f = open(path.join(self.testdir, 'dye_test_settings.py'), 'w')
+        try:
+            f.write("DATABASES = {'default': {'NAME': 'testproj'}}\n")
+        finally:
+            f.close()
+        sys.path.insert(0, self.testdir)
+
+    def tearDown(self):
+        sys.path.remove(self.testdir)
+        for module in ('dye_test_settings', 'dye_next_db_settings',
+                       'dyetestproj', 'dyetestproj.settings'):
+            sys.modules.pop(module, None)
+        tasklib.env.clear()
+        tasklib.env.update(self.old_env)
+        shutil.rmtree(self.testdir)
+
+    def test_next_db_settings_use_next_database(self):
+        tasklib_django._write_next_db_settings('testproj_next')
+        import dye_next_db_settings
+        self.assertEqual('testproj_next',
+                         dye_next_db_settings.DATABASES['default']['NAME'])
+
+    def test_next_db_settings_import_settings_from_settings_dir(self):
+        del tasklib.env['manage_py_settings']
+        settings_dir = path.join(self.testdir, 'dyetestproj')
+        tasklib.env['django_settings_dir'] = settings_dir
+        os.mkdir(settings_dir)
+        for filename, contents in [
+                ('__init__.py', ''),
+                ('settings.py', "DATABASES = {'default': {'NAME': 'testproj'}}\n")]:
+            f = open(path.join(settings_dir, filename), 'w')
+            try:
+                f.write(contents)
+            finally:
+                f.close()
+        tasklib_django._write_next_db_settings('testproj_next')
+        import dye_next_db_settings
+        self.assertEqual('testproj_next',
+                         dye_next_db_settings.DATABASES['default']['NAME'])
+
+
 if __name__ == '__main__':
     unittest.main()
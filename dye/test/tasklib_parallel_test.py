@@ -0,0 +1,130 @@
+import os
+from os import path
+import sys
+from StringIO import StringIO
+import threading
+import unittest
+
+dye_dir = path.join(path.dirname(__file__), os.pardir)
+sys.path.append(dye_dir)
+import tasklib
+from tasklib import parallel
+from tasklib import util
+from tasklib.exceptions import TasksError
+from dye import command_trace as trace
+
+tasklib.env['verbose'] = False
+tasklib.env['quiet'] = True
+
+
+class TestRunSteps(unittest.TestCase):
+    def setUp(self):
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def step(self, name, fail=False):
+        def function():
+            if fail:
+                raise TasksError('%s failed' % name)
+            self.lock.acquire()
+            try:
+                self.calls.append(name)
+            finally:
+                self.lock.release()
+        return function
+
+    def test_single_job_runs_steps_in_order(self):
+        parallel._run_steps([
+            ('a', self.step('a'), []),
+            ('b', self.step('b'), []),
+            ('c', self.step('c'), []),
+        ], jobs=1)
+        self.assertEqual(['a', 'b', 'c'], self.calls)
+
+    def test_dependencies_are_run_first(self):
+        parallel._run_steps([
+            ('a', self.step('a'), []),
+            ('b', self.step('b'), ['a']),
+            ('c', self.step('c'), ['b']),
+        ], jobs=4)
+        self.assertEqual(['a', 'b', 'c'], self.calls)
+
+    def test_independent_steps_all_run(self):
+        parallel._run_steps([
+            ('a', self.step('a'), []),
+            ('b', self.step('b'), []),
+            ('c', self.step('c'), ['a', 'b']),
+        ], jobs=2)
+        self.assertEqual(set(['a', 'b', 'c']), set(self.calls))
+        self.assertEqual('c', self.calls[-1])
+
+    def test_failure_cancels_only_dependent_steps(self):
+        with self.assertRaises(TasksError):
+            parallel._run_steps([
+                ('a', self.step('a', fail=True), []),
+                ('b', self.step('b'), ['a']),
+                ('c', self.step('c'), []),
+                ('d', self.step('d'), ['b']),
+            ], jobs=2)
+        self.assertEqual(['c'], self.calls)
+
+    def test_keyboard_interrupt_in_step_is_raised(self):
+        def interrupted():
+            raise KeyboardInterrupt()
+        with self.assertRaises(KeyboardInterrupt):
+            parallel._run_steps([
+                ('a', interrupted, []),
+                ('b', self.step('b'), ['a']),
+            ], jobs=2)
+        self.assertEqual([], self.calls)
+
+    def test_nested_steps_are_prefixed_with_both_names(self):
+        stream = StringIO()
+        stdout = sys.stdout
+        sys.stdout = stream
+        try:
+            def outer():
+                parallel._run_steps([('inner', lambda: say('hello'), [])],
+                                    jobs=2)
+
+            def say(text):
+                print text
+            parallel._run_steps([('outer', outer, [])], jobs=2)
+        finally:
+            sys.stdout = stdout
+        self.assertEqual('[outer/inner] hello\n', stream.getvalue())
+
+    def test_subprocess_output_is_prefixed(self):
+        stream = StringIO()
+        stdout = sys.stdout
+        sys.stdout = stream
+        try:
+            parallel._run_steps([
+                ('a', lambda: util._call_wrapper(['echo', 'hello']), []),
+            ], jobs=2)
+        finally:
+            sys.stdout = stdout
+        self.assertEqual('[a] hello\n', stream.getvalue())
+        self.assertEqual(len('hello\n'), trace.trace_records[-1]['output_bytes'])
+
+    def test_stdout_is_restored(self):
+        stdout = sys.stdout
+        parallel._run_steps([('a', self.step('a'), [])], jobs=2)
+        self.assertTrue(sys.stdout is stdout)
+
+
+class TestDependsOn(unittest.TestCase):
+    def test_undeclared_task_returns_none(self):
+        def task():
+            pass
+        self.assertEqual(None, parallel._declared_dependencies(task))
+
+    def test_declared_dependencies_are_returned(self):
+        @parallel.depends_on('a', 'b')
+        def task():
+            pass
+        self.assertEqual(('a', 'b'), parallel._declared_dependencies(task))
+
+
+if __name__ == '__main__':
+    unittest.main()
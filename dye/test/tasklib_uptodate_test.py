@@ -0,0 +1,201 @@
+import os
+from os import path
+import sys
+import shutil
+import tempfile
+import unittest
+
+dye_dir = path.join(path.dirname(__file__), os.pardir)
+sys.path.append(dye_dir)
+import tasklib
+from tasklib import uptodate
+
+tasklib.env['verbose'] = False
+tasklib.env['quiet'] = True
+
+
+class TestRunUnlessUpToDate(unittest.TestCase):
+    def setUp(self):
+        self.testdir = tempfile.mkdtemp()
+        tasklib.env['vcs_root_dir'] = self.testdir
+        tasklib.env['force_tasks'] = False
+        self.calls = []
+
+    def tearDown(self):
+        shutil.rmtree(self.testdir)
+        del tasklib.env['vcs_root_dir']
+        del tasklib.env['force_tasks']
+
+    def task(self, *args):
+        self.calls.append(args)
+
+    def run_task(self, args=(), inputs=None, outputs=()):
+        if inputs is None:
+            inputs = {'input': 'a'}
+        uptodate._run_unless_up_to_date('task', self.task, args=args,
+                                        inputs=inputs, outputs=outputs)
+
+    def test_task_is_run_first_time(self):
+        self.run_task()
+        self.assertEqual(1, len(self.calls))
+
+    def test_task_is_skipped_when_inputs_unchanged(self):
+        self.run_task()
+        self.run_task()
+        self.assertEqual(1, len(self.calls))
+
+    def test_task_is_run_when_inputs_change(self):
+        self.run_task()
+        self.run_task(inputs={'input': 'b'})
+        self.assertEqual(2, len(self.calls))
+
+    def test_task_is_run_when_args_change(self):
+        self.run_task(args=('staging',))
+        self.run_task(args=('production',))
+        self.assertEqual(2, len(self.calls))
+
+    def test_task_is_run_when_an_input_is_unknown(self):
+        self.run_task(inputs={'input': None})
+        self.run_task(inputs={'input': None})
+        self.assertEqual(2, len(self.calls))
+
+    def test_task_is_run_when_output_missing(self):
+        output = path.join(self.testdir, 'output')
+        self.run_task(outputs=[output])
+        self.run_task(outputs=[output])
+        self.assertEqual(2, len(self.calls))
+
+    def test_task_is_run_when_forced(self):
+        self.run_task()
+        tasklib.env['force_tasks'] = True
+        self.run_task()
+        self.assertEqual(2, len(self.calls))
+
+    def test_task_is_not_recorded_when_it_fails(self):
+        def failing_task():
+            raise Exception('failed')
+        self.assertRaises(Exception, uptodate._run_unless_up_to_date,
+                          'task', failing_task, inputs={'input': 'a'})
+        self.run_task()
+        self.assertEqual(1, len(self.calls))
+
+    def test_clean_task_state_makes_task_run_again(self):
+        self.run_task()
+        uptodate.clean_task_state()
+        self.run_task()
+        self.assertEqual(2, len(self.calls))
+
+
+class TestHashFiles(unittest.TestCase):
+    def setUp(self):
+        self.testdir = tempfile.mkdtemp()
+        self.test_file = path.join(self.testdir, 'test.txt')
+
+    def tearDown(self):
+        shutil.rmtree(self.testdir)
+
+    def write_test_file(self, contents):
+        with open(self.test_file, 'w') as f:
+            f.write(contents)
+
+    def test_hash_changes_when_file_is_created(self):
+        missing_hash = uptodate._hash_files(self.test_file)
+        self.write_test_file('')
+        self.assertNotEqual(missing_hash, uptodate._hash_files(self.test_file))
+
+    def test_hash_changes_when_contents_change(self):
+        self.write_test_file('a')
+        first_hash = uptodate._hash_files(self.test_file)
+        self.write_test_file('b')
+        self.assertNotEqual(first_hash, uptodate._hash_files(self.test_file))
+
+    def test_hash_is_the_same_when_vcs_root_dir_is_moved(self):
+        self.write_test_file('a')
+        tasklib.env['vcs_root_dir'] = self.testdir
+        try:
+            first_hash = uptodate._hash_files(self.test_file)
+            moved_dir = self.testdir + '_moved'
+            os.rename(self.testdir, moved_dir)
+            self.testdir = moved_dir
+            tasklib.env['vcs_root_dir'] = moved_dir
+            self.assertEqual(first_hash, uptodate._hash_files(
+                path.join(moved_dir, 'test.txt')))
+        finally:
+            del tasklib.env['vcs_root_dir']
+
+    def test_hash_dir_ignores_other_extensions(self):
+        first_hash = uptodate._hash_dir(self.testdir)
+        self.write_test_file('a')
+        self.assertEqual(first_hash, uptodate._hash_dir(self.testdir))
+
+
+class TestSubmodulesUpToDate(unittest.TestCase):
+    def setUp(self):
+        self.testdir = tempfile.mkdtemp()
+        os.mkdir(path.join(self.testdir, '.git'))
+        tasklib.env['force_tasks'] = False
+
+    def tearDown(self):
+        shutil.rmtree(self.testdir)
+        del tasklib.env['force_tasks']
+
+    def test_not_up_to_date_before_first_update(self):
+        self.assertFalse(uptodate._submodules_up_to_date(self.testdir, 'sig'))
+
+    def test_up_to_date_after_update_with_same_signature(self):
+        uptodate._record_submodules_updated(self.testdir, 'sig')
+        self.assertTrue(uptodate._submodules_up_to_date(self.testdir, 'sig'))
+
+    def test_not_up_to_date_when_signature_changes(self):
+        uptodate._record_submodules_updated(self.testdir, 'sig')
+        self.assertFalse(uptodate._submodules_up_to_date(self.testdir, 'new'))
+
+    def test_not_up_to_date_without_a_signature(self):
+        self.assertFalse(uptodate._submodules_up_to_date(self.testdir, None))
+
+    def test_signature_is_none_outside_git_checkout(self):
+        shutil.rmtree(path.join(self.testdir, '.git'))
+        self.assertEqual(None, uptodate._git_submodules_signature(self.testdir))
+
+
+class TestUpdateDbStep(unittest.TestCase):
+    def setUp(self):
+        self.testdir = tempfile.mkdtemp()
+        tasklib.env['vcs_root_dir'] = self.testdir
+        tasklib.env['force_tasks'] = False
+        self.calls = []
+        self.pending = []
+        self.real = {}
+        for name, replacement in [
+                ('update_db', lambda: self.calls.append('update_db')),
+                ('_pending_migrations', lambda: self.pending),
+                ('_update_db_inputs', lambda: {'migrations': 'a'}),
+                ('_syncdb_inputs', lambda: {'apps': 'a'})]:
+            self.real[name] = getattr(tasklib.tasklib, name)
+            setattr(tasklib.tasklib, name, replacement)
+
+    def tearDown(self):
+        for name, real in self.real.items():
+            setattr(tasklib.tasklib, name, real)
+        shutil.rmtree(self.testdir)
+        del tasklib.env['vcs_root_dir']
+        del tasklib.env['force_tasks']
+
+    def run_step(self):
+        name, step, depends = tasklib.tasklib._update_db_step()
+        step()
+
+    def test_skipped_when_up_to_date(self):
+        self.run_step()
+        self.run_step()
+        self.assertEqual(['update_db'], self.calls)
+
+    def test_run_when_database_has_pending_migrations(self):
+        self.run_step()
+        self.pending = [('main', '0002_add_field')]
+        self.run_step()
+        self.assertEqual(['update_db', 'update_db'], self.calls)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,144 @@
+import os
+from os import path
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+
+dye_dir = path.join(path.dirname(__file__), os.pardir)
+sys.path.append(dye_dir)
+import tasklib
+from tasklib import util
+from dye import command_trace as trace
+
+tasklib.env['verbose'] = False
+tasklib.env['quiet'] = True
+
+
+class TestCommandTrace(unittest.TestCase):
+    def setUp(self):
+        self.testdir = tempfile.mkdtemp()
+        self.trace_file = path.join(self.testdir, 'trace.jsonl')
+        del trace.trace_records[:]
+        del trace.trace_spans[:]
+        del trace._merged_traces[:]
+
+    def tearDown(self):
+        shutil.rmtree(self.testdir)
+        del trace.trace_records[:]
+        del trace.trace_spans[:]
+        del trace._merged_traces[:]
+        tasklib.env.pop('trace_file', None)
+
+    def test_call_wrapper_records_command_and_exit_code(self):
+        util._call_wrapper(['false'])
+        self.assertEqual(1, len(trace.trace_records))
+        record = trace.trace_records[0]
+        self.assertEqual('false', record['command'])
+        self.assertEqual(1, record['exit_code'])
+        self.assertTrue(record['end'] >= record['start'])
+
+    def test_call_wrapper_appends_json_line_to_trace_file(self):
+        tasklib.env['trace_file'] = self.trace_file
+        util._call_wrapper(['true'])
+        util._call_wrapper('true', shell=True)
+        with open(self.trace_file) as f:
+            records = [json.loads(line) for line in f]
+        self.assertEqual(2, len(records))
+        self.assertEqual(0, records[1]['exit_code'])
+
+    def test_record_command_joins_argument_lists(self):
+        record = trace._record_command(['ls', '-l'], 1.0, 3.5, 0, 10, host='web1')
+        self.assertEqual('ls -l', record['command'])
+        self.assertEqual(2.5, record['seconds'])
+        self.assertEqual('web1', record['host'])
+
+    def test_trace_summary_lists_slowest_first(self):
+        trace._record_command('fast', 1.0, 2.0, 0, host='web1')
+        trace._record_command('slow', 1.0, 11.0, 0, host='web1')
+        lines = trace._trace_summary()
+        self.assertTrue(lines[1].endswith('slow'))
+        self.assertTrue(lines[2].endswith('fast'))
+        self.assertTrue('11.0 seconds in total for 2 commands' in lines[-1])
+
+    def test_trace_summary_is_empty_with_no_commands(self):
+        self.assertEqual([], trace._trace_summary())
+
+    def test_mysql_password_is_not_recorded(self):
+        record = trace._record_command(['mysql', '-u', 'dye', '-psecret', 'db'],
+                                       1.0, 2.0, 0)
+        self.assertEqual('mysql -u dye -p*** db', record['command'])
+
+    def test_other_commands_options_are_not_masked(self):
+        command = "find . -path ./ve -prune -o -name '*.pyc' -print0"
+        record = trace._record_command(command, 1.0, 2.0, 0)
+        self.assertEqual(command, record['command'])
+
+    def test_chrome_trace_has_complete_event_per_span(self):
+        trace._record_command('ls', 1.0, 1.5, 0, host='web1')
+        with trace._span('deploy', 'task', host='web1'):
+            pass
+        events = [e for e in trace._chrome_trace_events() if e['ph'] == 'X']
+        self.assertEqual(['ls', 'deploy'], [e['name'] for e in events])
+        self.assertEqual(1000000, events[0]['ts'])
+        self.assertEqual(500000, events[0]['dur'])
+
+    def test_chrome_trace_has_process_per_host(self):
+        trace._record_command('ls', 1.0, 1.5, 0, host='web1')
+        trace._record_command('ls', 1.0, 1.5, 0, host='web2')
+        events = trace._chrome_trace_events()
+        process_names = [e['args']['name'] for e in events
+                         if e['name'] == 'process_name']
+        self.assertEqual(['web1', 'web2'], process_names)
+        pids = [e['pid'] for e in events if e['ph'] == 'X']
+        self.assertNotEqual(pids[0], pids[1])
+
+    def test_merged_trace_is_moved_to_host_process(self):
+        profile_file = path.join(self.testdir, 'profile.json')
+        with trace._span('update_db', 'step', host='server'):
+            pass
+        trace._write_chrome_trace(profile_file)
+        del trace.trace_spans[:]
+        trace._record_command('ls', 1.0, 1.5, 0, host='web1')
+        trace._merge_chrome_trace(profile_file, 'web1 tasks.py')
+        events = trace._chrome_trace_events()
+        process_names = [e['args']['name'] for e in events
+                         if e['name'] == 'process_name']
+        self.assertEqual(['web1', 'web1 tasks.py'], process_names)
+        update_db = [e for e in events if e['name'] == 'update_db'][0]
+        self.assertEqual(2, update_db['pid'])
+
+
+
+class TestPycFiles(unittest.TestCase):
+    def setUp(self):
+        self.testdir = tempfile.mkdtemp()
+        self.ve_dir = path.join(self.testdir, '.ve')
+        os.mkdir(self.ve_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.testdir)
+
+    def touch(self, *names):
+        for name in names:
+            open(path.join(self.testdir, name), 'w').close()
+
+    def test_orphaned_pyc_files_have_no_py_file(self):
+        self.touch('a.py', 'a.pyc', 'b.pyc')
+        self.assertEqual([path.join(self.testdir, 'b.pyc')],
+                         util._orphaned_pyc_files(self.testdir))
+
+    def test_orphaned_pyc_files_skips_virtualenv(self):
+        self.touch(path.join('.ve', 'c.pyc'))
+        self.assertEqual([], util._orphaned_pyc_files(self.testdir, [self.ve_dir]))
+
+    def test_stale_py_files_have_no_newer_pyc(self):
+        self.touch('a.py', 'a.pyc', 'b.py', 'c.py', 'c.pyc')
+        os.utime(path.join(self.testdir, 'c.pyc'), (0, 0))
+        self.assertEqual(['b.py', 'c.py'], sorted([path.basename(f) for f in
+            util._stale_py_files(self.testdir, [self.ve_dir])]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,8 @@
 import os
 from os import path
+import shutil
 import sys
+import tempfile
 import unittest
 
 # make sure a project_settings is available
@@ -20,6 +22,11 @@ class TasksMainTests(unittest.TestCase):
         self.assertEqual(0, exit_code)
 
 
+    def test_main_h_does_not_import_heavy_modules(self):
+        import startup_benchmark
+        self.assertEqual([], startup_benchmark.loaded_heavy_modules())
+
+
 class TasksArgumentConversionTests(unittest.TestCase):
 
     def test_convert_argument_converts_true_to_boolean_true(self):
@@ -119,3 +126,144 @@ class TasksGetPublicCallablesTests(unittest.TestCase):
     def test_get_public_callables_returns_empty_list_when_passed_none(self):
         public_callables = tasks.get_public_callables(None)
         self.assertEqual([], public_callables)
+
+
+class TasksTaskStepsTests(unittest.TestCase):
+
+    def make_task(self, depends=None):
+        def task():
+            pass
+        if depends is not None:
+            task.depends_on = depends
+        return task
+
+    def test_undeclared_task_depends_on_all_previous_tasks(self):
+        steps = tasks.task_steps([
+            ('a', self.make_task(), (), {}),
+            ('b', self.make_task(), (), {}),
+            ('c', self.make_task(), (), {}),
+        ])
+        self.assertEqual([], steps[0][2])
+        self.assertEqual(['a'], steps[1][2])
+        self.assertEqual(['a', 'b'], steps[2][2])
+
+    def test_declared_task_depends_on_undeclared_tasks(self):
+        steps = tasks.task_steps([
+            ('a', self.make_task(), (), {}),
+            ('b', self.make_task(depends=()), (), {}),
+        ])
+        self.assertEqual(['a'], steps[1][2])
+
+    def test_declared_task_only_depends_on_declared_tasks(self):
+        steps = tasks.task_steps([
+            ('a', self.make_task(depends=()), (), {}),
+            ('b', self.make_task(depends=()), (), {}),
+            ('c', self.make_task(depends=('a',)), (), {}),
+        ])
+        self.assertEqual(['a'], steps[2][2])
+
+    def test_declared_task_depends_on_tasks_its_dependencies_need(self):
+        steps = tasks.task_steps([
+            ('create_private_settings', tasks.tasklib.create_private_settings,
+             (), {}),
+            ('update_db', tasks.tasklib.update_db, (), {}),
+        ])
+        self.assertEqual(['create_private_settings'], steps[1][2])
+
+    def test_repeated_task_gets_unique_name(self):
+        steps = tasks.task_steps([
+            ('a', self.make_task(), (), {}),
+            ('a', self.make_task(), (), {}),
+        ])
+        self.assertEqual(['a', 'a#2'], [step[0] for step in steps])
+
+
+class TasksDatabaseSwapTests(unittest.TestCase):
+    """Run the database swapping tasks through tasks.py, with the MySQL
+    calls replaced, to check they find the database settings themselves"""
+
+    dump = (
+        "-- Table structure for table `auth_user`\n"
+        "CREATE TABLE `auth_user` (\n"
+        "  `id` int(11) NOT NULL AUTO_INCREMENT,\n"
+        "  PRIMARY KEY (`id`)\n"
+        ") ENGINE=InnoDB DEFAULT CHARSET=utf8;\n"
+        "INSERT INTO `auth_user` VALUES (1);\n"
+    )
+
+    def setUp(self):
+        self.testdir = tempfile.mkdtemp()
+        f = open(path.join(self.testdir, 'local_settings.py'), 'w')
+        f.write("DATABASES = {'default': {'ENGINE': 'django.db.backends.mysql', "
+                "'NAME': 'dyedb', 'USER': 'dye_user', 'PASSWORD': 'pw'}}\n")
+        f.close()
+        self.dump_file = path.join(self.testdir, 'db_dump.sql')
+        f = open(self.dump_file, 'w')
+        f.write(self.dump)
+        f.close()
+        self.real_env = dict(tasks.tasklib.env)
+        tasks.tasklib.env['django_settings_dir'] = self.testdir
+        sys.modules.pop('local_settings', None)
+
+        self.database = tasks.tasklib.database
+        self.database._reset_db_details()
+        self.tables = {'dyedb': ['auth_user'], 'dyedb_next': ['auth_user'],
+                       'dyedb_prev': ['old_table']}
+        self.sql = []
+        self.commands = []
+        self.real = {}
+        for name, replacement in [
+                ('_db_exists', lambda db_name: db_name in self.tables),
+                ('_db_tables', lambda db_name: self.tables.get(db_name, [])),
+                ('_recreate_db', lambda db_name: None),
+                ('drop_db', lambda db_name=None: None),
+                ('_mysql_exec_as_root', lambda *sql: self.sql.extend(sql)),
+                ('_check_call_wrapper', lambda argv, **kwargs: None),
+                ('_call_command',
+                 lambda argv, **kwargs: self.commands.append(argv))]:
+            self.real[name] = getattr(self.database, name)
+            setattr(self.database, name, replacement)
+
+    def tearDown(self):
+        for name, real in self.real.items():
+            setattr(self.database, name, real)
+        self.database._reset_db_details()
+        tasks.tasklib.env.clear()
+        tasks.tasklib.env.update(self.real_env)
+        sys.modules.pop('local_settings', None)
+        if self.testdir in sys.path:
+            sys.path.remove(self.testdir)
+        shutil.rmtree(self.testdir)
+
+    def test_dump_db_finds_database_settings(self):
+        dump_file = path.join(self.testdir, 'new_dump.sql')
+        self.assertFalse(tasks.main(['dump_db:' + dump_file]))
+        self.assertEqual(1, len(self.commands))
+        self.assertEqual('mysqldump', self.commands[0][0])
+        self.assertEqual('dyedb', self.commands[0][-1])
+        self.assertTrue(path.exists(dump_file))
+
+    def test_swap_in_next_db_finds_database_settings(self):
+        self.assertFalse(tasks.main(['swap_in_next_db']))
+        self.assertEqual(['RENAME TABLE `dyedb`.`auth_user` TO `dyedb_prev`.`auth_user`, '
+                          '`dyedb_next`.`auth_user` TO `dyedb`.`auth_user`'],
+                         self.sql)
+
+    def test_swap_in_next_db_refuses_empty_next_db(self):
+        self.tables['dyedb_next'] = []
+        self.assertEqual(1, tasks.main(['swap_in_next_db']))
+        self.assertEqual([], self.sql)
+
+    def test_swap_in_prev_db_finds_database_settings(self):
+        self.assertFalse(tasks.main(['swap_in_prev_db']))
+        self.assertEqual(['RENAME TABLE `dyedb`.`auth_user` TO `dyedb_next`.`auth_user`, '
+                          '`dyedb_prev`.`old_table` TO `dyedb`.`old_table`, '
+                          '`dyedb_next`.`auth_user` TO `dyedb_prev`.`auth_user`'],
+                         self.sql)
+
+    def test_restore_db_to_next_finds_database_settings(self):
+        self.assertFalse(tasks.main(['restore_db_to_next:' + self.dump_file]))
+
+    def test_restore_db_to_next_fails_when_tables_are_missing(self):
+        self.tables['dyedb_next'] = []
+        self.assertEqual(1, tasks.main(['restore_db_to_next:' + self.dump_file]))
@@ -92,8 +92,56 @@ server_home = '/var/django'
 # and previous/ containing old copies for rollback
 server_project_home = path.join(server_home, project_name)
 
-# which web server to use (or None)
+# how many old copies to keep for rollback (0 for no limit) - and optionally
+# the oldest to keep, and the disk space they can use between them.  The most
+# recent old copy is always kept.
+#versions_to_keep = 5
+#versions_max_age_days = 30
+#versions_disk_budget_mb = 2000
+
+# to make git checkouts on the servers quicker - only fetch the last
+# git_clone_depth commits, only fetch file contents when they are checked out,
+# and/or keep a mirror of the repository in server_home that the checkouts
+# share objects with and fetch from.  With git_clone_depth the branch on the
+# server is reset to the one fetched rather than merged, so don't make commits
+# on the server
+#git_clone_depth = 50
+#git_partial_clone = True
+#git_use_mirror = True
+# or send the new commits from your local copy of the branch as a git bundle,
+# for servers that can't get to the repository
+#git_push_bundle = True
+# a bare repository that git submodules are cloned with --reference to, so
+# their objects are only fetched once
+#submodule_cache_dir = path.join(server_home, 'git_mirrors', 'submodules.git')
+
+# which web server to use (or None) - 'apache' runs the app with mod_wsgi,
+# 'nginx' runs it with gunicorn (add gunicorn and futures to pip_packages.txt)
 webserver = 'apache'
+# the user for the gunicorn workers
+#gunicorn_user = 'www-data'
+
+# a URL that fab checks answers after reloading the site - it is fetched on
+# the server itself
+#health_check_url = 'http://localhost/'
+
+# the fewest hosts that must stay in the load balancer during rolling_deploy
+#rolling_min_capacity = 2
+
+# load the URLconf, views and templates when each WSGI daemon process starts,
+# rather than on the first requests (fetching warm_up_urls, default ['/']).
+# fab deploy also fetches the warm_up_urls (relative to health_check_url, or
+# http://localhost/) once the new code is running - that only reaches the
+# processes that happen to answer
+wsgi_warm_up = False
+#warm_up_urls = ['/']
+#warm_up_templates = ['base.html']
+
+# fab sizes WSGIDaemonProcess for each server from its CPUs and memory, and
+# the size of the running WSGI processes.  To fix the values instead:
+#wsgi_processes = 2
+#wsgi_threads = 10
+#wsgi_maximum_requests = 200
 
 ###################################################
 # OPTIONAL SETTINGS FOR FABRIC - will be put in env
@@ -126,7 +126,11 @@ class UpdateVE(object):
     def update_git_submodule(self):
         """ pip can include directories, and we sometimes add directories as
         submodules.  And pip install will fail if those directories are empty.
-        So we need to set up the submodules first. """
+        So we need to set up the submodules first.
+
+        This is skipped if .gitmodules and the submodule commits are the same
+        as the last time the submodules were updated - by this, tasks.py or
+        fab, which all record it in .git/dye_submodules """
         try:
             from project_settings import local_vcs_root, repo_type
         except ImportError:
@@ -134,9 +138,37 @@ class UpdateVE(object):
             raise
         if repo_type != 'git':
             return
-        subprocess.call(
-                ['git', 'submodule', 'update', '--init'],
-                cwd=local_vcs_root)
+        git_dir = path.join(local_vcs_root, '.git')
+        state_file = path.join(git_dir, 'dye_submodules')
+        signature = None
+        if path.isdir(git_dir):
+            signature = self.git_submodules_signature(git_dir)
+            if path.isfile(state_file) and \
+                    open(state_file).read().strip() == signature:
+                return
+        # fetch the submodules in parallel - 0 lets git decide how many
+        git_cmd = ['git', '-c', 'submodule.fetchJobs=0', 'submodule',
+                   'update', '--init']
+        import project_settings
+        cache_dir = getattr(project_settings, 'submodule_cache_dir', None)
+        if cache_dir and path.isdir(cache_dir):
+            git_cmd += ['--reference', cache_dir]
+        returncode = subprocess.call(git_cmd, cwd=local_vcs_root)
+        if returncode == 0 and signature is not None:
+            f = open(state_file, 'w')
+            try:
+                f.write(signature + '\n')
+            finally:
+                f.close()
+
+    def git_submodules_signature(self, git_dir):
+        """ the .gitmodules and gitlink lines of the git index - worked out
+        the same way as in dye.tasklib.uptodate """
+        output = subprocess.Popen(
+                ['git', '--git-dir=' + git_dir, 'ls-files', '--stage'],
+                stdout=subprocess.PIPE).communicate()[0]
+        return '\n'.join([line for line in output.splitlines()
+            if line.startswith('160000 ') or line.endswith('\t.gitmodules')])
 
     def delete_virtualenv(self):
         """ delete the virtualenv """
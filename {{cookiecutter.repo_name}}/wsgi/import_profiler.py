@@ -0,0 +1,89 @@
+"""
+Record how long each module takes to import while wsgi_handler.py loads.
+
+This is only used when DYE_PROFILE_IMPORTS=1 is set in the environment of
+the WSGI daemon processes (eg. in /etc/apache2/envvars).  The imports are
+written as a tree to dye_import_profile_<project name>.json in the temp
+directory (the release directory belongs to root, and the daemon processes
+can't write there), or to DYE_PROFILE_IMPORTS_FILE if that is set.  Then
+"tasks.py slowest_imports" shows the slowest.
+
+Each import that loaded new modules is recorded with:
+
+* name - the name that was imported
+* parent - the import it happened inside, or None
+* depth - how far down the tree it is
+* seconds - the time it took, including the imports inside it
+* self - the time it took, not including the imports inside it
+"""
+import __builtin__
+import json
+import os
+import sys
+import tempfile
+import time
+
+_real_import = __builtin__.__import__
+_stack = []
+records = []
+start_time = None
+
+
+def _profiled_import(name, globals=None, locals=None, fromlist=None, level=-1):
+    modules_before = len(sys.modules)
+    entry = {'name': name, 'children': 0.0}
+    _stack.append(entry)
+    import_start = time.time()
+    try:
+        return _real_import(name, globals, locals, fromlist, level)
+    finally:
+        seconds = time.time() - import_start
+        _stack.pop()
+        parent = None
+        if _stack:
+            _stack[-1]['children'] += seconds
+            parent = _stack[-1]['name']
+        # imports of modules that are already loaded aren't interesting
+        if len(sys.modules) != modules_before:
+            records.append({
+                'name': name,
+                'parent': parent,
+                'depth': len(_stack),
+                'seconds': seconds,
+                'self': seconds - entry['children'],
+            })
+
+
+def start():
+    global start_time
+    start_time = time.time()
+    __builtin__.__import__ = _profiled_import
+
+
+def profile_file_for(project_name):
+    return os.environ.get('DYE_PROFILE_IMPORTS_FILE') or os.path.join(
+        tempfile.gettempdir(), 'dye_import_profile_%s.json' % project_name)
+
+
+def stop(profile_file):
+    """Stop recording and write the imports to profile_file.  Failing to
+    write it is logged, not raised - the profile isn't worth the site."""
+    __builtin__.__import__ = _real_import
+    profile = {
+        'pid': os.getpid(),
+        'python': sys.version,
+        'total': time.time() - start_time,
+        'imports': records,
+    }
+    # each daemon process writes the file - the last one wins
+    tmp_file = '%s.%d.tmp' % (profile_file, os.getpid())
+    try:
+        f = open(tmp_file, 'w')
+        try:
+            json.dump(profile, f, indent=1)
+        finally:
+            f.close()
+        os.rename(tmp_file, profile_file)
+    except (IOError, OSError), e:
+        print >>sys.stderr, "import_profiler: could not write %s: %s" % (
+            profile_file, e)
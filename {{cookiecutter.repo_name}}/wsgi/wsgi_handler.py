@@ -20,8 +20,18 @@ import site
 
 vcs_root_dir = path.abspath(path.join(path.dirname(__file__), '..'))
 
+# set DYE_PROFILE_IMPORTS=1 in the environment of the daemon processes to
+# record how long each import takes - see import_profiler.py
+import_profiler = None
+if os.environ.get('DYE_PROFILE_IMPORTS', '') not in ('', '0'):
+    import imp
+    import_profiler = imp.load_source('import_profiler',
+        path.join(path.dirname(path.abspath(__file__)), 'import_profiler.py'))
+    import_profiler.start()
+
 # add deploy dir to path so we can import project_settings
 sys.path.append(path.join(vcs_root_dir, 'deploy'))
+import project_settings
 from project_settings import relative_django_dir, relative_ve_dir
 
 # ensure the virtualenv for this instance is added
@@ -38,3 +48,39 @@ os.environ['DJANGO_SETTINGS_MODULE'] = 'settings'
 
 from django.core.wsgi import get_wsgi_application
 application = get_wsgi_application()
+
+
+def warm_up(urls, template_names):
+    """Load the things Django would otherwise load when the first requests
+    come in: the apps, the URLconf, the views for urls and the template
+    loaders"""
+    try:
+        from django.db.models.loading import get_apps
+        get_apps()
+    except ImportError:
+        # newer django has already loaded the apps in get_wsgi_application
+        pass
+    from django.core import urlresolvers
+    # resolving the urls imports their views
+    for url in urls:
+        try:
+            urlresolvers.resolve(url)
+        except urlresolvers.Resolver404:
+            pass
+    from django.template import loader, TemplateDoesNotExist
+    for template_name in template_names:
+        try:
+            loader.get_template(template_name)
+        except TemplateDoesNotExist:
+            pass
+
+
+# set wsgi_warm_up = True in project_settings.py to do this when the daemon
+# process starts, rather than making the first users wait
+if getattr(project_settings, 'wsgi_warm_up', False):
+    warm_up(getattr(project_settings, 'warm_up_urls', ['/']),
+            getattr(project_settings, 'warm_up_templates', ['base.html']))
+
+if import_profiler is not None:
+    import_profiler.stop(
+        import_profiler.profile_file_for(project_settings.project_name))